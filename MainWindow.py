@@ -1,56 +1,124 @@
 import wx
 import LoginDialog
-import gpxParse
+import SummaryDialog
+import TrackListCtrl
+import gpxSources
+import instrument
+import jobs
 import sqlAlch
 import wx.html2
 import wx.html
-import pathlib2
+import json
+import logging
 import os
-from datetime import datetime
 import sys
-import MapMaker as map
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
-import matplotlib.pyplot as plt
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Imported by importHeavyModules() once the user has logged in, so the login
+# dialog does not wait for NumPy, matplotlib and the parsing stack.
+bulkImport = None
+heatmap = None
+plotData = None
+tileCache = None
+trackView = None
+np = None
+matplotlib = None
+Figure = None
+FigureCanvas = None
+
+
+def importHeavyModules():
+    global bulkImport, heatmap, plotData, tileCache, trackView, np, matplotlib, Figure, FigureCanvas
+    import numpy as np
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+    import bulkImport
+    import heatmap
+    import plotData
+    import tileCache
+    import trackView
+
+
+def preloadModules():
+    # Runs on a background thread while the login dialog is open; importing
+    # again in importHeavyModules() is then only a sys.modules lookup.
+    try:
+        import numpy
+        import matplotlib.figure
+        import bulkImport
+        import heatmap
+        import plotData
+        import tileCache
+        import trackView
+    except Exception:
+        log.exception('preloading modules failed')
 
 
 
 
 class MatplotPanel(wx.Panel):
     def __init__(self, parent):
-        plt.rcParams["figure.figsize"] = [3, 2]
-        plt.rcParams["figure.autolayout"] = True
-        plt.rcParams["ytick.labelright"]= False
-        plt.rcParams["ytick.labelleft"] = False
-        plt.rcParams["ytick.left"] = False
+        matplotlib.rcParams["figure.figsize"] = [3, 2]
+        matplotlib.rcParams["figure.autolayout"] = True
+        matplotlib.rcParams["ytick.labelright"]= False
+        matplotlib.rcParams["ytick.labelleft"] = False
+        matplotlib.rcParams["ytick.left"] = False
 
         wx.Panel.__init__(self, parent)
         self.figure = Figure()
         self.axes = self.figure.add_subplot(111)
-        self.axes.axes.get_xaxis().set_visible(False)
+        self.axes.tick_params(axis='x', labelsize=7)
+        self.axes.set_xlabel("km", fontsize=7)
+        # The line is animated: full redraws leave it out so the axes can be
+        # cached as a background and the line blitted on top of it.
+        self.line, = self.axes.plot([], [], animated=True)
         self.canvas = FigureCanvas(self, -1, self.figure)
+        self.background = None
+        self.limits = None
+        self.canvas.mpl_connect('draw_event', self.onCanvasDraw)
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.Add(self.canvas, 1, wx.LEFT | wx.TOP | wx.GROW)
         self.SetSizer(self.sizer)
         self.Fit()
 
+    def onCanvasDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.axes.draw_artist(self.line)
+
+    @instrument.timed('plot.draw')
     def draw(self,x,y):
-        self.figure.clear()
-        self.figure = Figure()
-        self.axes = self.figure.add_subplot(111)
-        self.axes.axes.get_xaxis().set_visible(False)
-        self.canvas = FigureCanvas(self, -1, self.figure)
-        self.sizer = wx.BoxSizer(wx.VERTICAL)
-        self.sizer.Add(self.canvas, 1, wx.LEFT | wx.TOP | wx.GROW)
-        self.SetSizer(self.sizer)
-        self.Fit()
-        self.axes.plot(x, y)
+        buckets = max(self.canvas.GetSize().width, 100)
+        x, y = plotData.decimateMinMax(x, y, buckets)
+        self.line.set_data(x, y)
+        # a ride without elevation or timestamps has no finite values; its
+        # line draws nothing and the axes keep their limits
+        limits = None
+        xFinite, yFinite = x[np.isfinite(x)], y[np.isfinite(y)]
+        if len(xFinite) and len(yFinite):
+            limits = (xFinite.min(), xFinite.max(), yFinite.min(), yFinite.max())
+        if limits == self.limits and self.background is not None:
+            self.canvas.restore_region(self.background)
+            self.axes.draw_artist(self.line)
+            self.canvas.blit(self.axes.bbox)
+            return
+        self.limits = limits
+        if limits is not None:
+            xMin, xMax, yMin, yMax = limits
+            yMargin = (yMax - yMin) * 0.05 or 1.0
+            self.axes.set_xlim(xMin, xMax if xMax > xMin else xMin + 1.0)
+            self.axes.set_ylim(yMin - yMargin, yMax + yMargin)
+        self.canvas.draw()
 
 class MyBrowser(wx.Frame):
     loggedUser = ""
 
     def __init__(self, *args, **kwargs):
         super(MyBrowser, self).__init__(*args, **kwargs)
+        threading.Thread(target=preloadModules, daemon=True).start()
         dlg = LoginDialog.LoginDialog()
         dlg.ShowModal()
         authenticated = dlg.logged_in
@@ -62,38 +130,55 @@ class MyBrowser(wx.Frame):
 
 
     def initUI(self):
+        importHeavyModules()
+        self.jobs = jobs.JobRunner(dispatch=wx.CallAfter)
+        self.importJobs = set()
         vbox = wx.BoxSizer(wx.VERTICAL)
         hbox = wx.BoxSizer(wx.HORIZONTAL)
         self.elevationPanel = MatplotPanel(self)
         self.hrPanel = MatplotPanel(self)
 
-        absPath = os.getcwd()
-        a = pathlib2.Path(absPath + "/" + "maparea.html").as_uri()
         usedBackend = wx.html2.WebViewBackendIE
         wx.html2.WebView.MSWSetEmulationLevel(wx.html2.WEBVIEWIE_EMU_IE11)
         self.browser = wx.html2.WebView.New(self, backend=usedBackend)
-        self.browser.LoadURL(a)
+        self.mapReady = False
+        self.pendingMapScript = None
+        self.browser.Bind(wx.html2.EVT_WEBVIEW_LOADED, self.onMapLoaded)
+        self.heatTiles = heatmap.HeatmapTiles(MyBrowser.loggedUser)
+        # The page, Leaflet and the map tiles come from a local server with a
+        # disk tile cache, so rides already looked at show offline too.
+        self.mapServer = tileCache.MapServer(tileCache.TileCache())
+        self.mapServer.addRoute(heatmap.TILE_ROUTE, self.heatTiles.tile)
+        self.browser.LoadURL(self.mapServer.url('maparea.html'))
 
         self.toolbar1 = self.CreateToolBar()
         tLoad = self.toolbar1.AddTool(wx.ID_ANY, 'Load', wx.Bitmap('ico/download.png'))
+        tImport = self.toolbar1.AddTool(wx.ID_ANY, 'Import folder', wx.Bitmap('ico/folder.png'))
+        tSummary = self.toolbar1.AddTool(wx.ID_ANY, 'Summary', wx.Bitmap('ico/house.png'))
+        self.tHeatmap = self.toolbar1.AddCheckTool(wx.ID_ANY, 'Heatmap', wx.Bitmap('ico/placeholder.png'))
         tSettings = self.toolbar1.AddTool(wx.ID_ANY, 'Settings', wx.Bitmap('ico/settings.png'))
+        self.tStop = self.toolbar1.AddTool(wx.ID_ANY, 'Stop import', wx.Bitmap('ico/reload.png'))
         tQuit = self.toolbar1.AddTool(wx.ID_ANY, 'Quit', wx.Bitmap('ico/cancel.png'))
+        self.toolbar1.EnableTool(self.tStop.GetId(), False)
         self.toolbar1.Realize()
+        self.statusBar = self.CreateStatusBar()
         vbox.Add(self.toolbar1, 0, wx.EXPAND)
 
         self.Bind(wx.EVT_TOOL, self.quit, tQuit)
         self.Bind(wx.EVT_TOOL, self.gpxLoad, tLoad)
+        self.Bind(wx.EVT_TOOL, self.gpxImportFolder, tImport)
+        self.Bind(wx.EVT_TOOL, self.stopImport, self.tStop)
+        self.Bind(wx.EVT_TOOL, self.showSummary, tSummary)
+        self.Bind(wx.EVT_TOOL, self.toggleHeatmap, self.tHeatmap)
         self.Bind(wx.EVT_CLOSE, self.quit)
 
-        datesListTemp = self.getUserTracksDates()
-        dateList = []
-        for index in range(len(datesListTemp)):
-            for key in datesListTemp[index]:
-                dateList.append(datesListTemp[index][key].strftime("%Y-%m-%d %H:%M:%S"))
-
-        # tracksList = self.getUserTracks()
-
-        self.lst = wx.ListBox(self, size=(150, -1), choices=dateList, style=wx.LB_SINGLE)
+        self.trackFilter = wx.SearchCtrl(self, style=wx.TE_PROCESS_ENTER)
+        self.trackFilter.SetDescriptiveText("2024-05  >50  <100")
+        self.trackFilter.ShowCancelButton(True)
+        self.lst = TrackListCtrl.TrackListCtrl(self, MyBrowser.loggedUser)
+        self.listSizer = wx.BoxSizer(wx.VERTICAL)
+        self.listSizer.Add(self.trackFilter, 0, wx.EXPAND | wx.BOTTOM, 2)
+        self.listSizer.Add(self.lst, 1, wx.EXPAND)
         self.box = wx.StaticBox( self, wx.ID_ANY, "GPX Track Data", size=(200, -1))
         self.SetBackgroundColour(wx.WHITE)
         self.trackData = wx.StaticBoxSizer(self.box, wx.VERTICAL )
@@ -137,6 +222,22 @@ class MyBrowser(wx.Frame):
         self.rideTimeSizer.Add(self.rideTimeSpacer)
         self.rideTimeSizer.Add(self.rideTimeLabel2)
 
+        self.movingTimeSizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.movingTimeLabel1 = wx.StaticText(self, -1, "Moving time:")
+        self.movingTimeSpacer = wx.StaticText(self, -1, "    ")
+        self.movingTimeLabel2 = wx.StaticText(self, -1, "")
+        self.movingTimeSizer.Add(self.movingTimeLabel1)
+        self.movingTimeSizer.Add(self.movingTimeSpacer)
+        self.movingTimeSizer.Add(self.movingTimeLabel2)
+
+        self.elevationGainSizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.elevationGainLabel1 = wx.StaticText(self, -1, "Elevation gain:")
+        self.elevationGainSpacer = wx.StaticText(self, -1, "    ")
+        self.elevationGainLabel2 = wx.StaticText(self, -1, "")
+        self.elevationGainSizer.Add(self.elevationGainLabel1)
+        self.elevationGainSizer.Add(self.elevationGainSpacer)
+        self.elevationGainSizer.Add(self.elevationGainLabel2)
+
         self.pointsNumberSizer = wx.BoxSizer(wx.HORIZONTAL)
         self.pointsNumberLabel1 = wx.StaticText(self, -1, "Number of points:")
         self.pointsNumberSpacer = wx.StaticText(self, -1, "    ")
@@ -145,7 +246,7 @@ class MyBrowser(wx.Frame):
         self.pointsNumberSizer.Add(self.pointsNumberSpacer)
         self.pointsNumberSizer.Add(self.pointsNumberLabel2)
 
-        hbox.Add(self.lst, 0, wx.ALIGN_LEFT | wx.EXPAND, 10)
+        hbox.Add(self.listSizer, 0, wx.ALIGN_LEFT | wx.EXPAND, 10)
         hbox.Add(self.browser, 1, wx.EXPAND, 10)
         hbox.Add(self.trackData, 0, wx.EXPAND, 10)
 
@@ -156,11 +257,16 @@ class MyBrowser(wx.Frame):
         self.trackData.Add(self.distanceSizer, 0, wx.EXPAND, 10)
         self.trackData.Add(self.hrSizer, 0, wx.EXPAND, 10)
         self.trackData.Add(self.rideTimeSizer, 0, wx.EXPAND, 10)
+        self.trackData.Add(self.movingTimeSizer, 0, wx.EXPAND, 10)
+        self.trackData.Add(self.elevationGainSizer, 0, wx.EXPAND, 10)
         self.trackData.Add(self.pointsNumberSizer, 0, wx.EXPAND, 10)
         self.trackData.Add(self.elevationPanel, 0, wx.EXPAND, 10)
         self.trackData.Add(self.hrPanel, 0, wx.EXPAND, 10)
-        self.lst.Bind(wx.EVT_LISTBOX, self.getUserPoints, self.lst)
-        self.lst.Bind(wx.EVT_RIGHT_DOWN, self.rightClickMenu, self.lst)
+        self.lst.Bind(wx.EVT_LIST_ITEM_SELECTED, self.getUserPoints)
+        self.lst.Bind(wx.EVT_LIST_ITEM_RIGHT_CLICK, self.rightClickMenu)
+        self.trackFilter.Bind(wx.EVT_TEXT_ENTER, self.onFilter)
+        self.trackFilter.Bind(wx.EVT_SEARCHCTRL_SEARCH_BTN, self.onFilter)
+        self.trackFilter.Bind(wx.EVT_SEARCHCTRL_CANCEL_BTN, self.onFilterCancel)
 
         self.SetSizer(vbox)
         self.SetSizer(hbox)
@@ -172,111 +278,266 @@ class MyBrowser(wx.Frame):
 
     def quit(self, e):
         # self.Close()
+        self.jobs.shutdown()
+        self.mapServer.close()
         self.Destroy()
         sys.exit(0)
 
 
     def gpxLoad(self, e):
+        openFileDialog = wx.FileDialog(self, "Open", "", "",
+                                       "GPX Files and archives (*.gpx;*.gpx.gz;*.zip;*.tar.gz;*.tgz)|"
+                                       "*.gpx;*.gpx.gz;*.zip;*.tar.gz;*.tgz|GPX Files (*.gpx)|*.gpx",
+                                       wx.FD_OPEN | wx.FD_FILE_MUST_EXIST | wx.FD_MULTIPLE)
+        if openFileDialog.ShowModal() == wx.ID_OK:
+            self.startImport(openFileDialog.GetPaths())
+        openFileDialog.Destroy()
+
+    def gpxImportFolder(self, e):
+        openDirDialog = wx.DirDialog(self, "Import folder", "", wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST)
+        if openDirDialog.ShowModal() == wx.ID_OK:
+            self.startImport(bulkImport.findGpxFiles(openDirDialog.GetPath()))
+        openDirDialog.Destroy()
+
+    def showSummary(self, e):
+        dialog = SummaryDialog.SummaryDialog(self, MyBrowser.loggedUser)
+        dialog.ShowModal()
+        dialog.Destroy()
+
+    def toggleHeatmap(self, e):
+        self.refreshHeatmap()
+
+    def refreshHeatmap(self):
+        # The tile URLs carry heatTiles.version, so after an import or a
+        # delete this redraws the layer from the updated cells.
+        if self.toolbar1.GetToolState(self.tHeatmap.GetId()):
+            self.runMapScript("showHeatmap(%s);" % json.dumps(self.heatTiles.urlTemplate()))
+        else:
+            self.runMapScript("hideHeatmap();")
+
+    def startImport(self, paths):
+        # Parsing and inserting run on a worker; the list is refreshed once
+        # when the whole batch is in.
+        self.toolbar1.EnableTool(self.tStop.GetId(), True)
+        self.statusBar.SetStatusText("Importing %d file(s)..." % len(paths))
+        job = self.jobs.submit(self.importJob, self.username, paths,
+                               onDone=self.onImportDone, onError=self.onImportError, onProgress=self.onImportProgress)
+        self.importJobs.add(job)
+
+    def importJob(self, job, user, paths):
+        # one plain file is parsed in place; archives go to the pool
+        workers = 1 if len(paths) == 1 and gpxSources.isGpx(paths[0]) else None
+        return bulkImport.importFiles(user, paths, workers=workers,
+                                      progress=lambda done, total, result: job.reportProgress(done, total))
+
+    def onImportProgress(self, done, total):
+        if total is None:
+            self.statusBar.SetStatusText("Importing %d..." % done)
+        else:
+            self.statusBar.SetStatusText("Importing %d/%d" % (done, total))
+
+    def stopImport(self, e):
+        for job in self.importJobs:
+            job.cancel()
+        self.importFinished()
+        self.statusBar.SetStatusText("Import cancelled")
+
+    def importFinished(self):
+        self.importJobs = set(job for job in self.importJobs if not job.future.done() and not job.cancelled)
+        self.toolbar1.EnableTool(self.tStop.GetId(), bool(self.importJobs))
+
+    def onImportError(self, error):
+        self.importFinished()
+        self.statusBar.SetStatusText("")
+        wx.MessageBox("File not added!", "Message", wx.OK | wx.ICON_ERROR)
+        log.error('import failed: %s', error)
+
+    def onImportDone(self, report):
+        self.importFinished()
+        self.statusBar.SetStatusText(report.summary())
+        self.refreshHeatmap()
+        if report.failed:
+            message = report.summary() + "\n\nNot added:\n" + "\n".join(
+                os.path.basename(result.path) + ": " + str(result.error) for result in report.failed[:20])
+            wx.MessageBox(message, "Import", wx.OK | wx.ICON_ERROR)
+
+    def onMapLoaded(self, event):
+        self.mapReady = True
+        if self.pendingMapScript is not None:
+            self.browser.RunScript(self.pendingMapScript)
+            self.pendingMapScript = None
+
+    def runMapScript(self, script):
+        # maparea.html is loaded once; until it is ready only the latest
+        # script is kept.
+        if self.mapReady:
+            self.browser.RunScript(script)
+        else:
+            self.pendingMapScript = script
+
+    def onFilter(self, event):
         try:
-            openFileDialog = wx.FileDialog(self, "Open", "", "",
-                                           "GPX Files (*.gpx)|*.gpx",
-                                           wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-            openFileDialog.ShowModal()
-            print(openFileDialog.GetPath())
-            gpxPath = openFileDialog.GetPath()
-            gpxObject = gpxParse.GpxRecord(self.username)
-            gpxObject.parseFile(gpxPath)
-            sqlAlch.insertGpxTrack(self.username, gpxObject.avgSpeed, gpxObject.distance, gpxObject.avgHr, gpxObject.rideDate,
-                                   gpxObject.rideTime,
-                                   gpxObject.serializedPointsArray, gpxObject.serializedHrArray,
-                                   gpxObject.serializedElevationArray)
-            openFileDialog.Destroy()
-            self.updateUserTracksDates()
-        except Exception as e:
-            wx.MessageBox("File not added!", "Message", wx.OK | wx.ICON_ERROR)
-            print(e)
-            pass
-
-    def getUserTracksDates(self):
-        return sqlAlch.getTrackDates(MyBrowser.loggedUser)
-
-    def updateUserTracksDates(self):
-        datesListTemp = self.getUserTracksDates()
-        dateList = []
-        for index in range(len(datesListTemp)):
-            for key in datesListTemp[index]:
-                dateList.append(datesListTemp[index][key].strftime("%Y-%m-%d %H:%M:%S"))
-        self.lst.Clear()
-        self.lst.AppendItems(dateList)
-
-
-    def getUserTracks(self):
-        return sqlAlch.getTracks(MyBrowser.loggedUser)
-
-    def getSelectedTrack(self, trackDate):
-        return sqlAlch.getSelectedTrack(MyBrowser.loggedUser, trackDate)
+            self.lst.setFilter(self.trackFilter.GetValue())
+        except ValueError as error:
+            self.statusBar.SetStatusText(str(error))
+            return
+        self.statusBar.SetStatusText("%d ride(s)" % self.lst.GetItemCount())
+
+    def onFilterCancel(self, event):
+        self.trackFilter.SetValue("")
+        self.onFilter(event)
+
+
+    def getSelectedTrackId(self):
+        return self.lst.getSelectedTrackId()
 
     def getUserPoints(self, event):
-        print("event")
-        positionSelected = self.lst.GetStringSelection()
-        a_object = datetime.strptime(positionSelected, '%Y-%m-%d %H:%M:%S')
-
-        gpxPointsListTemp = self.getSelectedTrack(a_object)
-        gpxPointsList = []
-        for index in range(len(gpxPointsListTemp)):
-            for key in gpxPointsListTemp[index]:
-                gpxPointsList.append(gpxPointsListTemp[index][key])
-        print(len(gpxPointsList[7]))
-        xtemp = gpxPointsList[7]
-        xtemp = xtemp.translate({ord('['): None}).translate({ord(']'): None})
-        splittedList= xtemp.split(",")
-        latPointsList = []
-        lonPointsList = []
-        for i in range(0, len(splittedList)):
-            if i % 2:
-                lonPointsList.append(splittedList[i])
-            else:
-                latPointsList.append(splittedList[i])
-
-        formPointsList = [(latPointsList[i], lonPointsList[i]) for i in range(0, len(latPointsList))]
-        map.updateMap(formPointsList)
-        absPath = os.getcwd()
-        self.browser.LoadURL(pathlib2.Path(absPath + "/" + "maparea.html").as_uri())
-        self.dateLabel2.SetLabel(positionSelected)
-        self.avgSpeedLabel2.SetLabel(str(gpxPointsList[2])[:5])
-        self.distanceLabel2.SetLabel(str(gpxPointsList[3])[:6])
-        self.hrLabel2.SetLabel(str(gpxPointsList[4])[:5])
-        self.rideTimeLabel2.SetLabel(str(gpxPointsList[6]))
-        self.pointsNumberLabel2.SetLabel(str(len(gpxPointsList[7])))
-        elevationTempList = gpxPointsList[9].replace("[","")
-        elevationList = list(elevationTempList.split(","))
-        elevationListSize = []
-        for i in range(0, (len(elevationList))):
-            elevationListSize.append(i)
-
-        hrTempList = gpxPointsList[8].replace("[", "")
-        hrTempList.replace("0.0","")
-        hrList = list(hrTempList.split(","))
-        hrListSize = []
-        for i in range(0, (len(hrList))):
-            hrListSize.append(i)
-
-        self.elevationPanel.draw(elevationListSize,elevationList)
-        self.hrPanel.draw(hrListSize,hrList)
-        trackId = gpxPointsList[0]
+        # Only the newest selection is rendered: submitting under the same
+        # key cancels a pending load and drops the result of a stale one.
+        trackId = self.getSelectedTrackId()
+        if trackId is None:
+            return None
+        width, height = self.browser.GetSize()
+        self.jobs.submit(self.prefetchJob, trackId, width, height, key='prefetch')
+        self.jobs.submit(self.trackViewJob, trackId, key='select', onDone=self.showTrackView)
         return trackId
 
+    def prefetchJob(self, job, trackId, width, height):
+        # the tile cache queues the downloads on its own threads
+        bounds = sqlAlch.getTrackBounds(trackId)
+        if bounds is not None:
+            self.mapServer.cache.prefetch(bounds, width, height)
+
+    def trackViewJob(self, job, trackId):
+        return trackView.loadTrackView(trackId, job.checkCancelled)
+
+    def showTrackView(self, view):
+        if view is None:
+            return
+        summary, script, (distanceList, elevationList, hrList) = view
+        self.runMapScript(script)
+        self.dateLabel2.SetLabel(summary['date'].strftime("%Y-%m-%d %H:%M:%S"))
+        self.avgSpeedLabel2.SetLabel(str(summary['avgSpeed'])[:5])
+        self.distanceLabel2.SetLabel(str(summary['distance'])[:6])
+        self.hrLabel2.SetLabel(str(summary['avgHr'])[:5])
+        self.rideTimeLabel2.SetLabel(str(summary['rideTime']))
+        movingTime = summary['movingTime']
+        self.movingTimeLabel2.SetLabel(time.strftime('%H:%M:%S', time.gmtime(movingTime)) if movingTime is not None else "-")
+        elevationGain = summary['elevationGain']
+        self.elevationGainLabel2.SetLabel("%.0f m" % elevationGain if elevationGain is not None else "-")
+        self.pointsNumberLabel2.SetLabel(str(summary['pointCount']))
+        self.elevationPanel.draw(distanceList, elevationList)
+        self.hrPanel.draw(distanceList, hrList)
+
     def rightClickMenu(self, event):
         self.popupID1 = wx.NewId()
+        self.popupSegmentID = wx.NewId()
+        self.popupEffortsID = wx.NewId()
         self.Bind(wx.EVT_MENU, self.onPopup, id=self.popupID1)
+        self.Bind(wx.EVT_MENU, self.onCreateSegment, id=self.popupSegmentID)
+        self.Bind(wx.EVT_MENU, self.onShowSegments, id=self.popupEffortsID)
         menu = wx.Menu()
         menu.Append(self.popupID1, "Delete")
+        menu.Append(self.popupSegmentID, "Create segment...")
+        menu.Append(self.popupEffortsID, "Segment efforts...")
         self.PopupMenu(menu)
 
     def onPopup(self, event):
-        trkId = self.getUserPoints(event)
-        sqlAlch.deleteSelectedTrack(trkId)
-        self.updateUserTracksDates()
+        trkId = self.getSelectedTrackId()
+        if trkId is None:
+            return
+        self.jobs.cancel('select')
+        # the heat cells and rollups are updated from the payload, so the
+        # delete runs on a worker too
+        self.jobs.submit(self.deleteJob, trkId, onDone=self.onDeleteDone, onError=self.onDeleteError)
+
+    def deleteJob(self, job, trackId):
+        sqlAlch.deleteSelectedTrack(trackId)
+        return trackId
+
+    def onDeleteDone(self, trackId):
+        # the track list follows by itself, through its track listener; the
+        # map keeps a ride selected while the delete ran
+        if self.getSelectedTrackId() in (None, trackId):
+            self.runMapScript("clearTrack();")
+        self.refreshHeatmap()
+
+    def onDeleteError(self, error):
+        wx.MessageBox("Track not deleted!", "Message", wx.OK | wx.ICON_ERROR)
+        log.error('delete failed: %s', error)
+
+    def onCreateSegment(self, event):
+        trackId = self.getSelectedTrackId()
+        if trackId is None:
+            return
+        dialog = wx.TextEntryDialog(self, "Segment name and range in km, e.g. \"Kartuzy climb 12.5-15.2\"",
+                                    "Create segment")
+        text = dialog.GetValue().strip() if dialog.ShowModal() == wx.ID_OK else ""
+        dialog.Destroy()
+        if not text:
+            return
+        try:
+            name, kmRange = text.rsplit(" ", 1)
+            startKm, endKm = (float(value) for value in kmRange.split("-"))
+        except ValueError:
+            wx.MessageBox("Expected a name followed by start-end in km", "Segment", wx.OK | wx.ICON_ERROR)
+            return
+        self.statusBar.SetStatusText("Finding efforts on %s..." % name)
+        self.jobs.submit(self.segmentJob, trackId, name, startKm, endKm,
+                         onDone=self.onSegmentDone, onError=self.onSegmentError)
+
+    def segmentJob(self, job, trackId, name, startKm, endKm):
+        distance = trackView.loadSeries(trackId)[0]
+        startIndex, endIndex = np.searchsorted(distance, (min(startKm, endKm), max(startKm, endKm)))
+        segmentId = sqlAlch.createSegment(MyBrowser.loggedUser, name, trackId, int(startIndex),
+                                          int(min(endIndex, len(distance) - 1)))
+        return name, len(sqlAlch.getSegmentEfforts(segmentId))
+
+    def onSegmentDone(self, result):
+        name, efforts = result
+        self.statusBar.SetStatusText("Segment %s: %d effort(s)" % (name, efforts))
+
+    def onSegmentError(self, error):
+        self.statusBar.SetStatusText("")
+        wx.MessageBox("Segment not created: %s" % error, "Segment", wx.OK | wx.ICON_ERROR)
+
+    def onShowSegments(self, event):
+        self.jobs.submit(self.segmentsJob, MyBrowser.loggedUser, key='segments', onDone=self.chooseSegment,
+                         onError=self.onSegmentsError)
+
+    def segmentsJob(self, job, user):
+        return sqlAlch.getSegments(user)
+
+    def chooseSegment(self, segments):
+        if not segments:
+            wx.MessageBox("No segments yet. Right click a ride and choose Create segment.", "Segments", wx.OK)
+            return
+        choices = ["%s (%.2f km, %d efforts)" % (segment['name'], segment['distance'], segment['effortCount'])
+                   for segment in segments]
+        dialog = wx.SingleChoiceDialog(self, "Segment", "Segment efforts", choices)
+        if dialog.ShowModal() == wx.ID_OK:
+            segment = segments[dialog.GetSelection()]
+            self.jobs.submit(self.effortsJob, segment, key='segments', onDone=self.showEfforts,
+                             onError=self.onSegmentsError)
+        dialog.Destroy()
+
+    def effortsJob(self, job, segment):
+        return segment, sqlAlch.getSegmentEfforts(segment['id'])[:30]
+
+    def showEfforts(self, result):
+        segment, efforts = result
+        lines = []
+        for effort in efforts:
+            elapsed = effort['elapsedTime']
+            lines.append("%s  %s  %s  %s" % (
+                effort['date'].strftime("%Y-%m-%d") if effort['date'] else "-",
+                time.strftime('%H:%M:%S', time.gmtime(elapsed)) if elapsed is not None else "-",
+                "%.1f km/h" % effort['avgSpeed'] if effort['avgSpeed'] is not None else "-",
+                "%.0f bpm" % effort['avgHr'] if effort['avgHr'] else "-"))
+        wx.MessageBox("\n".join(lines) or "No efforts", segment['name'], wx.OK)
+
+    def onSegmentsError(self, error):
+        wx.MessageBox("Segments not loaded: %s" % error, "Segments", wx.OK | wx.ICON_ERROR)
 
 
 def main():
@@ -1,15 +1,47 @@
-import folium
+import json
 import numpy as np
 
-def makeMap():
-    fmap = folium.Map([54.3821, 18.3362], zoom_start=12)
+import instrument
+import trackData
 
-    fmap.save('maparea.html')
+# Largest number of points handed to folium; longer tracks are drawn from a
+# simplified level of detail (see trackSimplify).
+MAX_MAP_POINTS = 5000
 
+# Decimal places kept by the encoded polyline (5 ~ 1.1 m, the finest LOD).
+POLYLINE_PRECISION = 5
 
-def updateMap(points):
-    pointsList = points
-    fmap = folium.Map(pointsList[0], zoom_start=12)
+
+def encodePolyline(points, precision=POLYLINE_PRECISION):
+    # Google encoded polyline format: zig-zag encoded coordinate deltas in
+    # 5-bit chunks, about 4-6 characters per coordinate instead of ~20 in JSON.
+    points = trackData.asPoints(points)
+    scaled = np.round(points * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chunks = []
+    for value in values.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+@instrument.timed('map.script')
+def trackScript(points):
+    # JavaScript handed to WebView.RunScript to swap the track shown on the
+    # already loaded maparea.html.
+    return "showTrack(%s, %d);" % (json.dumps(encodePolyline(points)), POLYLINE_PRECISION)
+
+
+@instrument.timed('map.folium')
+def updateMap(points, path='track.html'):
+    # Standalone folium page for a single track; the GUI keeps maparea.html
+    # loaded and uses trackScript() instead.
+    import folium
+    pointsList = trackData.asPoints(points)
+    fmap = folium.Map(pointsList[0].tolist(), zoom_start=12)
     # folium.PolyLine(pointsList[0], color="red", weight=2.5, opacity=1).add_to(fmap)
-    folium.PolyLine(np.array(pointsList, dtype=float), color="red").add_to(fmap)
-    fmap.save('maparea.html')
\ No newline at end of file
+    folium.PolyLine(pointsList, color="red").add_to(fmap)
+    fmap.save(path)
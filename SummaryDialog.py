@@ -0,0 +1,64 @@
+import wx
+import sqlAlch
+
+PERIOD_NAMES = (("Week", 'week'), ("Month", 'month'), ("Year", 'year'), ("Day", 'day'))
+# hrZone0 is time below zone 1
+ZONE_COLUMNS = sqlAlch.HR_ZONE_COLUMNS[1:]
+
+
+def formatDuration(seconds):
+    seconds = int(seconds or 0)
+    return "%d:%02d" % (seconds // 3600, seconds % 3600 // 60)
+
+
+class SummaryDialog(wx.Dialog):
+    # Reads only the rollups table, so it opens as fast with 10 rides as
+    # with 10,000.
+
+    def __init__(self, parent, user):
+        wx.Dialog.__init__(self, parent, id=wx.ID_ANY, title="Summary", size=wx.Size(820, 480),
+                           style=wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        self.user = user
+
+        bSizer1 = wx.BoxSizer(wx.VERTICAL)
+
+        self.totals = wx.StaticText(self, wx.ID_ANY, "")
+        bSizer1.Add(self.totals, 0, wx.ALL | wx.EXPAND, 5)
+
+        self.period = wx.Choice(self, wx.ID_ANY, choices=[name for name, period in PERIOD_NAMES])
+        self.period.SetSelection(0)
+        bSizer1.Add(self.period, 0, wx.ALL, 5)
+
+        self.list = wx.ListCtrl(self, wx.ID_ANY, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for column, (title, width) in enumerate([("From", 100), ("Rides", 50), ("Distance [km]", 100),
+                                                 ("Moving time", 90), ("Elevation [m]", 90)]
+                                                + [("Z%d" % (zone + 1), 60) for zone in range(len(ZONE_COLUMNS))]):
+            self.list.InsertColumn(column, title, width=width)
+        bSizer1.Add(self.list, 1, wx.ALL | wx.EXPAND, 5)
+
+        self.SetSizer(bSizer1)
+        self.Layout()
+        self.Centre(wx.BOTH)
+
+        self.period.Bind(wx.EVT_CHOICE, self.onPeriod)
+        self.showTotals()
+        self.showPeriod()
+
+    def showTotals(self):
+        totals = sqlAlch.getRollupTotals(self.user)
+        self.totals.SetLabel("All time: %d rides, %.1f km, %s moving, %.0f m climbed" % (
+            totals['rideCount'], totals['distance'], formatDuration(totals['movingTime']), totals['elevationGain']))
+
+    def onPeriod(self, event):
+        self.showPeriod()
+
+    def showPeriod(self):
+        period = PERIOD_NAMES[self.period.GetSelection()][1]
+        self.list.DeleteAllItems()
+        for row in sqlAlch.getRollups(self.user, period):
+            values = [row['start'].strftime("%Y-%m-%d"), str(row['rideCount']), "%.1f" % row['distance'],
+                      formatDuration(row['movingTime']), "%.0f" % row['elevationGain']]
+            values += [formatDuration(row[name]) for name in ZONE_COLUMNS]
+            index = self.list.InsertItem(self.list.GetItemCount(), values[0])
+            for column, value in enumerate(values[1:], 1):
+                self.list.SetItem(index, column, value)
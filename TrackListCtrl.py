@@ -0,0 +1,94 @@
+import threading
+
+import wx
+import sqlAlch
+import trackList
+
+
+class TrackListCtrl(wx.ListCtrl):
+    # Virtual report list of the user's tracks: wx asks for the text of the
+    # visible rows only and trackList.TrackListModel reads them a page at a
+    # time. Clicking a column header sorts by it (again for descending).
+    # Track inserts and deletes arrive through sqlAlch track listeners,
+    # possibly on a worker thread, and are applied in one batch on the UI
+    # thread.
+
+    def __init__(self, parent, user, size=(450, -1)):
+        wx.ListCtrl.__init__(self, parent, wx.ID_ANY, size=size,
+                             style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_SINGLE_SEL)
+        for column, (title, key, width) in enumerate(trackList.COLUMNS):
+            self.InsertColumn(column, title, width=width)
+        self.model = trackList.TrackListModel(user)
+        self.pending = []
+        self.pendingLock = threading.Lock()
+        self.SetItemCount(len(self.model))
+        self.showSortIndicator()
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.onColumnClick)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
+        sqlAlch.addTrackListener(self.onTrackChanged)
+
+    def OnGetItemText(self, item, column):
+        return self.model.cell(item, column)
+
+    def getSelectedTrackId(self):
+        return self.model.trackId(self.GetFirstSelected())
+
+    def selectTrack(self, trackId):
+        index = self.model.indexOf(trackId) if trackId is not None else None
+        selected = self.GetFirstSelected()
+        if index is None:
+            if selected != -1:
+                self.Select(selected, False)
+            return
+        if index != selected:
+            # keeps the selection on the same ride without reloading it
+            self.SetEvtHandlerEnabled(False)
+            try:
+                self.Select(index)
+            finally:
+                self.SetEvtHandlerEnabled(True)
+        self.EnsureVisible(index)
+
+    def refreshRows(self, trackId):
+        self.SetItemCount(len(self.model))
+        self.selectTrack(trackId)
+        self.Refresh()
+
+    def showSortIndicator(self):
+        column = [key for title, key, width in trackList.COLUMNS].index(self.model.sortKey)
+        if hasattr(self, 'ShowSortIndicator'):
+            self.ShowSortIndicator(column, not self.model.descending)
+
+    def onColumnClick(self, event):
+        key = trackList.COLUMNS[event.GetColumn()][1]
+        descending = key == self.model.sortKey and not self.model.descending
+        trackId = self.getSelectedTrackId()
+        self.model.setSort(key, descending)
+        self.showSortIndicator()
+        self.refreshRows(trackId)
+
+    def setFilter(self, text):
+        trackId = self.getSelectedTrackId()
+        self.model.setFilter(text)
+        self.refreshRows(trackId)
+
+    def onTrackChanged(self, event, trackId):
+        with self.pendingLock:
+            self.pending.append((event, trackId))
+            if len(self.pending) > 1:
+                return
+        wx.CallAfter(self.applyPending)
+
+    def applyPending(self):
+        with self.pendingLock:
+            changes, self.pending = self.pending, []
+        if not self:
+            return
+        trackId = self.getSelectedTrackId()
+        self.model.applyChanges(changes)
+        self.refreshRows(trackId)
+
+    def onDestroy(self, event):
+        if event.GetEventObject() is self:
+            sqlAlch.removeTrackListener(self.onTrackChanged)
+        event.Skip()
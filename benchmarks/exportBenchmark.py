@@ -0,0 +1,129 @@
+"""Benchmark for trackExport: streaming bulk export of a user's tracks.
+
+Fills a fresh database with --tracks synthetic rides of --points points
+(timestamps, heart rate, elevation and speed included), then exports them
+once per format in a child process each, so every figure comes with the
+peak RSS of a process that did nothing else. That RSS includes the
+database pages SQLite maps (see sqlAlch.SQLITE_PRAGMAS), so it grows with
+the file even though the export holds a fixed number of tracks. The disk
+baseline writes as many bytes as the largest export through the same 1 MB
+buffered file, to show how close the encoders come to disk speed. Writes a
+JSON report.
+
+    python benchmarks/exportBenchmark.py --tracks 10000 --points 1000 --output export.json
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+import numpy as np  # noqa: E402
+
+import gpxGenerator  # noqa: E402
+import sqlAlch  # noqa: E402
+import trackCodec  # noqa: E402
+import trackExport  # noqa: E402
+
+USER = 'benchmark'
+OUTPUTS = ('tracks.gpx', 'tracks.gpx.gz', 'tracks.zip', 'tracks.geojson', 'tracks.ndjson.gz', 'tracks.parquet',
+           'tracks.arrow')
+
+
+def syntheticTrack(index, args):
+    rows = np.array(list(gpxGenerator.generatePoints(args.points, args.seed + index)))
+    start = gpxGenerator.START + datetime.timedelta(hours=index)
+    times = rows[:, 3] + start.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return dict(user=USER, avgSpeed=float(rows[:, 5].mean()), distance=0.0, avgHr=float(rows[:, 4].mean()),
+                rideTime='00:00:00', date=start, points=trackCodec.encodePoints(rows[:, :2]),
+                hr=trackCodec.encodeSeries(rows[:, 4]), elevation=trackCodec.encodeSeries(rows[:, 2]),
+                time=trackCodec.encodeTimes(times), speed=trackCodec.encodeSeries(rows[:, 5]))
+
+
+def fillDatabase(args):
+    sqlAlch.createDb()
+    sqlAlch.insertUser(USER, USER)
+    start = time.perf_counter()
+    sqlAlch.insertGpxTracks((syntheticTrack(index, args) for index in range(args.tracks)), batchSize=200)
+    return time.perf_counter() - start
+
+
+def exportOne(args):
+    # Child process: one export, reported as JSON on stdout.
+    sqlAlch.configure(args.db)
+    start = time.perf_counter()
+    tracks = trackExport.exportTracks(USER, args.run_one, workers=args.workers)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(args.run_one)
+    print(json.dumps(dict(tracks=tracks, seconds=seconds, bytes=size, megabytesPerSecond=size / seconds / 1e6,
+                          tracksPerSecond=tracks / seconds,
+                          maxRssMegabytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)))
+
+
+def diskBaseline(path, size):
+    block = os.urandom(trackExport.BUFFER_BYTES)
+    start = time.perf_counter()
+    with open(path, 'wb', buffering=trackExport.BUFFER_BYTES) as output:
+        for offset in range(0, size, len(block)):
+            output.write(block[:size - offset])
+        output.flush()
+        os.fsync(output.fileno())
+    seconds = time.perf_counter() - start
+    os.remove(path)
+    return dict(bytes=size, seconds=seconds, megabytesPerSecond=size / seconds / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='encoding processes (default: one per core)')
+    parser.add_argument('--formats', nargs='+', default=OUTPUTS, help='output names, the suffix picks the format')
+    parser.add_argument('--db', help='reuse or keep this database file')
+    parser.add_argument('--output')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        exportOne(args)
+        return 0
+
+    workDir = tempfile.mkdtemp(prefix='gpxexport-')
+    try:
+        dbPath = args.db or os.path.join(workDir, 'export.db')
+        fresh = not os.path.exists(dbPath)
+        sqlAlch.configure(dbPath)
+        fillSeconds = fillDatabase(args) if fresh else None
+        sqlAlch.getEngine().dispose()
+        exports = {}
+        for name in args.formats:
+            command = [sys.executable, os.path.abspath(__file__), '--db', dbPath,
+                       '--run-one', os.path.join(workDir, name)]
+            if args.workers:
+                command += ['--workers', str(args.workers)]
+            exports[name] = json.loads(subprocess.check_output(command).decode('utf-8').splitlines()[-1])
+            os.remove(os.path.join(workDir, name))
+        largest = max(result['bytes'] for result in exports.values())
+        report = dict(tracks=args.tracks, points=args.points, insertSeconds=fillSeconds,
+                      databaseBytes=os.path.getsize(dbPath), exports=exports,
+                      disk=diskBaseline(os.path.join(workDir, 'baseline.bin'), largest), options=vars(args))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
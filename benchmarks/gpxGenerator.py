@@ -0,0 +1,133 @@
+"""Deterministic synthetic GPX files for the benchmarks.
+
+Writes a ride of ``points`` one-second samples as a random walk seeded with
+``seed``, so the same arguments always give byte-identical files. Every
+point carries what the app reads: ``<ele>`` in centimetres, heart rate in
+``<desc>`` and a speed extension. The ``amazfit`` style copies the Amazfit
+app export (see gpx/amazfit1.gpx), including runs of points that share one
+timestamp; ``garmin`` uses the Garmin TrackPointExtension layout with an
+``hr`` element next to ``speed``.
+
+    python benchmarks/gpxGenerator.py ride.gpx --points 100000 --seed 1
+"""
+import argparse
+import datetime
+import math
+import random
+import sys
+
+STYLES = ('amazfit', 'garmin')
+START = datetime.datetime(2020, 8, 1, 6, 41, 59)
+START_POSITION = (54.388577, 18.383194)
+METERS_PER_DEGREE = 6378137.0 * math.pi / 180
+
+HEADERS = {
+    'amazfit': ('<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\' ?>\n'
+                '<gpx xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+                'xmlns="http://www.topografix.com/GPX/1/1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                'xmlns:ns3="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
+                'xmlns:ns2="http://www.garmin.com/xmlschemas/GpxExtensions/v3" '
+                'xmlns:ns1="http://www.cluetrust.com/XML/GPXDATA/1/0" creator="Amazfit App" version="4.7.1-play" >\n'
+                '\t<trk >\n\t\t<trkseg >\n'),
+    'garmin': ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<gpx creator="Garmin Connect" version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
+               'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">\n'
+               '  <trk>\n    <name>Synthetic ride</name>\n    <type>cycling</type>\n    <trkseg>\n'),
+}
+FOOTERS = {
+    'amazfit': '\t\t</trkseg>\n\t</trk>\n</gpx>\n',
+    'garmin': '    </trkseg>\n  </trk>\n</gpx>\n',
+}
+POINT_FORMATS = {
+    'amazfit': ('\t\t\t<trkpt lat="%.6f" lon="%.6f" >\n'
+                '\t\t\t\t<ele >%.1f</ele>\n'
+                '\t\t\t\t<time >%s</time>\n'
+                '\t\t\t\t<desc ><![CDATA[%.1f]]></desc>\n'
+                '\t\t\t\t\t<extensions >\n'
+                '\t\t\t\t\t\t<ns3:TrackPointExtension >\n'
+                '\t\t\t\t\t\t\t<ns3:speed >%.1f</ns3:speed>\n'
+                '\t\t\t\t\t\t</ns3:TrackPointExtension>\n'
+                '\t\t\t\t\t</extensions>\n'
+                '\t\t\t</trkpt>\n'),
+    'garmin': ('      <trkpt lat="%.7f" lon="%.7f">\n'
+               '        <ele>%.1f</ele>\n'
+               '        <time>%s</time>\n'
+               '        <desc>%.1f</desc>\n'
+               '        <extensions>\n'
+               '          <gpxtpx:TrackPointExtension>\n'
+               '            <gpxtpx:speed>%.2f</gpxtpx:speed>\n'
+               '            <gpxtpx:hr>%d</gpxtpx:hr>\n'
+               '          </gpxtpx:TrackPointExtension>\n'
+               '        </extensions>\n'
+               '      </trkpt>\n'),
+}
+
+
+def generatePoints(points, seed=0, origin=START_POSITION):
+    # Yields (lat, lon, ele [m], seconds since start, hr, speed [m/s]).
+    rng = random.Random(seed)
+    lat, lon = origin
+    heading = rng.uniform(0, 2 * math.pi)
+    speed = 0.0
+    hr = 95.0
+    seconds = 0
+    stopped = 0
+    for index in range(points):
+        if stopped:
+            stopped -= 1
+            speed = 0.0
+        elif rng.random() < 0.0005:
+            # traffic lights and the like, so moving time != elapsed time
+            stopped = rng.randint(10, 120)
+            speed = 0.0
+        else:
+            speed = min(max(speed + rng.gauss(0.05, 0.4), 2.0), 14.0)
+        heading += rng.gauss(0, 0.05)
+        lat += speed * math.cos(heading) / METERS_PER_DEGREE
+        lon += speed * math.sin(heading) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        ele = 120 + 80 * math.sin(index / 900.0) + 15 * math.sin(index / 97.0) + rng.gauss(0, 0.3)
+        target = 110 + 5 * speed + 0.3 * max(ele - 120, 0)
+        hr = min(max(hr + 0.05 * (target - hr) + rng.gauss(0, 0.8), 60.0), 195.0)
+        yield lat, lon, ele, seconds, hr, speed
+        seconds += 1
+
+
+def writeGpx(output, points, seed=0, style='amazfit', start=START):
+    if style not in STYLES:
+        raise ValueError("unknown style %r" % style)
+    rng = random.Random(seed + 1)
+    pointFormat = POINT_FORMATS[style]
+    output.write(HEADERS[style])
+    stamp = None
+    for lat, lon, ele, seconds, hr, speed in generatePoints(points, seed):
+        # Amazfit batches samples: several points often share one timestamp.
+        if style == 'garmin' or stamp is None or rng.random() < 0.7:
+            stamp = (start + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if style == 'garmin':
+            output.write(pointFormat % (lat, lon, ele * 100, stamp, round(hr), speed, round(hr)))
+        else:
+            output.write(pointFormat % (lat, lon, ele * 100, stamp, round(hr), speed))
+    output.write(FOOTERS[style])
+
+
+def generateFile(path, points, seed=0, style='amazfit', start=START):
+    with open(path, 'w', encoding='utf-8', newline='\n') as output:
+        writeGpx(output, points, seed, style, start)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--style', choices=STYLES, default='amazfit')
+    args = parser.parse_args()
+    generateFile(args.path, args.points, args.seed, args.style)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Benchmark for the all-rides heatmap (heatTiles table and map tiles).
+
+Fills a fresh database in stages up to each of --tracks synthetic rides of
+--points points, started at random places in an --area-km square. After
+every stage it times binning one more ride and adding and removing its
+cells, then draws a --width x --height screen of map tiles around the
+start position at each of --zooms. The screen times should stay flat as
+the ride count grows. Writes a JSON report.
+
+    python benchmarks/heatmapBenchmark.py --tracks 500,2000,8000 --points 1000 --output heatmap.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+
+import gpxGenerator  # noqa: E402
+import heatmap  # noqa: E402
+import spatialBenchmark  # noqa: E402
+import sqlAlch  # noqa: E402
+
+USER = spatialBenchmark.USER
+
+
+def fillTo(count, args, rng):
+    start = time.perf_counter()
+    first = sqlAlch.countTracks(USER)
+    tracks = (spatialBenchmark.syntheticTrack(index, args, rng) for index in range(first, count))
+    sqlAlch.insertGpxTracks(tracks, batchSize=200)
+    return time.perf_counter() - start
+
+
+def updateCost(args, rng):
+    # One more ride binned, added and removed again; the store is unchanged.
+    points = np.array(list(gpxGenerator.generatePoints(args.points, args.seed + 10 ** 6)))[:, :2]
+    start = time.perf_counter()
+    cells = heatmap.binTrack(points)
+    binned = time.perf_counter()
+    sqlAlch.addHeatCells(USER, cells)
+    added = time.perf_counter()
+    sqlAlch.removeHeatCells(USER, cells)
+    removed = time.perf_counter()
+    return dict(cells=sum(len(keys) for keys in cells.values()), binSeconds=binned - start,
+                addSeconds=added - binned, removeSeconds=removed - added)
+
+
+def screenTiles(zoom, args):
+    x, y = heatmap.mercatorPixels(np.array([gpxGenerator.START_POSITION]), zoom)[0]
+    first = (int(x - args.width / 2) >> heatmap.TILE_BITS, int(y - args.height / 2) >> heatmap.TILE_BITS)
+    last = (int(x + args.width / 2) >> heatmap.TILE_BITS, int(y + args.height / 2) >> heatmap.TILE_BITS)
+    return [(tileX, tileY) for tileY in range(first[1], last[1] + 1) for tileX in range(first[0], last[0] + 1)]
+
+
+def screenCost(args):
+    results = {}
+    tiles = heatmap.HeatmapTiles(USER)
+    for zoom in args.zooms:
+        times = []
+        drawn = 0
+        for repeat in range(args.repeat):
+            start = time.perf_counter()
+            for tileX, tileY in screenTiles(zoom, args):
+                png = tiles.tile(tiles.urlTemplate().format(z=zoom, x=tileX, y=tileY))
+                drawn += png is not heatmap.EMPTY_TILE
+            times.append(time.perf_counter() - start)
+        results[str(zoom)] = dict(tiles=len(screenTiles(zoom, args)), drawnTiles=drawn // args.repeat,
+                                  bestSeconds=min(times))
+    tiles.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', default='200,1000,4000', help='comma separated ride counts')
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--area-km', type=float, default=60.0)
+    parser.add_argument('--zooms', default='6,9,12,14')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    args.zooms = [int(zoom) for zoom in args.zooms.split(',')]
+    counts = sorted(int(count) for count in args.tracks.split(','))
+
+    workDir = tempfile.mkdtemp(prefix='gpxheatmap-')
+    stages = []
+    try:
+        dbPath = os.path.join(workDir, 'heatmap.db')
+        sqlAlch.configure(dbPath)
+        sqlAlch.createDb()
+        sqlAlch.insertUser(USER, USER)
+        rng = random.Random(args.seed)
+        for count in counts:
+            insertSeconds = fillTo(count, args, rng)
+            with sqlAlch.transaction() as conn:
+                tiles, cells = conn.execute(sqlAlch.select(sqlAlch.func.count(), sqlAlch.func.sum(
+                    sqlAlch.heatTilesTable.c.cellCount))).first()
+            stages.append(dict(tracks=count, insertSeconds=insertSeconds, heatTiles=tiles, heatCells=cells,
+                               databaseBytes=os.path.getsize(dbPath), update=updateCost(args, rng),
+                               screens=screenCost(args)))
+        sqlAlch.getEngine().dispose()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    report = dict(stages=stages, options=vars(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
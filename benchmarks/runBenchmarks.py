@@ -0,0 +1,292 @@
+"""Headless benchmark suite for the parse, store, fetch and map paths.
+
+For every requested size a synthetic ride is written with gpxGenerator and
+pushed through the same code the app runs: GpxRecord.parseFile (streaming
+and, when gpxpy is installed, the gpxpy fallback), sqlAlch.insertGpxTrack,
+trackView.loadTrackView (what MainWindow.getUserPoints runs on the job
+runner, cold and warm cache), the map script and MapMaker.updateMap, the
+Douglas-Peucker levels and the NumPy analytics against a pure Python loop.
+Nothing imports wx, so it runs without a display.
+
+With --stages the instrument spans (parse, encode, simplify, analytics,
+db.*, decode, map.*) and counters are added per size.
+
+Timings are the best of --repeat runs, in seconds. The JSON report carries
+the git commit so runs can be diffed; --compare exits with status 1 when a
+timing got slower than --tolerance times the baseline.
+
+    python benchmarks/runBenchmarks.py --sizes 1000,10000,100000 --output bench.json
+    python benchmarks/runBenchmarks.py --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+
+import gpxGenerator  # noqa: E402
+import gpxParse  # noqa: E402
+import instrument  # noqa: E402
+import MapMaker  # noqa: E402
+import renderCache  # noqa: E402
+import sqlAlch  # noqa: E402
+import trackAnalytics  # noqa: E402
+import trackCodec  # noqa: E402
+import trackSimplify  # noqa: E402
+import trackView  # noqa: E402
+
+USER = 'benchmark'
+DEFAULT_SIZES = '1000,10000,100000'
+
+
+def bestOf(repeat, function, *args):
+    # (best wall time, result of the last call)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peakMemory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def parseRecord(path, streaming=True):
+    record = gpxParse.GpxRecord(USER)
+    record.parseFile(path, streaming)
+    if record.error is not None:
+        raise RuntimeError("parsing %s failed: %s" % (path, record.error))
+    return record
+
+
+def insertRecord(record):
+    return sqlAlch.insertGpxTrack(USER, record.avgSpeed, record.distance, record.avgHr, record.rideDate,
+                                  record.rideTime, record.serializedPointsArray, record.serializedHrArray,
+                                  record.serializedElevationArray, levels=record.serializedLevels,
+                                  time=record.serializedTimeArray, speed=record.serializedSpeedArray,
+                                  analytics=dict(record.analytics, speed=None), fingerprint=record.fingerprint)
+
+
+def timeInsert(repeat, record):
+    # The same file twice is skipped as a duplicate, so every timed insert
+    # but the last is deleted again before the next one.
+    best = None
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        trackId = insertRecord(record)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if attempt < repeat - 1:
+            sqlAlch.deleteSelectedTrack(trackId)
+    return best, trackId
+
+
+def coldTrackView(trackId):
+    return trackView.loadTrackView(trackId, cache=renderCache.RenderCache())
+
+
+def pythonAnalyse(lat, lon, ele, times):
+    # What the analytics cost as a plain loop: distance, smoothed climb,
+    # moving time and max speed. Kept only as the benchmark's baseline.
+    distance = 0.0
+    covered = 0.0
+    movingTime = 0.0
+    maxSpeed = 0.0
+    lastStep = 0
+    for index in range(1, len(lat)):
+        distance += gpxParse.pointDistance(lat[index - 1], lon[index - 1], lat[index], lon[index])
+        covered += gpxParse.pointDistance(lat[index - 1], lon[index - 1], lat[index], lon[index])
+        dt = times[index] - times[lastStep]
+        if dt > 0:
+            speed = covered / dt
+            if speed >= trackAnalytics.MOVING_SPEED and dt <= trackAnalytics.PAUSE_GAP:
+                movingTime += dt
+            maxSpeed = max(maxSpeed, speed)
+            covered = 0.0
+            lastStep = index
+    window = trackAnalytics.ELEVATION_SMOOTHING
+    smoothed = []
+    total = 0.0
+    for index, value in enumerate(ele):
+        total += value
+        if index >= window:
+            total -= ele[index - window]
+        smoothed.append(total / min(index + 1, window))
+    gain = loss = 0.0
+    for index in range(1, len(smoothed)):
+        climb = smoothed[index] - smoothed[index - 1]
+        if climb > 0:
+            gain += climb
+        else:
+            loss -= climb
+    return dict(distance=distance, elevationGain=gain, elevationLoss=loss, movingTime=movingTime, maxSpeed=maxSpeed)
+
+
+def fileSize(path):
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+
+def benchmarkSize(points, args, workDir):
+    result = dict(points=points, timings={}, sizes={}, counts={})
+    timings, sizes, counts = result['timings'], result['sizes'], result['counts']
+    path = os.path.join(workDir, 'ride-%d.gpx' % points)
+    timings['generate'], _ = bestOf(1, gpxGenerator.generateFile, path, points, args.seed, args.style)
+    sizes['gpxFile'] = fileSize(path)
+
+    timings['parseStreaming'], record = bestOf(args.repeat, parseRecord, path)
+    sizes['parsePeakMemory'] = peakMemory(parseRecord, path)
+    if gpxParse.gpxpy is not None and points <= args.gpxpy_limit:
+        timings['parseGpxpy'], _ = bestOf(args.repeat, parseRecord, path, False)
+
+    points2d = record.track.points()
+    sizes['storedPayload'] = sum(len(blob) for blob in (record.serializedPointsArray, record.serializedHrArray,
+                                                        record.serializedElevationArray,
+                                                        record.serializedTimeArray, record.serializedSpeedArray))
+    sizes['storedLevels'] = sum(len(blob) for blob in record.serializedLevels.values())
+
+    sqlAlch.configure(os.path.join(workDir, 'bench-%d.db' % points))
+    sqlAlch.createDb()
+    sqlAlch.insertUser(USER, USER)
+    timings['insertGpxTrack'], trackId = timeInsert(args.repeat, record)
+
+    timings['trackViewCold'], view = bestOf(args.repeat, coldTrackView, trackId)
+    cache = renderCache.RenderCache()
+    trackView.loadTrackView(trackId, cache=cache)
+    timings['trackViewWarm'], _ = bestOf(args.repeat, trackView.loadTrackView, trackId, None, cache)
+    timings['fetchDecode'], _ = bestOf(args.repeat, trackView.loadSeries, trackId)
+    timings['mapScript'], script = bestOf(args.repeat, trackView.loadMapScript, trackId)
+    sizes['mapScript'] = len(script)
+    counts['mapPoints'] = trackCodec.count(sqlAlch.getMapPoints(trackId, MapMaker.MAX_MAP_POINTS))
+    timings['mapScriptFull'], fullScript = bestOf(args.repeat, MapMaker.trackScript, points2d)
+    sizes['mapScriptFull'] = len(fullScript)
+
+    try:
+        import folium  # noqa: F401
+    except ImportError:
+        folium = None
+    if folium is not None:
+        mapPoints = trackCodec.decode(sqlAlch.getMapPoints(trackId, MapMaker.MAX_MAP_POINTS))
+        mapPath = os.path.join(workDir, 'map-%d.html' % points)
+        timings['updateMap'], _ = bestOf(args.repeat, MapMaker.updateMap, mapPoints, mapPath)
+        sizes['updateMap'] = fileSize(mapPath)
+        if points <= args.folium_full_limit:
+            timings['updateMapFull'], _ = bestOf(args.repeat, MapMaker.updateMap, points2d, mapPath)
+            sizes['updateMapFull'] = fileSize(mapPath)
+
+    timings['buildLevels'], levels = bestOf(args.repeat, trackSimplify.buildLevels, points2d)
+    for tolerance, blob in sorted(levels.items()):
+        counts['level%gm' % tolerance] = trackCodec.count(blob)
+
+    lat, lon = points2d[:, 0], points2d[:, 1]
+    ele = record.track.column('ele')
+    times = trackCodec.decode(record.serializedTimeArray)
+    timings['analyseNumpy'], analytics = bestOf(args.repeat, trackAnalytics.analyse, lat, lon, ele, times,
+                                                record.track.column('hr'))
+    if points <= args.python_limit:
+        columns = (lat.tolist(), lon.tolist(), ele.tolist(), times.tolist())
+        timings['analysePython'], reference = bestOf(1, pythonAnalyse, *columns)
+        result['analyticsDistanceDelta'] = abs(reference['distance'] - analytics['distance'])
+    sqlAlch.getEngine().dispose()
+    if instrument.enabled:
+        result['stages'] = instrument.snapshot()
+        instrument.reset()
+    return result
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def buildReport(args):
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    workDir = args.work_dir or tempfile.mkdtemp(prefix='gpxbench-')
+    os.makedirs(workDir, exist_ok=True)
+    try:
+        results = [benchmarkSize(points, args, workDir) for points in sizes]
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(workDir, ignore_errors=True)
+    import sqlalchemy
+    return dict(commit=gitCommit(), python=sys.version.split()[0], platform=platform.platform(),
+                numpy=np.__version__, sqlalchemy=sqlalchemy.__version__,
+                gpxpy=getattr(gpxParse.gpxpy, '__version__', None) if gpxParse.gpxpy else None,
+                style=args.style, seed=args.seed, repeat=args.repeat, results=results)
+
+
+def compareReports(report, baseline, tolerance):
+    # (points, name, baseline, current, ratio) for timings over tolerance
+    previous = dict((entry['points'], entry['timings']) for entry in baseline.get('results', []))
+    regressions = []
+    for entry in report['results']:
+        for name, seconds in entry['timings'].items():
+            before = previous.get(entry['points'], {}).get(name)
+            if not before or name == 'generate':
+                continue
+            ratio = seconds / before
+            if ratio > tolerance:
+                regressions.append(dict(points=entry['points'], name=name, baseline=before,
+                                        current=seconds, ratio=round(ratio, 2)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated point counts, up to 1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--style', choices=gpxGenerator.STYLES, default='amazfit')
+    parser.add_argument('--gpxpy-limit', type=int, default=100000, help='skip the gpxpy parser above this size')
+    parser.add_argument('--python-limit', type=int, default=100000,
+                        help='skip the pure Python analytics above this size')
+    parser.add_argument('--folium-full-limit', type=int, default=100000,
+                        help='skip updateMap on the full track above this size')
+    parser.add_argument('--stages', action='store_true',
+                        help='add the instrument spans and counters of every size to the report')
+    parser.add_argument('--work-dir', help='keep generated files and databases here')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='baseline JSON report')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+
+    if args.stages:
+        instrument.enable()
+    report = buildReport(args)
+    status = 0
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        report['baselineCommit'] = baseline.get('commit')
+        report['regressions'] = compareReports(report, baseline, args.tolerance)
+        status = 1 if report['regressions'] else 0
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
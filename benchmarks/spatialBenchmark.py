@@ -0,0 +1,155 @@
+"""Benchmark for the spatial index (trackBounds R*Tree and trackCells grid).
+
+Fills a fresh database with --tracks synthetic rides of --points points
+each, started at random places in a --area-km square, then times
+sqlAlch.findTracksInBox and sqlAlch.findTracksNear on random queries. Half
+of the queries are centred on a point of a stored track so they have hits.
+The first --verify queries of each kind are checked against a brute force
+scan of every stored track. Writes a JSON report.
+
+    python benchmarks/spatialBenchmark.py --tracks 20000 --points 1000 --output spatial.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+
+import gpxGenerator  # noqa: E402
+import spatialIndex  # noqa: E402
+import sqlAlch  # noqa: E402
+import trackCodec  # noqa: E402
+
+USER = 'benchmark'
+
+
+def syntheticTrack(index, args, rng):
+    halfSide = args.area_km * 500.0
+    lat0, lon0 = gpxGenerator.START_POSITION
+    origin = (lat0 + math.degrees(rng.uniform(-halfSide, halfSide) / spatialIndex.EARTH_RADIUS),
+              lon0 + math.degrees(rng.uniform(-halfSide, halfSide) / spatialIndex.EARTH_RADIUS)
+              / math.cos(math.radians(lat0)))
+    rows = np.array(list(gpxGenerator.generatePoints(args.points, args.seed + index, origin)))
+    return dict(user=USER, avgSpeed=0.0, distance=0.0, avgHr=float(rows[:, 4].mean()), rideTime='00:00:00',
+                date=None, points=trackCodec.encodePoints(rows[:, :2]), hr=trackCodec.encodeSeries(rows[:, 4]),
+                elevation=trackCodec.encodeSeries(rows[:, 2]))
+
+
+def fillDatabase(args):
+    rng = random.Random(args.seed)
+    sqlAlch.createDb()
+    sqlAlch.insertUser(USER, USER)
+    start = time.perf_counter()
+    tracks = (syntheticTrack(index, args, rng) for index in range(args.tracks))
+    sqlAlch.insertGpxTracks(tracks, batchSize=200)
+    return time.perf_counter() - start
+
+
+def loadAllPoints():
+    query = sqlAlch.select(sqlAlch.trackPayloadsTable.c.trackId, sqlAlch.trackPayloadsTable.c.points)
+    with sqlAlch.transaction() as conn:
+        return dict((row.trackId, np.array(trackCodec.decode(row.points))) for row in conn.execute(query))
+
+
+def indexCost(allPoints):
+    start = time.perf_counter()
+    cells = 0
+    for points in allPoints.values():
+        spatialIndex.trackBounds(points)
+        cells += len(spatialIndex.trackCells(points))
+    return time.perf_counter() - start, cells
+
+
+def randomCentre(rng, allPoints, trackIds, args):
+    if rng.random() < 0.5:
+        points = allPoints[rng.choice(trackIds)]
+        return tuple(points[rng.randrange(len(points))])
+    lat0, lon0 = gpxGenerator.START_POSITION
+    span = math.degrees(args.area_km * 500.0 / spatialIndex.EARTH_RADIUS)
+    return lat0 + rng.uniform(-span, span), lon0 + rng.uniform(-span, span) / math.cos(math.radians(lat0))
+
+
+def summarise(times, hits, candidates):
+    times = sorted(times)
+    return dict(queries=len(times), p50Seconds=times[len(times) // 2],
+                p95Seconds=times[min(int(len(times) * 0.95), len(times) - 1)], maxSeconds=times[-1],
+                meanHits=sum(hits) / float(len(hits)), meanCandidates=sum(candidates) / float(len(candidates)))
+
+
+def runQueries(kind, args, allPoints, rng):
+    trackIds = sorted(allPoints)
+    times, hits, candidates = [], [], []
+    mismatches = 0
+    for index in range(args.queries):
+        lat, lon = randomCentre(rng, allPoints, trackIds, args)
+        if kind == 'near':
+            query = lambda exact: sqlAlch.findTracksNear(USER, lat, lon, args.radius, exact)
+            matches = lambda points: spatialIndex.distanceToTrack(points, lat, lon) <= args.radius
+        else:
+            box = spatialIndex.radiusBox(lat, lon, args.box_km * 500.0)
+            query = lambda exact: sqlAlch.findTracksInBox(USER, *box, exact=exact)
+            matches = lambda points: spatialIndex.intersectsBox(points, *box)
+        start = time.perf_counter()
+        found = query(True)
+        times.append(time.perf_counter() - start)
+        hits.append(len(found))
+        candidates.append(len(query(False)))
+        if index < args.verify:
+            expected = set(trackId for trackId, points in allPoints.items() if matches(points))
+            mismatches += expected != set(track['id'] for track in found)
+    result = summarise(times, hits, candidates)
+    result['verified'] = min(args.verify, args.queries)
+    result['mismatches'] = mismatches
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--area-km', type=float, default=100.0)
+    parser.add_argument('--box-km', type=float, default=2.0, help='side of the box queries')
+    parser.add_argument('--radius', type=float, default=100.0, help='metres, for the near queries')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--verify', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='reuse or keep this database file')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='gpxspatial-')
+    try:
+        dbPath = args.db or os.path.join(workDir, 'spatial.db')
+        fresh = not os.path.exists(dbPath)
+        sqlAlch.configure(dbPath)
+        fillSeconds = fillDatabase(args) if fresh else None
+        allPoints = loadAllPoints()
+        indexSeconds, cells = indexCost(allPoints)
+        rng = random.Random(args.seed + 1)
+        report = dict(tracks=len(allPoints), points=sum(len(points) for points in allPoints.values()),
+                      cells=cells, insertSeconds=fillSeconds, indexSeconds=indexSeconds,
+                      databaseBytes=os.path.getsize(dbPath),
+                      box=runQueries('box', args, allPoints, rng), near=runQueries('near', args, allPoints, rng),
+                      options=vars(args))
+        sqlAlch.getEngine().dispose()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return 1 if report['box']['mismatches'] or report['near']['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Startup import report, kept as a regression benchmark.
+
+Runs ``python -X importtime -c "import main"`` from the repository root and
+writes a JSON report with the total import time, the slowest modules and any
+heavy module that got imported before the login dialog. Exits with status 1
+when the budget is exceeded or a deferred module shows up.
+
+    python benchmarks/startupReport.py --budget-ms 600 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be imported before login (see MainWindow.importHeavyModules).
+DEFERRED_MODULES = ('numpy', 'matplotlib', 'folium', 'gpxpy', 'MapMaker', 'gpxParse', 'trackAnalytics',
+                    'trackView', 'trackData', 'heatmap', 'tileCache')
+
+
+def importTimes(statement):
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append(dict(module=name.strip(), selfUs=int(selfTime), cumulativeUs=int(cumulative), depth=depth))
+    return completed.returncode, modules, completed.stderr
+
+
+def buildReport(statement, top):
+    returnCode, modules, stderr = importTimes(statement)
+    report = dict(statement=statement, python=sys.version.split()[0], returnCode=returnCode,
+                  totalMs=sum(module['selfUs'] for module in modules) / 1000.0,
+                  moduleCount=len(modules),
+                  deferredImported=sorted(set(module['module'].split('.')[0] for module in modules
+                                              if module['module'].split('.')[0] in DEFERRED_MODULES)),
+                  slowest=sorted(modules, key=lambda module: module['cumulativeUs'], reverse=True)[:top])
+    if returnCode != 0:
+        errors = [line for line in stderr.splitlines() if not line.startswith('import time:')]
+        report['error'] = errors[-1] if errors else ''
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--statement', default='import main')
+    parser.add_argument('--budget-ms', type=float, default=600.0)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    report = buildReport(args.statement, args.top)
+    report['budgetMs'] = args.budget_ms
+    report['ok'] = (report['returnCode'] == 0 and report['totalMs'] <= args.budget_ms
+                    and not report['deferredImported'])
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""Benchmark for the map tile cache and local map server (tileCache).
+
+Starts a stand-in tile server on 127.0.0.1 that answers every tile after
+--latency-ms with --tile-kb of bytes, and puts a tileCache.MapServer in
+front of it the way MainWindow does. Then, like a WebView opening a
+--width x --height map of a ride: loads a cold screen with one, the
+default and --workers download threads, the same screen warm, and after
+prefetching the ride's bounding box the screens of the zooms prefetched.
+Also checks that one tile asked for many times at once is downloaded once,
+that the disk use stays under the limit with least recently used tiles
+going first, that cached tiles and assets are still served with the tile
+server stopped, and that missing ones are not. Writes a JSON report; exits
+1 when a check fails.
+
+    python benchmarks/tileCacheBenchmark.py --latency-ms 80 --output tiles.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import gpxGenerator  # noqa: E402
+import tileCache  # noqa: E402
+
+# What a browser opens at once to one host.
+BROWSER_CONNECTIONS = 6
+
+
+class StandInTileServer:
+    # Tiles are the path repeated to tileBytes, so any mix-up shows.
+
+    def __init__(self, latency, tileBytes):
+        self.latency = latency
+        self.tileBytes = tileBytes
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.requests[self.path] += 1
+                time.sleep(server.latency)
+                body = server.body(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def body(self, path):
+        return (path.encode() * (self.tileBytes // len(path) + 1))[:self.tileBytes]
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.httpd.server_address[1], path)
+
+    def count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fetch(url):
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, b''
+
+
+def screenTiles(bounds, zoom, args):
+    # Tiles of a width x height map centred on the bounds
+    centreX, centreY = tileCache.mercatorPixel((bounds[0] + bounds[1]) / 2, (bounds[2] + bounds[3]) / 2, zoom)
+    first = (int(centreX - args.width / 2) >> 8, int(centreY - args.height / 2) >> 8)
+    last = (int(centreX + args.width / 2) >> 8, int(centreY + args.height / 2) >> 8)
+    return [(zoom, x, y) for x in range(first[0], last[0] + 1) for y in range(first[1], last[1] + 1)]
+
+
+def loadScreen(server, tiles):
+    # Seconds to fetch every tile through the map server as a browser would,
+    # and the bodies in order
+    start = time.perf_counter()
+    with ThreadPoolExecutor(BROWSER_CONNECTIONS) as browser:
+        results = list(browser.map(fetch, [server.url('tiles/%d/%d/%d.png' % tile) for tile in tiles]))
+    return time.perf_counter() - start, results
+
+
+def checkBodies(upstream, tiles, results, failures, what):
+    for (zoom, x, y), (status, body) in zip(tiles, results):
+        if status != 200 or body != upstream.body('/%d/%d/%d.png' % (zoom, x, y)):
+            failures.append('%s: tile %d/%d/%d came back %d with %d bytes' % (what, zoom, x, y, status, len(body)))
+            return
+
+
+def newServer(upstream, directory, workers, maxBytes):
+    cache = tileCache.TileCache(directory, maxBytes, upstream.url('{z}/{x}/{y}.png'), workers)
+    return tileCache.MapServer(cache)
+
+
+def screens(upstream, workDir, bounds, args, failures):
+    zoom = tileCache.fitZoom(bounds, args.width, args.height)
+    tiles = screenTiles(bounds, zoom, args)
+    results = dict(zoom=zoom, tiles=len(tiles))
+    for workers in sorted({1, tileCache.FETCH_WORKERS, args.workers}):
+        server = newServer(upstream, os.path.join(workDir, 'cold%d' % workers), workers, args.cache_mb << 20)
+        seconds, bodies = loadScreen(server, tiles)
+        checkBodies(upstream, tiles, bodies, failures, 'cold screen')
+        results['coldSeconds%dWorkers' % workers] = seconds
+        if workers == args.workers:
+            before = upstream.count()
+            results['warmSeconds'], bodies = loadScreen(server, tiles)
+            checkBodies(upstream, tiles, bodies, failures, 'warm screen')
+            if upstream.count() != before:
+                failures.append('warm screen downloaded %d tiles again' % (upstream.count() - before))
+            results['cache'] = server.cache.stats()
+        server.close()
+    return results
+
+
+def prefetched(upstream, workDir, bounds, args, failures):
+    server = newServer(upstream, os.path.join(workDir, 'prefetch'), args.workers, args.cache_mb << 20)
+    start = time.perf_counter()
+    queued = server.cache.prefetch(bounds, args.width, args.height)
+    while server.cache.stats()['pending']:
+        time.sleep(0.01)
+    results = dict(queued=queued, prefetchSeconds=time.perf_counter() - start, screens={})
+    first = tileCache.fitZoom(bounds, args.width, args.height)
+    for zoom in sorted(set(zoom for zoom, x, y in tileCache.prefetchTiles(bounds, args.width, args.height))):
+        # the ride itself, which is what the prefetch covers
+        tiles = tileCache.boundsTiles(bounds, zoom)
+        before = upstream.count()
+        seconds, bodies = loadScreen(server, tiles)
+        checkBodies(upstream, tiles, bodies, failures, 'prefetched zoom %d' % zoom)
+        if upstream.count() != before:
+            failures.append('zoom %d downloaded %d tiles after prefetching' % (zoom, upstream.count() - before))
+        results['screens'][str(zoom)] = dict(tiles=len(tiles), seconds=seconds)
+    if str(first) not in results['screens']:
+        failures.append('prefetch left out the zoom the ride is shown at')
+    if queued > tileCache.MAX_PREFETCH_TILES:
+        failures.append('prefetch queued %d tiles' % queued)
+    server.close()
+    return results
+
+
+def sharedDownloads(upstream, workDir, args, failures):
+    server = newServer(upstream, os.path.join(workDir, 'shared'), args.workers, args.cache_mb << 20)
+    before = upstream.count()
+    with ThreadPoolExecutor(16) as clients:
+        bodies = list(clients.map(lambda index: server.cache.get(5, 17, 10), range(16)))
+    downloads = upstream.count() - before
+    if downloads != 1 or len(set(bodies)) != 1:
+        failures.append('16 requests of one tile made %d downloads' % downloads)
+    server.close()
+    return dict(requests=16, downloads=downloads)
+
+
+def eviction(upstream, workDir, args, failures):
+    directory = os.path.join(workDir, 'evict')
+    maxBytes = 50 * args.tile_kb << 10
+    cache = tileCache.TileCache(directory, maxBytes, upstream.url('{z}/{x}/{y}.png'), args.workers)
+    kept = (14, 0, 0)
+    cache.get(*kept)
+    for x in range(1, 120):
+        cache.get(14, x, 0)
+        # keeps one early tile in use
+        cache.get(*kept)
+    onDisk = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(directory)
+                 for name in names)
+    stats = cache.stats()
+    cache.close()
+    if onDisk > maxBytes or stats['bytes'] != onDisk:
+        failures.append('cache holds %d bytes on disk (%d counted) over a limit of %d' % (
+            onDisk, stats['bytes'], maxBytes))
+    if not os.path.exists(cache._path(*kept)) or os.path.exists(cache._path(14, 1, 0)):
+        failures.append('eviction did not remove the least recently used tiles')
+    reopened = tileCache.TileCache(directory, maxBytes, upstream.url('{z}/{x}/{y}.png'), args.workers)
+    if reopened.stats()['bytes'] != onDisk:
+        failures.append('reopened cache counts %d bytes' % reopened.stats()['bytes'])
+    reopened.close()
+    return dict(limitBytes=maxBytes, diskBytes=onDisk, files=stats['files'], evictions=stats['evictions'])
+
+
+def offline(upstream, workDir, bounds, args, failures):
+    tileCache.ASSET_DIR = os.path.join(workDir, 'assets')
+    tileCache.ASSETS = {'leaflet/leaflet.js': upstream.url('leaflet.js')}
+    server = newServer(upstream, os.path.join(workDir, 'offline'), args.workers, args.cache_mb << 20)
+    server.cache.maxAge = 0
+    tiles = screenTiles(bounds, tileCache.fitZoom(bounds, args.width, args.height), args)
+    loadScreen(server, tiles)
+    asset = fetch(server.url('assets/leaflet/leaflet.js'))
+    page = fetch(server.url('maparea.html'))
+    upstream.stop()
+    seconds, bodies = loadScreen(server, tiles)
+    checkBodies(upstream, tiles, bodies, failures, 'offline screen')
+    if fetch(server.url('assets/leaflet/leaflet.js')) != asset or asset[0] != 200:
+        failures.append('asset not served offline')
+    if page[0] != 200 or b'tiles/{z}/{x}/{y}.png' not in page[1]:
+        failures.append('map page not served')
+    missing = [fetch(server.url(path))[0] for path in ('tiles/3/1/1.png', 'assets/other.js', 'nothing')]
+    if missing != [404, 404, 404]:
+        failures.append('missing tiles answered %s' % missing)
+    stats = server.cache.stats()
+    server.close()
+    return dict(seconds=seconds, staleHits=stats['staleHits'], errors=stats['errors'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--tile-kb', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=tileCache.FETCH_WORKERS * 3)
+    parser.add_argument('--cache-mb', type=int, default=64)
+    parser.add_argument('--points', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    points = [point[:2] for point in gpxGenerator.generatePoints(args.points, args.seed)]
+    lats, lons = [lat for lat, lon in points], [lon for lat, lon in points]
+    bounds = (min(lats), max(lats), min(lons), max(lons))
+    upstream = StandInTileServer(args.latency_ms / 1000.0, args.tile_kb << 10)
+    workDir = tempfile.mkdtemp(prefix='gpxtiles-')
+    failures = []
+    try:
+        report = dict(bounds=bounds, screen=screens(upstream, workDir, bounds, args, failures),
+                      prefetch=prefetched(upstream, workDir, bounds, args, failures),
+                      sharedDownloads=sharedDownloads(upstream, workDir, args, failures),
+                      eviction=eviction(upstream, workDir, args, failures),
+                      offline=offline(upstream, workDir, bounds, args, failures))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    report.update(failures=failures, options=vars(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    print(text)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
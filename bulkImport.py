@@ -0,0 +1,234 @@
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import gpxParse
+import gpxSources
+import heatmap
+import sqlAlch
+import trackCodec
+import trackFingerprint
+import trackSimplify
+import workerPool
+
+
+class FileResult:
+
+    def __init__(self, path, ok, points=0, error=None, skipped=False):
+        self.path = path
+        self.ok = ok
+        self.points = points
+        self.error = error
+        # already imported (same fingerprint); neither ok nor failed
+        self.skipped = skipped
+
+
+class ImportReport:
+
+    def __init__(self):
+        self.results = []
+        self.elapsed = 0.0
+
+    @property
+    def imported(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok and not result.skipped]
+
+    @property
+    def skipped(self):
+        return [result for result in self.results if result.skipped]
+
+    @property
+    def points(self):
+        return sum(result.points for result in self.results)
+
+    @property
+    def filesPerSecond(self):
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def pointsPerSecond(self):
+        return self.points / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return "%d imported, %d already known, %d failed in %.1f s (%.1f files/s, %.0f points/s)" % (
+            len(self.imported), len(self.skipped), len(self.failed), self.elapsed, self.filesPerSecond, self.pointsPerSecond)
+
+
+def findGpxFiles(folder):
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if gpxSources.isImportable(name):
+                paths.append(os.path.join(root, name))
+    paths.sort()
+    return paths
+
+
+# getHeadFingerprints() of the tracks already stored, set by the initializer
+# of a pool's worker processes; each import starts its own pool
+_knownHeads = {}
+
+
+def _initWorker(knownHeads):
+    global _knownHeads
+    _knownHeads = knownHeads
+
+
+def parseGpxFile(user, path, knownHeads=None, data=None):
+    # Runs in a worker process; returns (path, gpxTracks row or None, points,
+    # error, skipped). `path` is a gpxSources source, `data` the bytes of a
+    # tar member. A file whose first points match a stored track is skipped
+    # once the fingerprint of all its points matches too, without the full
+    # parse.
+    if knownHeads:
+        candidates = knownHeads.get(trackFingerprint.readHeadHash(path, data=data))
+        if candidates and trackFingerprint.sameTrack(trackFingerprint.readFingerprint(path, data), candidates):
+            return path, None, 0, None, True
+    gpxObject = gpxParse.GpxRecord(user)
+    gpxObject.parseFile(path, data=data)
+    if gpxObject.error is not None:
+        return path, None, 0, str(gpxObject.error), False
+    row = dict(user=user, avgSpeed=gpxObject.avgSpeed, distance=gpxObject.distance,
+               avgHr=gpxObject.avgHr, date=gpxObject.rideDate, rideTime=gpxObject.rideTime,
+               points=gpxObject.serializedPointsArray, hr=gpxObject.serializedHrArray,
+               elevation=gpxObject.serializedElevationArray, levels=gpxObject.serializedLevels,
+               time=gpxObject.serializedTimeArray, speed=gpxObject.serializedSpeedArray,
+               analytics=dict(gpxObject.analytics, speed=None), fingerprint=gpxObject.fingerprint,
+               heatCells=heatmap.binTrack(gpxObject.track))
+    return path, row, len(gpxObject.track), None, False
+
+
+def _parseWorker(knownHeads, args):
+    user, path, data = args
+    try:
+        return parseGpxFile(user, path, knownHeads, data)
+    except Exception as e:
+        return path, None, 0, str(e), False
+
+
+def _parseChunk(jobs):
+    return [_parseWorker(_knownHeads, job) for job in jobs]
+
+
+def importFiles(user, paths, workers=None, batchSize=200, progress=None, skipKnown=True):
+    # Parses `paths` (.gpx, .gpx.gz, .zip or .tar.gz) in a process pool and
+    # writes every parsed track inside a single transaction.
+    # `progress(done, total, fileResult)` is called after each file, in the
+    # calling process; total is None while a tar archive is being read, as
+    # its member count is only known at the end. An exception raised from
+    # progress aborts the import, drops the files not parsed yet and rolls
+    # the batch back. Tracks already stored are reported as skipped: before
+    # the full parse when skipKnown is set and the head hash and fingerprint
+    # both match, otherwise (and for duplicates within the batch) by the
+    # fingerprint check in insertGpxTracks.
+    report = ImportReport()
+    paths = list(paths)
+    started = time.perf_counter()
+    knownHeads = sqlAlch.getHeadFingerprints(user) if skipKnown else {}
+    queued = []
+
+    # zip members are listed from the central directory; tar members are
+    # streamed to the workers while the archive is read
+    if any(gpxSources.isTar(path) for path in paths):
+        jobs = ((user, source, data) for source, data in gpxSources.expandSources(paths))
+        total = None
+    else:
+        jobs = [(user, source, data) for source, data in gpxSources.expandSources(paths)]
+        total = len(jobs)
+
+    def parsedRows(results):
+        for path, row, points, error, skipped in results:
+            fileResult = FileResult(path, row is not None, points, error, skipped)
+            report.results.append(fileResult)
+            if progress is not None:
+                progress(len(report.results), total, fileResult)
+            if row is not None:
+                queued.append(fileResult)
+                yield row
+
+    try:
+        if workers == 1 or (total is not None and total < 2):
+            results = map(functools.partial(_parseWorker, knownHeads), jobs)
+            trackIds = sqlAlch.insertGpxTracks(parsedRows(results), batchSize=batchSize)
+        else:
+            poolSize = workerPool.poolSize(workers)
+            window = poolSize * workerPool.CHUNKS_PER_WORKER
+            chunksize = workerPool.MAX_CHUNK if total is None else max(1, min(workerPool.MAX_CHUNK, total // window))
+            executor = ProcessPoolExecutor(max_workers=poolSize, initializer=_initWorker, initargs=(knownHeads,))
+            try:
+                results = workerPool.boundedMap(executor, _parseChunk, jobs, window, chunksize)
+                trackIds = sqlAlch.insertGpxTracks(parsedRows(results), batchSize=batchSize)
+            finally:
+                workerPool.shutdown(executor)
+    finally:
+        gpxSources.closeArchives()
+    for fileResult, trackId in zip(queued, trackIds):
+        if trackId is None:
+            fileResult.ok = False
+            fileResult.skipped = True
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def importFolder(user, folder, workers=None, batchSize=200, progress=None, skipKnown=True):
+    return importFiles(user, findGpxFiles(folder), workers, batchSize, progress, skipKnown)
+
+
+RECOMPUTE_KINDS = ('analytics', 'levels', 'fingerprints')
+
+
+def recomputeTrack(kinds, track):
+    # Runs in a worker process; `track` is an iterStoredTracks() row.
+    result = dict(trackId=track['id'], user=track['user'])
+    if 'analytics' in kinds:
+        result['analytics'] = sqlAlch.analyseStoredTrack(track['points'], track['elevation'], track['hr'],
+                                                         track['time'])
+    if 'levels' in kinds:
+        result['levels'] = trackSimplify.buildLevels(trackCodec.decode(track['points']))
+    if 'fingerprints' in kinds:
+        result['fingerprint'] = sqlAlch.fingerprintStoredTrack(track['points'], track['time'], track['date'])
+    return result
+
+
+def _recomputeChunk(jobs):
+    return [recomputeTrack(kinds, track) for kinds, track in jobs]
+
+
+def recomputeTracks(kinds, user=None, workers=None, batchSize=100, progress=None):
+    # Recomputes the derived data in `kinds` (see RECOMPUTE_KINDS) for the
+    # stored tracks of `user`, or of everybody, after the algorithms behind
+    # them changed. Tracks are read and written batchSize at a time, so the
+    # database stays usable meanwhile; `progress(done)` is called per batch.
+    # Rollups are rebuilt afterwards when analytics changed. Returns the
+    # number of tracks processed.
+    kinds = tuple(kind for kind in RECOMPUTE_KINDS if kind in kinds)
+    if not kinds:
+        return 0
+    jobs = ((kinds, track) for track in sqlAlch.iterStoredTracks(user, batchSize))
+    done = 0
+    executor = None
+    try:
+        if workers == 1:
+            results = (recomputeTrack(kinds, track) for kinds, track in jobs)
+        else:
+            poolSize = workerPool.poolSize(workers)
+            executor = ProcessPoolExecutor(max_workers=poolSize)
+            results = workerPool.boundedMap(executor, _recomputeChunk, jobs, poolSize * workerPool.CHUNKS_PER_WORKER)
+        for batch in workerPool.chunks(results, batchSize):
+            with sqlAlch.transaction() as conn:
+                for result in batch:
+                    sqlAlch.storeRecomputed(conn=conn, **result)
+            done += len(batch)
+            if progress is not None:
+                progress(done)
+    finally:
+        if executor is not None:
+            workerPool.shutdown(executor)
+    if 'analytics' in kinds:
+        sqlAlch.rebuildRollups(user)
+    return done
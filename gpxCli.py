@@ -0,0 +1,196 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+import instrument
+import sqlAlch
+
+log = logging.getLogger(__name__)
+
+# Headless entry point for imports and reports on machines without a
+# display, e.g. from cron:
+#
+#   python gpxCli.py --db /data/sqlDb.db import --user anna /incoming/*.zip
+#   python gpxCli.py recompute analytics --user anna
+#   python gpxCli.py export --user anna -o anna.csv
+#   python gpxCli.py export --user anna -o anna.parquet
+#   python gpxCli.py stats --user anna --period month --limit 12
+#   python gpxCli.py assets
+#
+# Only the parsing and storage modules are imported (bulkImport on first
+# use), never wx, matplotlib or folium.
+
+EXPORT_COLUMNS = ('id', 'date', 'distance', 'rideTime', 'avgSpeed', 'avgHr', 'movingTime', 'elevationGain',
+                  'elevationLoss', 'maxSpeed', 'pointCount')
+
+
+def requireUser(name):
+    if not sqlAlch.checkCreatedUser(name):
+        raise SystemExit("gpxCli: unknown user %r" % name)
+
+
+def importCommand(args):
+    import bulkImport
+    requireUser(args.user)
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths.extend(bulkImport.findGpxFiles(path))
+        else:
+            paths.append(path)
+
+    def progress(done, total, result):
+        if result.error is not None:
+            log.warning('%s: %s', result.path, result.error)
+        if args.verbose:
+            print("%d/%s %s" % (done, total if total is not None else '?', result.path), file=sys.stderr)
+
+    report = bulkImport.importFiles(args.user, paths, workers=args.workers, batchSize=args.batch_size,
+                                    progress=progress, skipKnown=not args.no_skip_known)
+    print(report.summary())
+    return 1 if report.failed else 0
+
+
+def recomputeCommand(args):
+    import bulkImport
+    if args.user is not None:
+        requireUser(args.user)
+    kinds = set(args.kinds)
+    if 'all' in kinds:
+        kinds = set(bulkImport.RECOMPUTE_KINDS) | {'rollups', 'heatmap'}
+    trackKinds = [kind for kind in bulkImport.RECOMPUTE_KINDS if kind in kinds]
+    if trackKinds:
+        done = bulkImport.recomputeTracks(trackKinds, user=args.user, workers=args.workers,
+                                          batchSize=args.batch_size,
+                                          progress=lambda done: log.info('%d tracks recomputed', done))
+        print("%d tracks recomputed (%s)" % (done, ', '.join(trackKinds)))
+    # recomputing analytics rebuilds the rollups already
+    if 'rollups' in kinds and 'analytics' not in kinds:
+        print("%d rollup rows rebuilt" % sqlAlch.rebuildRollups(args.user))
+    if 'heatmap' in kinds:
+        print("heatmap rebuilt from %d tracks" % sqlAlch.rebuildHeatmap(args.user))
+    return 0
+
+
+def exportCommand(args):
+    requireUser(args.user)
+    format = args.format
+    if format is None:
+        format = 'csv' if args.output == '-' or args.output.lower().endswith('.csv') else None
+    if format != 'csv':
+        import trackExport
+        done = trackExport.exportTracks(args.user, args.output, format, compress=True if args.gzip else None,
+                                        workers=args.workers,
+                                        progress=lambda done, total: log.debug('%d/%d tracks exported', done, total))
+        print("%d tracks exported to %s" % (done, args.output), file=sys.stderr)
+        return 0
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output != '-' else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(EXPORT_COLUMNS)
+        for track in sqlAlch.getTrackSummaries(args.user):
+            writer.writerow([track[name] for name in EXPORT_COLUMNS])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def statsCommand(args):
+    requireUser(args.user)
+    stats = dict(user=args.user, tracks=sqlAlch.countTracks(args.user),
+                 totals=sqlAlch.getRollupTotals(args.user))
+    if args.period is not None:
+        stats[args.period] = sqlAlch.getRollups(args.user, args.period, args.limit)
+    if args.json:
+        print(json.dumps(stats, default=str, indent=2))
+        return 0
+    totals = stats['totals']
+    print("%s: %d tracks, %d rides, %.1f km, %s moving, %.0f m climbed" % (
+        args.user, stats['tracks'], totals['rideCount'], totals['distance'],
+        formatDuration(totals['movingTime']), totals['elevationGain']))
+    for row in stats.get(args.period, ()):
+        print("%s  %4d rides  %8.1f km  %10s  %6.0f m" % (
+            row['start'], row['rideCount'], row['distance'], formatDuration(row['movingTime']),
+            row['elevationGain']))
+    return 0
+
+
+def assetsCommand(args):
+    import tileCache
+    try:
+        fetched = tileCache.fetchAssets(force=args.force)
+    except OSError as error:
+        raise SystemExit("gpxCli: cannot download the map assets: %s" % error)
+    print("%d map assets downloaded to %s" % (len(fetched), tileCache.ASSET_DIR))
+    return 0
+
+
+def formatDuration(seconds):
+    seconds = int(seconds or 0)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description='Import and report on GPX tracks without the GUI.')
+    parser.add_argument('--db', help='database file (default: $GPX_DB_PATH or %s)' % sqlAlch.DB_PATH)
+    parser.add_argument('--log-level', help='logging level, e.g. INFO or DEBUG (default: $GPX_LOG_LEVEL)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('import', help='import .gpx/.gpx.gz files, folders and .zip/.tar.gz archives')
+    command.add_argument('--user', required=True)
+    command.add_argument('paths', nargs='+')
+    command.add_argument('--workers', type=int, help='parser processes (default: one per core)')
+    command.add_argument('--batch-size', type=int, default=200)
+    command.add_argument('--no-skip-known', action='store_true',
+                         help='parse every file, even those whose first points match a stored track')
+    command.add_argument('-v', '--verbose', action='store_true', help='print every file as it is done')
+    command.set_defaults(run=importCommand)
+
+    command = commands.add_parser('recompute', help='recompute derived data of stored tracks')
+    command.add_argument('kinds', nargs='+', choices=('analytics', 'levels', 'fingerprints', 'rollups', 'heatmap',
+                                                         'all'))
+    command.add_argument('--user', help='only this user (default: everybody)')
+    command.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    command.add_argument('--batch-size', type=int, default=100)
+    command.set_defaults(run=recomputeCommand)
+
+    command = commands.add_parser('export', help='write the tracks as GPX, GeoJSON, NDJSON, Parquet or Arrow, '
+                                                 'or the track list as CSV')
+    command.add_argument('--user', required=True)
+    command.add_argument('-o', '--output', default='-',
+                         help='output file, its name picks the format: .gpx, .zip (one GPX per track), .geojson, '
+                              '.ndjson, .parquet, .arrow, .csv, each text format optionally .gz (default: stdout)')
+    command.add_argument('--format', choices=('csv', 'gpx', 'geojson', 'ndjson', 'parquet', 'arrow'))
+    command.add_argument('--gzip', action='store_true', help='compress the output (Parquet: gzip codec)')
+    command.add_argument('--workers', type=int, help='encoding processes (default: one per core)')
+    command.set_defaults(run=exportCommand)
+
+    command = commands.add_parser('stats', help='print totals and per-period rollups')
+    command.add_argument('--user', required=True)
+    command.add_argument('--period', choices=sqlAlch.ROLLUP_PERIODS)
+    command.add_argument('--limit', type=int, help='newest periods only')
+    command.add_argument('--json', action='store_true')
+    command.set_defaults(run=statsCommand)
+
+    command = commands.add_parser('assets', help='download the map page assets (Leaflet) for offline use')
+    command.add_argument('--force', action='store_true', help='download them again even when present')
+    command.set_defaults(run=assetsCommand)
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    instrument.configureLogging(args.log_level)
+    if args.db is not None:
+        sqlAlch.configure(args.db)
+    sqlAlch.createDb()
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,60 +1,126 @@
-import gpxParse
-import gpxpy
-from array import *
-import json
-from datetime import datetime
+import gpxSources
+import instrument
+import trackCodec
+import trackFingerprint
+import trackSimplify
+import trackAnalytics
+import trackData
+from datetime import datetime, timezone
+import logging
+import math
 import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+try:
+    import gpxpy
+except ImportError:
+    gpxpy = None
+
+log = logging.getLogger(__name__)
+
+# same constants gpxpy.geo uses, so both parser paths agree on distance
+EARTH_RADIUS = 6378.137 * 1000
+ONE_DEGREE = (2 * math.pi * EARTH_RADIUS) / 360
+# Amazfit exports <ele> in centimetres
+ELEVATION_SCALE = 100.0
+# creator of the files written by trackExport: standard GPX 1.1, <ele> in
+# metres and the heart rate in a TrackPointExtension <hr> instead of <desc>
+EXPORT_CREATOR = 'wxpython-gpx'
+
+
+def elevationScale(creator):
+    return 1.0 if creator == EXPORT_CREATOR else ELEVATION_SCALE
+
+
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parseGpxTime(text):
+    text = text.strip()
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def pointDistance(lat1, lon1, lat2, lon2):
+    # mirror of gpxpy.geo.distance() without elevation
+    if abs(lat1 - lat2) > .2 or abs(lon1 - lon2) > .2:
+        dLon = math.radians(lon1 - lon2)
+        rLat1 = math.radians(lat1)
+        rLat2 = math.radians(lat2)
+        dLat = rLat1 - rLat2
+        a = math.pow(math.sin(dLat / 2), 2) + \
+            math.pow(math.sin(dLon / 2), 2) * math.cos(rLat1) * math.cos(rLat2)
+        return EARTH_RADIUS * 2 * math.asin(math.sqrt(a))
+    coef = math.cos(math.radians(lat1))
+    x = lat1 - lat2
+    y = (lon1 - lon2) * coef
+    return math.sqrt(x * x + y * y) * ONE_DEGREE
+
 
 class GpxRecord:
 
     def __init__(self, user):
-        print('object created')
         self.user = user
-        self.pointsArray = []
-        self.elevationArray = []
-        self.hrArray = []
+        self.track = trackData.TrackData()
         self.serializedPointsArray = []
         self.serializedHrArray = []
         self.serializedElevationArray = []
+        self.serializedLevels = None
+        self.serializedTimeArray = None
+        self.serializedSpeedArray = None
+        self.analytics = None
+        self.fingerprint = None
         self.distance = None
         self.rideDate = None
         self.rideTime = None
         self.avgSpeed = None
         self.avgHr = 0.0
+        self.error = None
 
 
 
-    def parseFile(self,filePath):
+    def parseFile(self, filePath, streaming=True, data=None):
+        # filePath is a gpxSources source: a .gpx or .gpx.gz path or an
+        # archive member; `data` carries the bytes of a tar member.
         try:
-            print('DEBUG:' + filePath)
-            gpx_file = open(filePath, 'r')
-            gpx_parsed_file = gpxpy.parse(gpx_file)
-            i = 0
-            for track in gpx_parsed_file.tracks:
-                for segment in track.segments:
-                    for point in segment.points:
-                        if i == 0:
-                            startTime=point.time
-                        if segment.points[-1]:
-                            endTime = point.time
-                        self.pointsArray.append([])
-                        self.pointsArray[-1].append(point.latitude)
-                        self.pointsArray[-1].append(point.longitude)
-                        self.elevationArray.append(float(point.elevation)/100)
-                        self.hrArray.append(float(point.description))
-                        i = i+1
-            #DEBUG:
-            # print(len(self.pointsArray))
-            # print(len(self.elevationArray))
-            # print(self.pointsArray[60])
-            # print(self.hrArray[33])
-
-            self.distance = (gpx_parsed_file.length_2d() / 1000)
-            print(self.distance)
-
-            self.serializedPointsArray = json.dumps(self.pointsArray)
-            self.serializedHrArray = json.dumps(self.hrArray)
-            self.serializedElevationArray = json.dumps(self.elevationArray)
+            log.debug('parsing %s', filePath)
+            with instrument.span('parse') as span:
+                with instrument.span('parse.read'):
+                    if streaming or gpxpy is None:
+                        try:
+                            with gpxSources.openSource(filePath, data) as source:
+                                startTime, endTime, hrSum = self.streamPoints(source)
+                        except ET.ParseError as e:
+                            if gpxpy is None:
+                                raise
+                            log.warning('streaming parser failed on %s, falling back to gpxpy: %s', filePath, e)
+                            self.resetArrays()
+                            with gpxSources.openSource(filePath, data) as source:
+                                startTime, endTime, hrSum = self.gpxpyPoints(source)
+                    else:
+                        with gpxSources.openSource(filePath, data) as source:
+                            startTime, endTime, hrSum = self.gpxpyPoints(source)
+                log.debug('%s: %d points, %.3f km', filePath, len(self.track), self.distance)
+
+                self.track.freeze()
+                points = self.track.points()
+                with instrument.span('encode'):
+                    self.serializedPointsArray = trackCodec.encodePoints(points)
+                    self.serializedHrArray = trackCodec.encodeSeries(self.track.hr)
+                    self.serializedElevationArray = trackCodec.encodeSeries(self.track.ele)
+                self.serializedLevels = trackSimplify.buildLevels(points)
+                self.analyse()
+                self.fingerprint = trackFingerprint.fingerprint(points, self.track.time, startTime)
+                span.add('points', len(self.track))
+                span.add('bytes.payload', len(self.serializedPointsArray) + len(self.serializedHrArray)
+                         + len(self.serializedElevationArray))
 
             self.rideDate = startTime
             time_delta = (endTime - startTime)
@@ -63,13 +129,157 @@ class GpxRecord:
 
             self.avgSpeed = ((self.distance)/total_seconds)*3600
 
-            hrSum = sum(self.hrArray)
-            hrLen = len(self.hrArray)
-            self.avgHr = hrSum/hrLen
-            print(self.elevationArray)
+            self.avgHr = hrSum/len(self.track)
         except Exception as e:
-            print(e)
+            self.error = e
+            log.warning('could not parse %s: %s', filePath, e)
+
+    def analyse(self):
+        track = self.track
+        times = track.column('time')
+        self.analytics = trackAnalytics.analyse(track.column('lat'), track.column('lon'), track.column('ele'),
+                                                times if not np.isnan(times).any() else None, track.column('hr'))
+        # prefer the speed recorded by the device when the file has one
+        if not track.column('speed').any() and self.analytics['speed'] is not None:
+            track.speed = self.analytics['speed']
+        self.serializedTimeArray = trackCodec.encodeTimes(times)
+        self.serializedSpeedArray = trackCodec.encodeSeries(track.column('speed'))
+
+    def resetArrays(self):
+        self.track = trackData.TrackData()
+        self.distance = None
+
+    def streamPoints(self, source):
+        # Single pass over the XML with iterparse: every finished trkpt is
+        # appended to self.track and removed from its trkseg, so the tree
+        # never holds more than one point at a time.
+        track = self.track
+        startTime = None
+        endTime = None
+        hrSum = 0.0
+        distance = 0.0
+        segment = None
+        prevLat = prevLon = None
+        lat = lon = None
+        ele = desc = hrText = pointTime = speed = None
+        inPoint = False
+        scale = ELEVATION_SCALE
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            name = localName(elem.tag)
+            if event == 'start':
+                if name == 'gpx':
+                    scale = elevationScale(elem.get('creator'))
+                elif name == 'trkseg':
+                    segment = elem
+                    prevLat = prevLon = None
+                elif name == 'trkpt' and segment is not None:
+                    inPoint = True
+                    lat = float(elem.get('lat'))
+                    lon = float(elem.get('lon'))
+                    ele = desc = hrText = pointTime = speed = None
+                continue
+
+            if not inPoint:
+                if name == 'trkseg':
+                    segment = None
+                continue
+            if name == 'ele':
+                ele = elem.text
+            elif name == 'time':
+                pointTime = elem.text
+            elif name == 'desc':
+                desc = elem.text
+            elif name == 'hr':
+                hrText = elem.text
+            elif name == 'speed':
+                speed = elem.text
+            elif name == 'trkpt':
+                inPoint = False
+                hr = float(desc if desc is not None else hrText)
+                hrSum += hr
+                if pointTime is not None:
+                    endTime = parseGpxTime(pointTime)
+                    if startTime is None and len(track) == 0:
+                        startTime = endTime
+                    seconds = endTime.timestamp()
+                else:
+                    seconds = math.nan
+                track.append(lat, lon, float(ele)/scale, seconds, hr, float(speed) if speed is not None else 0.0)
+                if prevLat is not None:
+                    distance += pointDistance(lat, lon, prevLat, prevLon)
+                prevLat, prevLon = lat, lon
+                segment.remove(elem)
+        self.distance = distance / 1000
+        return startTime, endTime, hrSum
+
+    def gpxpyPoints(self, source):
+        text = source.read().decode('utf-8-sig')
+        gpx_parsed_file = gpxpy.parse(text)
+        scale = elevationScale(gpx_parsed_file.creator)
+        rawExtensions = None
+        i = 0
+        hrSum = 0.0
+        for track in gpx_parsed_file.tracks:
+            for segment in track.segments:
+                for point in segment.points:
+                    if i == 0:
+                        startTime=point.time
+                    if segment.points[-1]:
+                        endTime = point.time
+                    extensions = None
+                    if not point.extensions:
+                        # gpxpy only keeps <extensions> for version="1.1" files
+                        if rawExtensions is None:
+                            rawExtensions = pointExtensions(text)
+                        extensions = rawExtensions[i] if i < len(rawExtensions) else {}
+                    hr = float(point.description if point.description is not None
+                               else self.extensionValue(point, 'hr', extensions))
+                    hrSum += hr
+                    self.track.append(point.latitude, point.longitude, float(point.elevation)/scale,
+                                      point.time.timestamp() if point.time is not None else math.nan, hr,
+                                      self.extensionSpeed(point, extensions))
+                    i = i+1
+        self.distance = (gpx_parsed_file.length_2d() / 1000)
+        return startTime, endTime, hrSum
 
+    def extensionValue(self, point, name, extensions=None):
+        # `extensions` are the point's pointExtensions() when gpxpy has none
+        if extensions is not None:
+            return extensions.get(name)
+        for extension in point.extensions:
+            for child in extension.iter():
+                if localName(child.tag) == name and child.text:
+                    return child.text
+        return None
 
+    def extensionSpeed(self, point, extensions=None):
+        # fall back to the GPX 1.0 <speed> element and finally to 0.0 like
+        # the streaming path
+        speed = self.extensionValue(point, 'speed', extensions)
+        if speed is not None:
+            return float(speed)
+        if point.speed is not None:
+            return float(point.speed)
+        return 0.0
 
 
+def pointExtensions(text):
+    # [{name: text}] of the elements inside every trkpt's <extensions>, in
+    # document order, which is the order gpxpy lists the points in.
+    points = []
+    try:
+        root = ET.fromstring(text.encode('utf-8'))
+    except ET.ParseError as e:
+        log.warning('cannot read the point extensions: %s', e)
+        return points
+    for point in root.iter():
+        if localName(point.tag) != 'trkpt':
+            continue
+        values = {}
+        for child in point:
+            if localName(child.tag) == 'extensions':
+                for element in child.iter():
+                    if element.text and element.text.strip():
+                        values.setdefault(localName(element.tag), element.text)
+        points.append(values)
+    return points
@@ -0,0 +1,173 @@
+import gzip
+import io
+import mmap
+import os
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+# A "source" names one GPX document: a plain path, a path ending in .gz, or
+# an archive member written as "<archive>::<member>". Everything that reads
+# track files (GpxRecord.parseFile, trackFingerprint.readHeadHash) opens
+# them through openSource(), so members are parsed straight from the
+# archive without temporary files.
+MEMBER_SEPARATOR = '::'
+GPX_SUFFIXES = ('.gpx', '.gpx.gz')
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar.gz', '.tgz', '.tar')
+
+# Archives at least this big are mapped instead of read through a buffer;
+# worker processes opening the same zip then share its pages.
+MMAP_BYTES = 64 * 1024 * 1024
+BUFFER_BYTES = 1024 * 1024
+# open ZipFile objects kept per process, so members are not re-indexed
+OPEN_ZIPS = 4
+
+_zipLock = threading.Lock()
+_openZips = OrderedDict()
+
+
+def isGpx(name):
+    return name.lower().endswith(GPX_SUFFIXES)
+
+
+def isZip(name):
+    return name.lower().endswith(ZIP_SUFFIXES)
+
+
+def isTar(name):
+    return name.lower().endswith(TAR_SUFFIXES)
+
+
+def isImportable(name):
+    return isGpx(name) or isZip(name) or isTar(name)
+
+
+def memberSource(archive, member):
+    return archive + MEMBER_SEPARATOR + member
+
+
+def splitSource(source):
+    # (path, member or None)
+    index = source.find(MEMBER_SEPARATOR)
+    while index >= 0:
+        if isZip(source[:index]) or isTar(source[:index]):
+            return source[:index], source[index + len(MEMBER_SEPARATOR):]
+        index = source.find(MEMBER_SEPARATOR, index + 1)
+    return source, None
+
+
+class _MappedFile:
+    # Read-only file object over an mmap; ZipFile asks for seekable(), which
+    # mmap objects only have from Python 3.13.
+
+    def __init__(self, path):
+        with open(path, 'rb') as archive:
+            self._mapped = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getattr__(self, name):
+        return getattr(self._mapped, name)
+
+    def seekable(self):
+        return True
+
+
+def _openArchiveFile(path):
+    if os.path.getsize(path) >= MMAP_BYTES:
+        return _MappedFile(path)
+    return open(path, 'rb', buffering=BUFFER_BYTES)
+
+
+def _zipFile(path):
+    with _zipLock:
+        entry = _openZips.pop(path, None)
+        if entry is None:
+            handle = _openArchiveFile(path)
+            entry = (zipfile.ZipFile(handle), handle)
+            while len(_openZips) >= OPEN_ZIPS:
+                _closeZip(_openZips.popitem(last=False)[1])
+        _openZips[path] = entry
+        return entry[0]
+
+
+def _closeZip(entry):
+    archive, handle = entry
+    archive.close()
+    handle.close()
+
+
+def closeArchives():
+    with _zipLock:
+        while _openZips:
+            _closeZip(_openZips.popitem()[1])
+
+
+class _GzipSource(gzip.GzipFile):
+    # GzipFile only closes files it opened itself; this also closes the file
+    # or archive member it reads from.
+
+    def __init__(self, stream):
+        self.stream = stream
+        try:
+            gzip.GzipFile.__init__(self, fileobj=stream, mode='rb')
+        except Exception:
+            stream.close()
+            raise
+
+    def close(self):
+        try:
+            gzip.GzipFile.close(self)
+        finally:
+            self.stream.close()
+
+
+def openSource(source, data=None):
+    # Binary file object for a source. `data` holds the bytes of a member
+    # already read by the caller (tar members arrive that way, see
+    # tarMembers()).
+    path, member = splitSource(source)
+    name = member if member is not None else path
+    if data is not None:
+        stream = io.BytesIO(data)
+    elif member is not None:
+        if not isZip(path):
+            raise ValueError('%s: only zip members can be opened directly' % source)
+        stream = _zipFile(path).open(member)
+    else:
+        stream = open(path, 'rb', buffering=BUFFER_BYTES)
+    if name.lower().endswith('.gz'):
+        return _GzipSource(stream)
+    return stream
+
+
+def zipMembers(path):
+    # Sources of the GPX members, read from the central directory only.
+    with zipfile.ZipFile(path) as archive:
+        return [memberSource(path, info.filename) for info in archive.infolist()
+                if not info.is_dir() and isGpx(info.filename)]
+
+
+def tarMembers(path):
+    # Yields (source, bytes) per GPX member in a single streaming pass over
+    # the (compressed) tar; only the member being yielded is held in memory.
+    with open(path, 'rb', buffering=BUFFER_BYTES) as archive:
+        with tarfile.open(fileobj=archive, mode='r|*') as tar:
+            for info in tar:
+                if info.isfile() and isGpx(info.name):
+                    member = tar.extractfile(info)
+                    yield memberSource(path, info.name), member.read()
+
+
+def expandSources(paths):
+    # Yields (source, data) for every GPX document in `paths`: plain files
+    # and zip members with data None, tar members with their bytes.
+    for path in paths:
+        if isZip(path):
+            for source in zipMembers(path):
+                yield source, None
+        elif isTar(path):
+            for source, data in tarMembers(path):
+                yield source, data
+        else:
+            yield path, None
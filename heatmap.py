@@ -0,0 +1,226 @@
+import re
+import struct
+import zlib
+
+import numpy as np
+
+import sqlAlch
+import spatialIndex
+import trackData
+
+# Zoom levels every ride is binned at. A bin is one pixel of a 256 pixel web
+# map tile at that zoom (about 11 m at 54N on level 13); map tiles of other
+# zooms are drawn from the nearest level below, so drawing one reads at most
+# one level tile of cells, however many rides there are.
+HEAT_LEVELS = (1, 3, 5, 7, 9, 11, 13)
+TILE_BITS = 8
+TILE_SIZE = 1 << TILE_BITS
+MAX_LATITUDE = 85.0511287798
+
+# One stored bin: its position in the tile (y << 8 | x) and the rides
+# through it; packed, 6 bytes per bin.
+CELL_DTYPE = np.dtype([('position', '<u2'), ('rides', '<u4')])
+
+# Tiles are served to maparea.html under this path (see tileCache.MapServer).
+TILE_ROUTE = 'heat'
+TILE_PATTERN = re.compile(r'(\d+)/(\d+)/(\d+)/(\d+)\.png')
+
+# Colour ramp from one ride to every ride: (position, r, g, b, alpha).
+COLOUR_STOPS = ((0.0, 120, 0, 0, 90), (0.3, 220, 30, 0, 170), (0.7, 255, 170, 0, 230), (1.0, 255, 255, 200, 255))
+
+
+def mercatorPixels(points, level):
+    # (n, 2) web mercator pixel x, y of lat/lon points at zoom `level`
+    points = trackData.asPoints(points)
+    size = TILE_SIZE << level
+    sinLat = np.sin(np.radians(np.clip(points[:, 0], -MAX_LATITUDE, MAX_LATITUDE)))
+    x = (points[:, 1] + 180.0) / 360.0 * size
+    y = (0.5 - np.log((1 + sinLat) / (1 - sinLat)) / (4 * np.pi)) * size
+    return np.column_stack((x, y))
+
+
+def cellKeys(x, y, level):
+    # Tile-major keys of integer bins: key >> 16 is the level tile (stored
+    # as one heatTiles row), key & 0xffff the bin's position in it.
+    last = (TILE_SIZE << level) - 1
+    x = np.clip(x, 0, last)
+    y = np.clip(y, 0, last)
+    tile = ((y >> TILE_BITS) << level) | (x >> TILE_BITS)
+    return (tile << (2 * TILE_BITS)) | ((y & (TILE_SIZE - 1)) << TILE_BITS) | (x & (TILE_SIZE - 1))
+
+
+def cellBins(keys, level):
+    # Inverse of cellKeys(): bin x, y
+    tile = keys >> (2 * TILE_BITS)
+    x = ((tile & ((1 << level) - 1)) << TILE_BITS) | (keys & (TILE_SIZE - 1))
+    y = ((tile >> level) << TILE_BITS) | ((keys >> TILE_BITS) & (TILE_SIZE - 1))
+    return x, y
+
+
+def packCells(positions, rides):
+    cells = np.empty(len(positions), dtype=CELL_DTYPE)
+    cells['position'] = positions
+    cells['rides'] = rides
+    return cells.tobytes()
+
+
+def unpackCells(blob):
+    cells = np.frombuffer(blob, dtype=CELL_DTYPE)
+    return cells['position'].astype(np.int64), cells['rides'].astype(np.int64)
+
+
+def splitTiles(keys, rides):
+    # {tile: (positions, rides)} for sorted cell keys; `rides` is one
+    # number or one per key.
+    keys = np.asarray(keys, dtype=np.int64)
+    rides = np.broadcast_to(np.asarray(rides, dtype=np.int64), keys.shape)
+    if len(keys) == 0:
+        return {}
+    tiles = keys >> (2 * TILE_BITS)
+    starts = np.flatnonzero(np.concatenate(([True], tiles[1:] != tiles[:-1])))
+    ends = np.append(starts[1:], len(keys))
+    return dict((int(tiles[start]), (keys[start:end] & 0xffff, rides[start:end])) for start, end in zip(starts, ends))
+
+
+def mergeCells(blob, positions, rides):
+    # packCells() blob (or None) with `rides` added at the sorted, unique
+    # `positions`, and the number of bins left with any ride. Stored bins
+    # are kept sorted too, so this is a merge rather than a sort.
+    if blob is None:
+        storedPositions = storedRides = np.zeros(0, dtype=np.int64)
+    else:
+        storedPositions, storedRides = unpackCells(blob)
+    index = np.searchsorted(storedPositions, positions)
+    found = index < len(storedPositions)
+    found[found] = storedPositions[index[found]] == positions[found]
+    storedRides[index[found]] += rides[found]
+    positions = np.insert(storedPositions, index[~found], positions[~found])
+    totals = np.insert(storedRides, index[~found], rides[~found])
+    kept = totals > 0
+    return packCells(positions[kept], totals[kept]), int(kept.sum())
+
+
+def binTrack(points):
+    # {level: sorted cell keys} of the bins the track passes through; a ride
+    # counts once per cell however long it stays there. The track is
+    # densified to one bin steps on the finest level first, so sparse
+    # sampling still draws a continuous line.
+    pixels = mercatorPixels(points, HEAT_LEVELS[-1])
+    if len(pixels) == 0:
+        return {}
+    bins = np.floor(spatialIndex.densify(pixels, 1.0)).astype(np.int64)
+    cells = {}
+    for level in HEAT_LEVELS:
+        shift = HEAT_LEVELS[-1] - level
+        cells[level] = np.unique(cellKeys(bins[:, 0] >> shift, bins[:, 1] >> shift, level))
+    return cells
+
+
+def tileLevel(zoom):
+    # Finest level at or below the map zoom; the coarsest for world views.
+    levels = [level for level in HEAT_LEVELS if level <= zoom]
+    return levels[-1] if levels else HEAT_LEVELS[0]
+
+
+def colourTable(steps=256):
+    positions = np.linspace(0.0, 1.0, steps)
+    stops = np.array(COLOUR_STOPS, dtype=float)
+    table = np.column_stack([np.interp(positions, stops[:, 0], stops[:, channel]) for channel in range(1, 5)])
+    return np.round(table).astype(np.uint8)
+
+
+COLOURS = colourTable()
+
+
+def encodePng(rgba):
+    # Minimal RGBA PNG writer, enough for tiles without pulling in an
+    # imaging library.
+    height, width = rgba.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+EMPTY_TILE = encodePng(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+def tileRides(user, zoom, x, y):
+    # TILE_SIZE x TILE_SIZE array of rides through every pixel of map tile
+    # zoom/x/y. Above a level each bin covers 2**(zoom - level) pixels; below
+    # the coarsest one pixels take the busiest of the bins they cover.
+    level = tileLevel(zoom)
+    if zoom < level:
+        side = TILE_SIZE << (level - zoom)
+        originX, originY = x * side, y * side
+    elif zoom - level <= TILE_BITS:
+        side = TILE_SIZE >> (zoom - level)
+        originX, originY = x * side, y * side
+    else:
+        # deeper than a bin: the whole tile lies inside one
+        side = 1
+        originX, originY = x >> (zoom - level - TILE_BITS), y >> (zoom - level - TILE_BITS)
+    first, last = originX >> TILE_BITS, (originX + side - 1) >> TILE_BITS
+    top, bottom = originY >> TILE_BITS, (originY + side - 1) >> TILE_BITS
+    tiles = [(tileY << level) | tileX for tileY in range(top, bottom + 1) for tileX in range(first, last + 1)]
+    grid = np.zeros((side, side), dtype=np.int64)
+    for tile, cells in sqlAlch.getHeatTiles(user, level, tiles):
+        positions, rides = unpackCells(cells)
+        binX, binY = cellBins((tile << (2 * TILE_BITS)) | positions, level)
+        inside = (binX >= originX) & (binX < originX + side) & (binY >= originY) & (binY < originY + side)
+        grid[binY[inside] - originY, binX[inside] - originX] = rides[inside]
+    if side > TILE_SIZE:
+        factor = side // TILE_SIZE
+        return grid.reshape(TILE_SIZE, factor, TILE_SIZE, factor).max(axis=(1, 3))
+    factor = TILE_SIZE // side
+    return np.repeat(np.repeat(grid, factor, axis=0), factor, axis=1)
+
+
+def renderTile(user, zoom, x, y, totalRides):
+    # PNG of map tile zoom/x/y; brightness is log(rides) against the log of
+    # the user's ride count, so one ride is faint and the daily commute glows.
+    rides = tileRides(user, zoom, x, y)
+    if not rides.any():
+        return EMPTY_TILE
+    scale = np.log1p(max(totalRides, int(rides.max())))
+    shades = np.round(np.log1p(rides) / scale * (len(COLOURS) - 1)).astype(np.intp)
+    rgba = COLOURS[shades]
+    rgba[rides == 0] = 0
+    return encodePng(rgba)
+
+
+class HeatmapTiles:
+    # Tile source for one user's heatmap layer. `version` changes whenever a
+    # ride is added or deleted and is part of the tile URLs, so the map
+    # fetches fresh tiles instead of reusing ones it has cached.
+
+    def __init__(self, user):
+        self.user = user
+        self.version = 0
+        self.totalRides = None
+        sqlAlch.addTrackListener(self.onTrackChanged)
+
+    def onTrackChanged(self, event, trackId):
+        self.version += 1
+        self.totalRides = None
+
+    def urlTemplate(self):
+        # relative to maparea.html
+        return '%s/%d/{z}/{x}/{y}.png' % (TILE_ROUTE, self.version)
+
+    def tile(self, url):
+        # PNG for a urlTemplate() URL, or None when it is not one
+        match = TILE_PATTERN.search(url)
+        if match is None:
+            return None
+        zoom, x, y = (int(value) for value in match.groups()[1:])
+        if self.totalRides is None:
+            self.totalRides = sqlAlch.countTracks(self.user)
+        return renderTile(self.user, zoom, x, y, self.totalRides)
+
+    def close(self):
+        sqlAlch.removeTrackListener(self.onTrackChanged)
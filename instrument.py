@@ -0,0 +1,212 @@
+import atexit
+import cProfile
+import csv
+import functools
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Off by default; while disabled span() hands back one shared no-op object
+# and count() returns straight away, so the hooks cost a global lookup.
+enabled = False
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_profiled = set()
+_profileDir = None
+_profiles = {}
+_profiling = threading.local()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, name, value=1):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ('name', 'start', 'profiler')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.profiler = None
+
+    def __enter__(self):
+        if self.name in _profiled and not getattr(_profiling, 'active', False):
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+                _profiling.active = True
+            except ValueError:
+                # Python 3.12+ allows one profiler per process
+                self.profiler = None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            _profiling.active = False
+            _saveProfile(self.name, self.profiler)
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                _spans[self.name] = [1, elapsed, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = min(stats[2], elapsed)
+                stats[3] = max(stats[3], elapsed)
+        return False
+
+    def add(self, name, value=1):
+        count(name, value)
+
+
+def span(name):
+    # with instrument.span('parse') as s: ...; s.add('points', n)
+    if not enabled:
+        return _NULL_SPAN
+    return Span(name)
+
+
+def timed(name):
+    # Decorator form of span(); checks `enabled` on every call.
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def enable(profile=(), profileDir=None):
+    # `profile` names the spans that also run under cProfile; their stats are
+    # merged per span name and, with profileDir, dumped as <name>.prof files.
+    global enabled, _profileDir
+    with _lock:
+        _profiled.clear()
+        _profiled.update(profile)
+        _profileDir = profileDir
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _profiles.clear()
+
+
+def _saveProfile(name, profiler):
+    with _lock:
+        stats = _profiles.get(name)
+        if stats is None:
+            _profiles[name] = pstats.Stats(profiler)
+        else:
+            stats.add(profiler)
+        if _profileDir is not None:
+            os.makedirs(_profileDir, exist_ok=True)
+            _profiles[name].dump_stats(os.path.join(_profileDir, name + '.prof'))
+
+
+def profileReport(name, limit=25, sortBy='cumulative'):
+    import io
+    with _lock:
+        stats = _profiles.get(name)
+        if stats is None:
+            return ''
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats(sortBy).print_stats(limit)
+    return output.getvalue()
+
+
+def snapshot():
+    with _lock:
+        spans = [dict(name=name, count=calls, totalSeconds=total, meanSeconds=total / calls,
+                      minSeconds=lowest, maxSeconds=highest)
+                 for name, (calls, total, lowest, highest) in sorted(_spans.items())]
+        counters = dict(sorted(_counters.items()))
+    return dict(spans=spans, counters=counters)
+
+
+def exportJson(path):
+    with open(path, 'w') as output:
+        json.dump(snapshot(), output, indent=2)
+
+
+def exportCsv(path):
+    data = snapshot()
+    with open(path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(('kind', 'name', 'count', 'totalSeconds', 'meanSeconds', 'minSeconds', 'maxSeconds'))
+        for stats in data['spans']:
+            writer.writerow(('span', stats['name'], stats['count'], stats['totalSeconds'], stats['meanSeconds'],
+                             stats['minSeconds'], stats['maxSeconds']))
+        for name, value in data['counters'].items():
+            writer.writerow(('counter', name, value, '', '', '', ''))
+
+
+def export(path):
+    if path.lower().endswith('.csv'):
+        exportCsv(path)
+    else:
+        exportJson(path)
+
+
+def configureFromEnvironment(environ=os.environ):
+    # GPX_INSTRUMENT=1 turns spans on; GPX_INSTRUMENT_OUTPUT=stats.json (or
+    # .csv) writes them at exit; GPX_PROFILE=parse,db.insert profiles those
+    # spans, dumping into GPX_PROFILE_DIR when it is set.
+    output = environ.get('GPX_INSTRUMENT_OUTPUT')
+    profile = [name.strip() for name in environ.get('GPX_PROFILE', '').split(',') if name.strip()]
+    if environ.get('GPX_INSTRUMENT', '') not in ('', '0') or output or profile:
+        enable(profile, environ.get('GPX_PROFILE_DIR'))
+        if output:
+            atexit.register(export, output)
+
+
+def configureLogging(level=None, sqlLevel=None):
+    # GPX_LOG_LEVEL=DEBUG shows the parser's per-file messages and
+    # GPX_SQL_LOG_LEVEL=INFO the SQL statements (instead of engine echo).
+    level = level or os.environ.get('GPX_LOG_LEVEL', 'WARNING')
+    sqlLevel = sqlLevel or os.environ.get('GPX_SQL_LOG_LEVEL')
+    logging.basicConfig(level=level.upper() if isinstance(level, str) else level,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if sqlLevel:
+        logging.getLogger('sqlalchemy.engine').setLevel(sqlLevel.upper() if isinstance(sqlLevel, str) else sqlLevel)
+
+
+configureFromEnvironment()
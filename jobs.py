@@ -0,0 +1,132 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _callDirectly(function, *args):
+    function(*args)
+
+
+class Job:
+    # Handle given to a job function as its first argument. The function
+    # should call checkCancelled() (or read `cancelled`) between steps and may
+    # report progress; callbacks always run through the runner's dispatch.
+
+    def __init__(self, runner, key, onDone, onError, onProgress):
+        self.runner = runner
+        self.key = key
+        self.onDone = onDone
+        self.onError = onError
+        self.onProgress = onProgress
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def checkCancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def reportProgress(self, *args):
+        self.checkCancelled()
+        if self.onProgress is not None:
+            self.runner.dispatch(self._deliverProgress, args)
+
+    def _deliverProgress(self, args):
+        if not self.cancelled:
+            self.onProgress(*args)
+
+
+class JobRunner:
+    # Runs blocking work (parsing, queries, decoding) on a thread pool and
+    # hands the results back through `dispatch`, wx.CallAfter by default, so
+    # callbacks execute on the GUI thread. Jobs submitted with the same `key`
+    # coalesce: a newer one cancels the older, and only the newest job's
+    # callbacks are delivered.
+
+    def __init__(self, workers=4, dispatch=None):
+        if dispatch is None:
+            try:
+                import wx
+                dispatch = wx.CallAfter
+            except ImportError:
+                dispatch = _callDirectly
+        self.dispatch = dispatch
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.latest = {}
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, onDone=None, onError=None, onProgress=None, key=None, **kwargs):
+        job = Job(self, key, onDone, onError, onProgress)
+        previous = None
+        with self.lock:
+            if key is not None:
+                previous = self.latest.get(key)
+                self.latest[key] = job
+            self.running.add(job)
+        if previous is not None:
+            previous.cancel()
+        job.future = self.executor.submit(self._run, job, function, args, kwargs)
+        job.future.add_done_callback(lambda future: self._finish(job))
+        return job
+
+    def _run(self, job, function, args, kwargs):
+        try:
+            job.checkCancelled()
+            result = function(job, *args, **kwargs)
+        except JobCancelled:
+            return
+        except Exception as e:
+            if job.onError is not None and self._isCurrent(job):
+                self.dispatch(job.onError, e)
+            else:
+                log.exception('background job failed')
+            return
+        if job.onDone is not None and self._isCurrent(job):
+            self.dispatch(self._deliverDone, job, result)
+
+    def _deliverDone(self, job, result):
+        # re-checked on the GUI thread: a newer job may have been submitted
+        # while this result was queued
+        if self._isCurrent(job):
+            job.onDone(result)
+
+    def _isCurrent(self, job):
+        if job.cancelled:
+            return False
+        with self.lock:
+            return job.key is None or self.latest.get(job.key) is job
+
+    def _finish(self, job):
+        with self.lock:
+            self.running.discard(job)
+            if job.key is not None and self.latest.get(job.key) is job and job.cancelled:
+                del self.latest[job.key]
+
+    def isBusy(self, key=None):
+        with self.lock:
+            return any(key is None or job.key == key for job in self.running)
+
+    def cancel(self, key=None):
+        with self.lock:
+            jobs = [job for job in self.running if key is None or job.key == key]
+        for job in jobs:
+            job.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
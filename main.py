@@ -1,15 +1,20 @@
+import argparse
+import instrument
 import sqlAlch
 from datetime import  datetime
 import MainWindow
-import MapMaker
 
 
 
 if __name__ == '__main__':
-    MapMaker.makeMap()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='recompute the day/week/month/year totals from the tracks and exit')
+    args = parser.parse_args()
+    instrument.configureLogging()
     timeNow = datetime.now()
     sqlAlch.createDb()
-    MainWindow.main()
-
-
-
+    if args.rebuild_rollups:
+        print("%d rollup rows rebuilt" % sqlAlch.rebuildRollups())
+    else:
+        MainWindow.main()
@@ -0,0 +1,43 @@
+import numpy as np
+
+import trackData
+
+EARTH_RADIUS = 6378.137 * 1000
+
+
+def cumulativeDistance(points):
+    # Distance in km from the start of the track to every point (haversine);
+    # `points` is a TrackData or an (n, 2) lat/lon array.
+    points = trackData.asPoints(points)
+    if len(points) == 0:
+        return np.zeros(0)
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    segments = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.concatenate(([0.0], np.cumsum(segments))) / 1000
+
+
+def decimateMinMax(x, y, buckets):
+    # Keeps the minimum and maximum sample of each of `buckets` equal slices,
+    # in their original order, so a line drawn one bucket per pixel looks
+    # the same as the full series but costs O(buckets) to draw.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    buckets = max(int(buckets), 1)
+    if n <= 2 * buckets:
+        return x, y
+    size = -(-n // buckets)
+    rows = -(-n // size)
+    padded = np.full(rows * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(rows, size)
+    valid = ~np.isnan(padded).all(axis=1)
+    padded[~valid] = 0.0
+    offsets = np.arange(rows) * size
+    lowest = offsets + np.nanargmin(padded, axis=1)
+    highest = offsets + np.nanargmax(padded, axis=1)
+    keep = np.unique(np.concatenate((lowest[valid], highest[valid], [0, n - 1])))
+    keep = keep[keep < n]
+    return x[keep], y[keep]
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import sqlAlch
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 512 * 1024 * 1024
+
+
+def sizeOf(value):
+    # Rough byte size of a cached value; arrays and strings dominate.
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return int(nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeOf(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeOf(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class RenderCache:
+    # LRU cache for per-track render artifacts (map scripts, decoded series).
+    # Keys are tuples starting with (kind, trackId, contentHash, ...options).
+    # Entries evicted from memory spill to `directory` when one is given;
+    # that tier is bounded by diskBytes and evicted least recently used too.
+
+    def __init__(self, memoryBytes=DEFAULT_MEMORY_BYTES, directory=None, diskBytes=DEFAULT_DISK_BYTES):
+        self.memoryBytes = memoryBytes
+        self.directory = directory
+        self.diskBytes = diskBytes
+        self.memory = OrderedDict()
+        self.memoryUsed = 0
+        self.disk = OrderedDict()
+        self.diskUsed = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._loadDiskIndex()
+
+    def _loadDiskIndex(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self.disk[path] = size
+            self.diskUsed += size
+
+    def _diskPath(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, '%s-%s.pickle' % (key[1], digest))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key][0]
+            if self.directory is not None:
+                path = self._diskPath(key)
+                if path in self.disk:
+                    try:
+                        with open(path, 'rb') as diskFile:
+                            storedKey, value = pickle.load(diskFile)
+                    except (OSError, pickle.PickleError, EOFError):
+                        storedKey = None
+                    if storedKey == key:
+                        self.disk.move_to_end(path)
+                        try:
+                            os.utime(path)
+                        except OSError:
+                            pass
+                        self.hits += 1
+                        self.diskHits += 1
+                        self._putMemory(key, value, sizeOf(value))
+                        return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            size = sizeOf(value)
+            if key in self.memory:
+                self.memoryUsed -= self.memory.pop(key)[1]
+            self._putMemory(key, value, size)
+        return value
+
+    def _putMemory(self, key, value, size):
+        self.memory[key] = (value, size)
+        self.memoryUsed += size
+        while self.memoryUsed > self.memoryBytes and len(self.memory) > 1:
+            oldKey, (oldValue, oldSize) = self.memory.popitem(last=False)
+            self.memoryUsed -= oldSize
+            self.evictions += 1
+            self._spill(oldKey, oldValue)
+
+    def _spill(self, key, value):
+        if self.directory is None:
+            return
+        path = self._diskPath(key)
+        if path in self.disk:
+            self.disk.move_to_end(path)
+            return
+        try:
+            with open(path, 'wb') as diskFile:
+                pickle.dump((key, value), diskFile, pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.disk[path] = size
+        self.diskUsed += size
+        while self.diskUsed > self.diskBytes and self.disk:
+            oldPath, oldSize = self.disk.popitem(last=False)
+            self.diskUsed -= oldSize
+            self._remove(oldPath)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def getOrCreate(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, factory())
+        return value
+
+    def invalidate(self, trackId):
+        with self.lock:
+            for key in [key for key in self.memory if key[1] == trackId]:
+                self.memoryUsed -= self.memory.pop(key)[1]
+            prefix = os.path.join(self.directory, '%s-' % trackId) if self.directory is not None else None
+            for path in [path for path in self.disk if prefix and path.startswith(prefix)]:
+                self.diskUsed -= self.disk.pop(path)
+                self._remove(path)
+
+    def onTrackChanged(self, event, trackId):
+        self.invalidate(trackId)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memoryUsed = 0
+            for path in list(self.disk):
+                self._remove(path)
+            self.disk.clear()
+            self.diskUsed = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, diskHits=self.diskHits, misses=self.misses,
+                        hitRate=self.hits / lookups if lookups else 0.0, evictions=self.evictions,
+                        memoryEntries=len(self.memory), memoryBytes=self.memoryUsed,
+                        diskEntries=len(self.disk), diskBytes=self.diskUsed)
+
+
+trackCache = RenderCache(directory=os.environ.get('GPX_CACHE_DIR'))
+sqlAlch.addTrackListener(trackCache.onTrackChanged)
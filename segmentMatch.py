@@ -0,0 +1,139 @@
+import math
+
+import numpy as np
+
+import instrument
+import spatialIndex
+import trackAnalytics
+
+EARTH_RADIUS = 6378.137 * 1000
+
+# An effort starts (ends) where the track passes closest to the segment's
+# first (last) point, if that pass comes within ENDPOINT_RADIUS metres.
+ENDPOINT_RADIUS = 25.0
+# Between start and end the effort must follow the segment: every point of
+# the segment within CORRIDOR metres of the track, at least MIN_ON_ROUTE of
+# the track points within CORRIDOR of the segment and a comparable length.
+CORRIDOR = 40.0
+MIN_ON_ROUTE = 0.9
+LENGTH_RATIO = (0.8, 1.25)
+# segment points compared per effort
+ALIGN_SAMPLES = 100
+
+
+def localMeters(points, origin):
+    # Equirectangular projection around `origin` (lat, lon).
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    scale = math.radians(1) * EARTH_RADIUS
+    return np.column_stack(((points[:, 1] - origin[1]) * math.cos(math.radians(origin[0])) * scale,
+                            (points[:, 0] - origin[0]) * scale))
+
+
+def pathLength(xy):
+    return float(np.hypot(*np.diff(xy, axis=0).T).sum()) if len(xy) > 1 else 0.0
+
+
+def resample(xy, samples=ALIGN_SAMPLES):
+    # `samples` points spread evenly along the polyline.
+    if len(xy) < 2:
+        return xy
+    cumulative = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+    if cumulative[-1] == 0:
+        return xy[:1]
+    at = np.linspace(0.0, cumulative[-1], samples)
+    return np.column_stack((np.interp(at, cumulative, xy[:, 0]), np.interp(at, cumulative, xy[:, 1])))
+
+
+def polylineDistances(xy, line):
+    # Distance of every row of xy to the polyline `line`, all pairs at once.
+    if len(line) == 1:
+        return np.hypot(*(xy - line[0]).T)
+    a = line[:-1][None, :, :]
+    ab = np.diff(line, axis=0)[None, :, :]
+    ap = xy[:, None, :] - a
+    lengthSq = (ab ** 2).sum(axis=2)
+    dot = (ap * ab).sum(axis=2)
+    t = np.clip(np.divide(dot, lengthSq, out=np.zeros_like(dot), where=lengthSq > 0), 0.0, 1.0)
+    offset = ap - ab * t[..., None]
+    return np.sqrt((offset ** 2).sum(axis=2)).min(axis=1)
+
+
+def passes(distance, radius):
+    # (first, last, closest) index of every run of points within radius.
+    inside = distance <= radius
+    if not inside.any():
+        return []
+    edges = np.diff(np.concatenate(([0], inside.astype(np.int8), [0])))
+    firsts = np.flatnonzero(edges == 1)
+    lasts = np.flatnonzero(edges == -1) - 1
+    return [(first, last, first + int(np.argmin(distance[first:last + 1]))) for first, last in zip(firsts, lasts)]
+
+
+def endpointCells(segment):
+    # [(cell, 'start' | 'end')] for the 3x3 cells around both ends: a track
+    # that passes an end has an indexed cell among them (see trackCells).
+    segment = np.asarray(segment, dtype=float).reshape(-1, 2)
+    cells = []
+    for endpoint, (lat, lon) in (('start', segment[0]), ('end', segment[-1])):
+        row = int(spatialIndex.cellRow(lat))
+        column = int(spatialIndex.cellColumn(lon))
+        cells.extend(((row + dRow) * spatialIndex.CELLS_PER_ROW + column + dColumn, endpoint)
+                     for dRow in (-1, 0, 1) for dColumn in (-1, 0, 1))
+    return cells
+
+
+def follows(segmentXY, effortXY, segmentLength):
+    effortLength = pathLength(effortXY)
+    if segmentLength > 0 and not LENGTH_RATIO[0] <= effortLength / segmentLength <= LENGTH_RATIO[1]:
+        return False
+    samples = resample(segmentXY)
+    if polylineDistances(samples, effortXY).max() > CORRIDOR:
+        return False
+    return (polylineDistances(effortXY, samples) <= CORRIDOR).mean() >= MIN_ON_ROUTE
+
+
+def effortStats(points, startIndex, endIndex, times=None, hr=None):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)[startIndex:endIndex + 1]
+    distance = float(trackAnalytics.segmentDistances(points[:, 0], points[:, 1]).sum()) / 1000
+    elapsedTime = avgSpeed = avgHr = None
+    if times is not None and len(times) > endIndex:
+        elapsed = float(times[endIndex] - times[startIndex])
+        if not math.isnan(elapsed):
+            elapsedTime = elapsed
+            avgSpeed = distance / elapsed * 3600 if elapsed > 0 else None
+    if hr is not None and len(hr) > endIndex:
+        avgHr = float(np.mean(hr[startIndex:endIndex + 1]))
+    return dict(startIndex=int(startIndex), endIndex=int(endIndex), distance=distance,
+                elapsedTime=elapsedTime, avgSpeed=avgSpeed, avgHr=avgHr)
+
+
+@instrument.timed('segments.match')
+def matchSegment(segment, points, times=None, hr=None):
+    # Every effort on `segment` within the track, as effortStats() dicts in
+    # track order. A track riding the segment several times (laps) gives
+    # several efforts; riding it backwards gives none.
+    segment = np.asarray(segment, dtype=float).reshape(-1, 2)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(segment) < 2 or len(points) < 2:
+        return []
+    origin = segment[0]
+    segmentXY = localMeters(segment, origin)
+    xy = localMeters(points, origin)
+    starts = passes(np.hypot(*(xy - segmentXY[0]).T), ENDPOINT_RADIUS)
+    ends = passes(np.hypot(*(xy - segmentXY[-1]).T), ENDPOINT_RADIUS)
+    segmentLength = pathLength(segmentXY)
+    efforts = []
+    endAt = 0
+    for number, (first, last, start) in enumerate(starts):
+        if start < endAt:
+            continue
+        end = next((closest for endFirst, endLast, closest in ends if endFirst > last), None)
+        if end is None:
+            break
+        # a later pass through the start before reaching the end is tighter
+        if number + 1 < len(starts) and starts[number + 1][2] < end:
+            continue
+        if follows(segmentXY, xy[start:end + 1], segmentLength):
+            efforts.append(effortStats(points, start, end, times, hr))
+            endAt = end
+    return efforts
@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+import trackSimplify
+
+EARTH_RADIUS = 6378.137 * 1000
+
+# Grid used by the trackCells table: 0.01 degree cells (about 1.1 x 0.65 km
+# at 54N), numbered row by row from (-90, -180).
+CELL_DEGREES = 0.01
+CELLS_PER_ROW = int(round(360 / CELL_DEGREES))
+
+# Box queries covering more cells than this skip the cell filter and rely
+# on the R*Tree bounds alone.
+MAX_QUERY_CELLS = 4096
+# Every grid row is one BETWEEN in an OR chain, and SQLite refuses
+# expressions deeper than 1000, so tall boxes fall back the same way.
+MAX_QUERY_ROWS = 256
+
+
+def trackBounds(points):
+    # (minLat, maxLat, minLon, maxLon)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    lowest = points.min(axis=0)
+    highest = points.max(axis=0)
+    return float(lowest[0]), float(highest[0]), float(lowest[1]), float(highest[1])
+
+
+def cellRow(lat, cellDegrees=CELL_DEGREES):
+    return np.floor((np.asarray(lat, dtype=float) + 90.0) / cellDegrees).astype(np.int64)
+
+
+def cellColumn(lon, cellDegrees=CELL_DEGREES):
+    return np.floor((np.asarray(lon, dtype=float) + 180.0) / cellDegrees).astype(np.int64)
+
+
+def densify(points, step):
+    # Adds points along segments longer than `step` degrees on either axis,
+    # so a track sampled every few minutes still marks the cells between.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        return points
+    delta = np.diff(points, axis=0)
+    steps = np.maximum(np.ceil(np.abs(delta).max(axis=1) / step), 1).astype(np.intp)
+    if steps.max() == 1:
+        return points
+    offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+    fractions = offsets / np.repeat(steps, steps)
+    dense = np.repeat(points[:-1], steps, axis=0) + np.repeat(delta, steps, axis=0) * fractions[:, None]
+    return np.vstack((dense, points[-1:]))
+
+
+def trackCells(points, cellDegrees=CELL_DEGREES):
+    # Sorted ids of the grid cells the track's points fall in. Consecutive
+    # points are at most one cell apart after densify(), so every cell the
+    # track crosses is either listed or next to a listed one; queries make
+    # up for that by widening their cell range by one (see queryCellRanges).
+    points = densify(points, cellDegrees)
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(cellRow(points[:, 0], cellDegrees) * CELLS_PER_ROW + cellColumn(points[:, 1], cellDegrees))
+
+
+def queryCellRanges(minLat, maxLat, minLon, maxLon, cellDegrees=CELL_DEGREES, maxCells=MAX_QUERY_CELLS,
+                    maxRows=MAX_QUERY_ROWS):
+    # [(firstCell, lastCell)] per grid row covering the box plus one cell on
+    # every side, or None when that is more than maxCells cells or maxRows
+    # rows.
+    firstRow, lastRow = int(cellRow(minLat, cellDegrees)) - 1, int(cellRow(maxLat, cellDegrees)) + 1
+    firstColumn, lastColumn = int(cellColumn(minLon, cellDegrees)) - 1, int(cellColumn(maxLon, cellDegrees)) + 1
+    rows = lastRow - firstRow + 1
+    if rows > maxRows or rows * (lastColumn - firstColumn + 1) > maxCells:
+        return None
+    return [(row * CELLS_PER_ROW + firstColumn, row * CELLS_PER_ROW + lastColumn)
+            for row in range(firstRow, lastRow + 1)]
+
+
+def radiusBox(lat, lon, radius):
+    # Box around a point that contains everything within `radius` metres.
+    dLat = math.degrees(radius / EARTH_RADIUS)
+    dLon = dLat / max(math.cos(math.radians(min(abs(lat) + dLat, 89.9))), 1e-6)
+    return lat - dLat, lat + dLat, lon - dLon, lon + dLon
+
+
+def intersectsBox(points, minLat, maxLat, minLon, maxLon):
+    # True when a point lies in the box or a segment crosses it
+    # (Liang-Barsky clipping for all segments at once).
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return False
+    lat, lon = points[:, 0], points[:, 1]
+    if ((lat >= minLat) & (lat <= maxLat) & (lon >= minLon) & (lon <= maxLon)).any():
+        return True
+    if len(points) < 2:
+        return False
+    start = points[:-1]
+    delta = np.diff(points, axis=0)
+    enter = np.zeros(len(delta))
+    leave = np.ones(len(delta))
+    rejected = np.zeros(len(delta), dtype=bool)
+    for p, q in ((-delta[:, 1], start[:, 1] - minLon), (delta[:, 1], maxLon - start[:, 1]),
+                 (-delta[:, 0], start[:, 0] - minLat), (delta[:, 0], maxLat - start[:, 0])):
+        rejected |= (p == 0) & (q < 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        enter = np.where(p < 0, np.maximum(enter, r), enter)
+        leave = np.where(p > 0, np.minimum(leave, r), leave)
+    return bool((~rejected & (enter <= leave)).any())
+
+
+def distanceToTrack(points, lat, lon):
+    # Shortest distance in metres from (lat, lon) to the track's polyline,
+    # on an equirectangular projection centred on the query point.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return math.inf
+    scale = math.radians(1) * EARTH_RADIUS
+    xy = np.column_stack(((points[:, 1] - lon) * math.cos(math.radians(lat)) * scale,
+                          (points[:, 0] - lat) * scale))
+    if len(xy) == 1:
+        return float(np.hypot(xy[0, 0], xy[0, 1]))
+    origin = np.zeros((len(xy) - 1, 2))
+    return float(trackSimplify.segmentDistances(origin, xy[:-1], xy[1:]).min())
@@ -1,128 +1,1210 @@
-from sqlalchemy import create_engine,inspect, select
-from sqlalchemy import Column, Table, Integer, String, MetaData, REAL, DATETIME
-from sqlalchemy import and_
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy import Column, Table, Integer, String, MetaData, REAL, DATE, DATETIME, LargeBinary
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy import and_, or_, func, bindparam
 from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqliteInsert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+import instrument
+import trackCodec
+import json
+
+log = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get('GPX_DB_PATH', 'sqlDb.db')
+
+# Connection pragmas applied to every new SQLite connection: WAL lets the UI
+# read while an import writes, the rest trade a little durability for speed.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', '-20000'),
+    ('mmap_size', '268435456'),
+)
+
+# Bumped whenever createDb() gains a migration step; stored in the database
+# as PRAGMA user_version so an up to date file skips all schema work.
+SCHEMA_VERSION = 7
+
+_engine = None
+
+# Callables notified as listener(event, trackId) after a track is inserted
+# ('insert') or deleted ('delete'); caches use this to drop stale entries.
+_trackListeners = []
+
+metadata = MetaData()
+
+usersTable = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+    Column('password', String),
+)
+
+# Narrow summary rows, cheap to list and sort; the point payloads live in
+# trackPayloads and are only read when a single track is opened.
+tracksTable = Table(
+    'tracks', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user', String, nullable=False),
+    Column('date', DATETIME),
+    Column('avgSpeed', REAL),
+    Column('distance', REAL),
+    Column('avgHr', REAL),
+    Column('rideTime', String),
+    Column('pointCount', Integer),
+    Column('contentHash', String),
+    Column('movingTime', REAL),
+    Column('elevationGain', REAL),
+    Column('elevationLoss', REAL),
+    Column('maxSpeed', REAL),
+    Column('analytics', String),
+    Index('ix_tracks_user_date', 'user', 'date'),
+    Index('ix_tracks_user_distance', 'user', 'distance'),
+    Index('ix_tracks_user_rideTime', 'user', 'rideTime'),
+    Index('ix_tracks_user_avgSpeed', 'user', 'avgSpeed'),
+    Index('ix_tracks_user_avgHr', 'user', 'avgHr'),
+)
+
+trackPayloadsTable = Table(
+    'trackPayloads', metadata,
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='CASCADE'), primary_key=True),
+    Column('points', LargeBinary),
+    Column('hr', LargeBinary),
+    Column('elevation', LargeBinary),
+    Column('time', LargeBinary),
+    Column('speed', LargeBinary),
+)
+
+# Douglas-Peucker simplified copies of the points, one row per tolerance
+# (see trackSimplify.LOD_TOLERANCES), used by the map instead of the full track.
+trackLevelsTable = Table(
+    'trackLevels', metadata,
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='CASCADE'), primary_key=True),
+    Column('tolerance', REAL, primary_key=True),
+    Column('pointCount', Integer),
+    Column('points', LargeBinary),
+)
+
+# Grid cells every track passes through (spatialIndex.trackCells), the fine
+# filter for location queries after the bounding boxes in trackBounds.
+trackCellsTable = Table(
+    'trackCells', metadata,
+    Column('cell', Integer, primary_key=True),
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_trackCells_trackId', 'trackId'),
+)
+
+# User defined stretches of road (cut from a stored track) and every effort
+# on them. segmentCells holds the grid cells around both ends of a segment;
+# joined with trackCells it finds the tracks that may contain an effort.
+segmentsTable = Table(
+    'segments', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user', String, nullable=False),
+    Column('name', String),
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='SET NULL')),
+    Column('distance', REAL),
+    Column('pointCount', Integer),
+    Column('points', LargeBinary),
+    Index('ix_segments_user', 'user'),
+)
+
+segmentCellsTable = Table(
+    'segmentCells', metadata,
+    Column('cell', Integer, primary_key=True),
+    Column('segmentId', Integer, ForeignKey('segments.id', ondelete='CASCADE'), primary_key=True),
+    Column('endpoint', String, primary_key=True),
+    Index('ix_segmentCells_segmentId', 'segmentId'),
+)
+
+segmentEffortsTable = Table(
+    'segmentEfforts', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('segmentId', Integer, ForeignKey('segments.id', ondelete='CASCADE'), nullable=False),
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='CASCADE'), nullable=False),
+    Column('startIndex', Integer),
+    Column('endIndex', Integer),
+    Column('distance', REAL),
+    Column('elapsedTime', REAL),
+    Column('avgSpeed', REAL),
+    Column('avgHr', REAL),
+    Index('ix_segmentEfforts_segment_time', 'segmentId', 'elapsedTime'),
+    Index('ix_segmentEfforts_trackId', 'trackId'),
+)
+
+# What makes two imports the same track (see trackFingerprint): the hash of
+# the coordinates, or start time + point count + bounding box. headHash
+# lets a bulk import pick the files that may be known after reading their
+# first points.
+trackFingerprintsTable = Table(
+    'trackFingerprints', metadata,
+    Column('trackId', Integer, ForeignKey('tracks.id', ondelete='CASCADE'), primary_key=True),
+    Column('user', String, nullable=False),
+    Column('pointsHash', String, nullable=False),
+    Column('headHash', String),
+    Column('signature', String),
+    Index('ux_trackFingerprints_points', 'user', 'pointsHash', unique=True),
+    Index('ux_trackFingerprints_signature', 'user', 'signature', unique=True),
+    Index('ix_trackFingerprints_head', 'user', 'headHash'),
+)
+
+# Running totals per user and calendar day/week/month/year, kept in step by
+# insertGpxTracks() and deleteSelectedTrack() so summaries never read the
+# tracks themselves. `start` is the first day of the period (weeks start on
+# Monday); hrZone0-5 are seconds per trackAnalytics.hrZones() zone.
+ROLLUP_PERIODS = ('day', 'week', 'month', 'year')
+HR_ZONE_COLUMNS = ['hrZone%d' % zone for zone in range(6)]
+ROLLUP_VALUES = ['rideCount', 'distance', 'movingTime', 'elevationGain'] + HR_ZONE_COLUMNS
+
+rollupsTable = Table(
+    'rollups', metadata,
+    Column('user', String, primary_key=True),
+    Column('period', String, primary_key=True),
+    Column('start', DATE, primary_key=True),
+    Column('rideCount', Integer, nullable=False),
+    Column('distance', REAL, nullable=False),
+    Column('movingTime', REAL, nullable=False),
+    Column('elevationGain', REAL, nullable=False),
+    *[Column(name, REAL, nullable=False) for name in HR_ZONE_COLUMNS]
+)
+
+# Rides through every heatmap bin per user at the heatmap.HEAT_LEVELS
+# zooms, one row per 256 x 256 bin tile: `cells` packs the bins some ride
+# passed with their ride counts (heatmap.packCells). Drawing a map tile reads
+# one row however many rides there are; insertGpxTracks() and
+# deleteSelectedTrack() rewrite only the tiles of that ride.
+heatTilesTable = Table(
+    'heatTiles', metadata,
+    Column('user', String, primary_key=True),
+    Column('level', Integer, primary_key=True),
+    Column('tile', Integer, primary_key=True),
+    Column('cellCount', Integer, nullable=False),
+    Column('cells', LargeBinary, nullable=False),
+)
+
+# Per-track bounding boxes. This is an SQLite R*Tree virtual table, so it is
+# created by createSpatialTables() instead of create_all(), and rows have to
+# be deleted by hand (foreign keys do not apply to virtual tables).
+spatialMetadata = MetaData()
+
+trackBoundsTable = Table(
+    'trackBounds', spatialMetadata,
+    Column('id', Integer, primary_key=True),
+    Column('minLat', REAL),
+    Column('maxLat', REAL),
+    Column('minLon', REAL),
+    Column('maxLon', REAL),
+    Index('ix_trackBounds_lat', 'minLat', 'maxLat'),
+)
+
+SUMMARY_COLUMNS = [tracksTable.c.id, tracksTable.c.user, tracksTable.c.date, tracksTable.c.avgSpeed,
+                   tracksTable.c.distance, tracksTable.c.avgHr, tracksTable.c.rideTime,
+                   tracksTable.c.pointCount, tracksTable.c.contentHash, tracksTable.c.movingTime,
+                   tracksTable.c.elevationGain, tracksTable.c.elevationLoss, tracksTable.c.maxSpeed,
+                   tracksTable.c.analytics]
+# What the track list shows, and the columns it can sort on. Every sort
+# column has a (user, column) index, which also holds the id, so a user's
+# ids come out in list order without reading the table.
+LIST_COLUMNS = [tracksTable.c.id, tracksTable.c.date, tracksTable.c.distance, tracksTable.c.rideTime,
+                tracksTable.c.avgSpeed, tracksTable.c.avgHr]
+LIST_SORT_COLUMNS = dict((column.name, column) for column in LIST_COLUMNS[1:])
+PAYLOAD_COLUMNS = [trackPayloadsTable.c.points, trackPayloadsTable.c.hr, trackPayloadsTable.c.elevation,
+                   trackPayloadsTable.c.time, trackPayloadsTable.c.speed]
+
+# Pre-split schema, kept only so createDb() can move old rows over. The
+# payload columns are untyped because they hold JSON text or packed blobs
+# depending on the age of the database.
+legacyMetadata = MetaData()
+
+gpxTracksTable = Table(
+    'gpxTracks', legacyMetadata,
+    Column('id', Integer, primary_key=True),
+    Column('user', String),
+    Column('avgSpeed', REAL),
+    Column('distance', REAL),
+    Column('avgHr', REAL),
+    Column('date', DATETIME),
+    Column('rideTime', String),
+    Column('points'),
+    Column('hr'),
+    Column('elevation'),
+)
+
+
+def configure(dbPath=None, echo=False):
+    # Point the module at another database file; the next call to getEngine()
+    # builds a fresh engine for it.
+    global DB_PATH, _engine
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+    if dbPath is not None:
+        DB_PATH = dbPath
+    getEngine(echo)
+
+
+def getEngine(echo=False):
+    global _engine
+    if _engine is None:
+        _engine = create_engine("sqlite:///" + DB_PATH, echo=echo, poolclass=QueuePool,
+                                connect_args={'check_same_thread': False})
+        event.listen(_engine, 'connect', _setPragmas)
+    return _engine
+
+
+def _setPragmas(dbapiConnection, connectionRecord):
+    cursor = dbapiConnection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA %s=%s' % (name, value))
+    cursor.close()
+
+
+@contextmanager
+def transaction():
+    # One connection and one COMMIT for everything done inside the block;
+    # the connection can be passed as `conn` to the functions below. Track
+    # listeners hear of the inserts and deletes made in it after the COMMIT,
+    # and not at all when it is rolled back.
+    events = []
+    with getEngine().begin() as conn:
+        conn.info['trackEvents'] = events
+        try:
+            yield conn
+        finally:
+            del conn.info['trackEvents']
+    for change, trackId in events:
+        _notifyTrackListeners(change, trackId)
+
+
+@contextmanager
+def _connection(conn):
+    if conn is not None:
+        yield conn
+    else:
+        with transaction() as conn:
+            yield conn
+
+
+def addTrackListener(listener):
+    if listener not in _trackListeners:
+        _trackListeners.append(listener)
+
+
+def removeTrackListener(listener):
+    if listener in _trackListeners:
+        _trackListeners.remove(listener)
+
+
+def _notifyTrackListeners(event, trackId):
+    for listener in list(_trackListeners):
+        listener(event, trackId)
+
+
+def _trackChanged(conn, event, trackId):
+    # Queues the event on the transaction() `conn` belongs to
+    events = conn.info.get('trackEvents')
+    if events is None:
+        raise ValueError('track changes need a connection from sqlAlch.transaction()')
+    events.append((event, trackId))
 
 
 def createDb():
-    engine = create_engine("sqlite:///sqlDb.db", echo=True)
-    insp = inspect(engine)
-    meta = MetaData()
-    if not insp.has_table('users'):
-        users = Table(
-            'users',meta,
-            Column('id',Integer, primary_key=True),
-            Column('name',String),
-            Column('password',String),
-        )
-
-        gpxTracks = Table(
-            'gpxTracks',meta,
-            Column('id',Integer,primary_key=True),
-            Column('user',String),
-            Column('avgSpeed',REAL),
-            Column('distance',REAL),
-            Column('avgHr',REAL),
-            Column('date',DATETIME),
-            Column('rideTime',String),
-            Column('points', String),
-            Column('hr', String),
-            Column('elevation', String),
-
-        )
-        meta.create_all(engine)
-
-
-def insertUser(name,password):
-    engine = create_engine("sqlite:///sqlDb.db",echo=False)
-    metadata = MetaData()
-    userstable = Table('users', metadata, autoload=True, autoload_with=engine)
-    userIns = userstable.insert().values(name = name, password=password)
-    results = engine.execute(userIns)
-
-
-
-def insertGpxTrack(username,avgSpeed,distance,avgHr,date,rideTime,points,hr,elevation):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    gpxTracksTable = Table('gpxTracks', metadata, autoload=True, autoload_with=engine)
-    trackInsert = gpxTracksTable.insert().values(user=username,
-                                                 avgSpeed=avgSpeed, distance=distance, avgHr=avgHr,
-                                                 date=date, rideTime=rideTime, points=points, hr=hr,
-                                                 elevation=elevation)
-    results = engine.execute(trackInsert)
+    with getEngine().connect() as conn:
+        if conn.exec_driver_sql('PRAGMA user_version').scalar() == SCHEMA_VERSION:
+            return
+    metadata.create_all(getEngine())
+    createSpatialTables()
+    upgradeSchema()
+    migrateLegacyTracks()
+    buildMissingLevels()
+    buildMissingSpatialIndex()
+    buildMissingFingerprints()
+    buildMissingContentHashes()
+    buildMissingAnalytics()
+    buildMissingHeatmap()
+    rebuildRollups()
+    with transaction() as conn:
+        conn.exec_driver_sql('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+
+def upgradeSchema():
+    # create_all() only adds missing tables; add the columns and indexes
+    # introduced since an existing database was created.
+    insp = inspect(getEngine())
+    with transaction() as conn:
+        for table in metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = set(column['name'] for column in insp.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (
+                        table.name, column.name, column.type.compile(dialect=conn.dialect)))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def createSpatialTables():
+    with transaction() as conn:
+        try:
+            conn.exec_driver_sql('CREATE VIRTUAL TABLE IF NOT EXISTS trackBounds '
+                                 'USING rtree(id, minLat, maxLat, minLon, maxLon)')
+        except OperationalError:
+            # SQLite built without the R*Tree module: same columns, plain index
+            log.warning('SQLite has no rtree module, using an ordinary trackBounds table')
+    if not inspect(getEngine()).has_table('trackBounds'):
+        spatialMetadata.create_all(getEngine())
+
+
+def migrateLegacyTracks(batchSize=500):
+    # Move rows of the old single gpxTracks table into tracks/trackPayloads,
+    # keeping their ids, then drop it. Payloads still stored as json.dumps()
+    # text are packed with trackCodec on the way.
+    if not inspect(getEngine()).has_table('gpxTracks'):
+        return 0
+    query = select(gpxTracksTable).order_by(gpxTracksTable.c.id)
+    moved = 0
+    with transaction() as conn:
+        results = conn.execute(query)
+        while True:
+            rows = results.fetchmany(batchSize)
+            if not rows:
+                break
+            for row in rows:
+                points, hr, elevation = row.points, row.hr, row.elevation
+                if not trackCodec.isPacked(points):
+                    points = trackCodec.encodePoints(trackCodec.decodeJson(points))
+                    hr = trackCodec.encodeSeries(trackCodec.decodeJson(hr))
+                    elevation = trackCodec.encodeSeries(trackCodec.decodeJson(elevation))
+                conn.execute(tracksTable.insert().values(
+                    id=row.id, user=row.user, date=row.date, avgSpeed=row.avgSpeed, distance=row.distance,
+                    avgHr=row.avgHr, rideTime=row.rideTime, pointCount=trackCodec.count(points),
+                    contentHash=trackCodec.contentHash(points, hr, elevation)))
+                conn.execute(trackPayloadsTable.insert().values(
+                    trackId=row.id, points=points, hr=hr, elevation=elevation))
+            moved += len(rows)
+        gpxTracksTable.drop(conn)
+    if moved:
+        with getEngine().connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+    return moved
+
+
+def buildMissingLevels(batchSize=100):
+    # Tracks imported before levels of detail existed get them computed once.
+    query = select(trackPayloadsTable.c.trackId, trackPayloadsTable.c.points).where(
+        ~trackPayloadsTable.c.trackId.in_(select(trackLevelsTable.c.trackId))).limit(batchSize)
+    built = 0
+    while True:
+        with transaction() as conn:
+            rows = conn.execute(query).fetchall()
+            for row in rows:
+                insertLevels(row.trackId, _buildLevels(row.points), conn)
+        built += len(rows)
+        if len(rows) < batchSize:
+            return built
+
+
+def buildMissingContentHashes(batchSize=500):
+    query = select(tracksTable.c.id, *PAYLOAD_COLUMNS).join_from(
+        tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+        tracksTable.c.contentHash.is_(None)).limit(batchSize)
+    built = 0
+    while True:
+        with transaction() as conn:
+            rows = conn.execute(query).fetchall()
+            for row in rows:
+                conn.execute(tracksTable.update().where(tracksTable.c.id == row.id).values(
+                    contentHash=trackCodec.contentHash(row.points, row.hr, row.elevation)))
+        built += len(rows)
+        if len(rows) < batchSize:
+            return built
+
+
+def buildMissingSpatialIndex(batchSize=200):
+    # Tracks imported before the spatial index existed.
+    lastId = 0
+    built = 0
+    while True:
+        query = select(trackPayloadsTable.c.trackId, trackPayloadsTable.c.points).where(
+            trackPayloadsTable.c.trackId > lastId,
+            ~trackPayloadsTable.c.trackId.in_(select(trackBoundsTable.c.id))).order_by(
+            trackPayloadsTable.c.trackId).limit(batchSize)
+        with transaction() as conn:
+            rows = conn.execute(query).fetchall()
+            for row in rows:
+                insertSpatialIndex(row.trackId, row.points, conn)
+        built += len(rows)
+        if len(rows) < batchSize:
+            return built
+        lastId = rows[-1].trackId
+
+
+def buildMissingFingerprints(batchSize=200):
+    # Fingerprints for tracks stored before they existed. A track that turns
+    # out to duplicate an earlier one keeps its data but gets no fingerprint.
+    lastId = 0
+    built = duplicates = 0
+    while True:
+        query = select(tracksTable.c.id, tracksTable.c.user, tracksTable.c.date, trackPayloadsTable.c.points,
+                       trackPayloadsTable.c.time).join_from(
+            tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+            tracksTable.c.id > lastId, ~tracksTable.c.id.in_(select(trackFingerprintsTable.c.trackId))).order_by(
+            tracksTable.c.id).limit(batchSize)
+        with transaction() as conn:
+            rows = conn.execute(query).fetchall()
+            for row in rows:
+                fingerprint = fingerprintStoredTrack(row.points, row.time, row.date)
+                result = conn.execute(trackFingerprintsTable.insert().prefix_with('OR IGNORE').values(
+                    trackId=row.id, user=row.user, **fingerprint))
+                duplicates += result.rowcount == 0
+        built += len(rows)
+        if len(rows) < batchSize:
+            break
+        lastId = rows[-1].id
+    if duplicates:
+        log.warning('%d stored tracks duplicate earlier ones', duplicates)
+    return built
+
+
+def fingerprintStoredTrack(points, times, date):
+    import trackFingerprint
+    return trackFingerprint.fingerprint(trackCodec.decode(points), _decodeOptional(times), date)
+
+
+def findTrackByFingerprint(user, fingerprint, conn=None):
+    # Id of a stored track of `user` with the same points or signature.
+    fingerprints = trackFingerprintsTable.c
+    same = fingerprints.pointsHash == fingerprint['pointsHash']
+    if fingerprint['signature'] is not None:
+        same = or_(same, fingerprints.signature == fingerprint['signature'])
+    query = select(fingerprints.trackId).where(fingerprints.user == user, same).limit(1)
+    with _connection(conn) as conn:
+        return conn.execute(query).scalar()
+
+
+def getHeadFingerprints(user):
+    # {headHash: [(pointsHash, signature)]} of the user's stored tracks
+    fingerprints = trackFingerprintsTable.c
+    query = select(fingerprints.headHash, fingerprints.pointsHash, fingerprints.signature).where(
+        fingerprints.user == user, fingerprints.headHash.isnot(None))
+    known = {}
+    with _connection(None) as conn:
+        for row in conn.execute(query):
+            known.setdefault(row.headHash, []).append((row.pointsHash, row.signature))
+    return known
+
+
+def analyticsColumns(analytics):
+    # tracks columns for a trackAnalytics.analyse() result; the nested parts
+    # are kept as JSON in `analytics`.
+    if analytics is None:
+        return {}
+    extra = dict(elapsedTime=analytics['elapsedTime'], movingSpeed=analytics['movingSpeed'],
+                 bestEfforts=analytics['bestEfforts'], hrZones=analytics['hrZones'])
+    return dict(movingTime=analytics['movingTime'], elevationGain=analytics['elevationGain'],
+                elevationLoss=analytics['elevationLoss'], maxSpeed=analytics['maxSpeed'],
+                analytics=json.dumps(extra))
+
+
+def _buildLevels(points):
+    import trackSimplify
+    return trackSimplify.buildLevels(trackCodec.decode(points))
+
+
+def analyseStoredTrack(points, elevation, hr, times=None):
+    import trackAnalytics
+    points = trackCodec.decode(points).reshape(-1, 2)
+    if times is not None:
+        times = trackCodec.decode(times)
+    return trackAnalytics.analyse(points[:, 0], points[:, 1], trackCodec.decode(elevation), times,
+                                  trackCodec.decode(hr))
+
+
+def buildMissingAnalytics(batchSize=100):
+    # Tracks imported before analytics existed have no timestamps stored, so
+    # only the distance based figures can be filled in for them.
+    query = select(tracksTable.c.id, *PAYLOAD_COLUMNS).join_from(
+        tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+        tracksTable.c.analytics.is_(None)).limit(batchSize)
+    built = 0
+    while True:
+        with transaction() as conn:
+            rows = conn.execute(query).fetchall()
+            for row in rows:
+                analytics = analyseStoredTrack(row.points, row.elevation, row.hr, row.time)
+                conn.execute(tracksTable.update().where(tracksTable.c.id == row.id).values(
+                    **analyticsColumns(analytics)))
+        built += len(rows)
+        if len(rows) < batchSize:
+            return built
+
+
+def iterStoredTracks(user=None, batchSize=200):
+    # Summary and payload rows in id order, read batchSize at a time on short
+    # transactions so a caller can write between batches.
+    lastId = 0
+    while True:
+        query = select(*SUMMARY_COLUMNS, *PAYLOAD_COLUMNS).join_from(
+            tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+            tracksTable.c.id > lastId).order_by(tracksTable.c.id).limit(batchSize)
+        if user is not None:
+            query = query.where(tracksTable.c.user == user)
+        with _connection(None) as conn:
+            rows = [row._asdict() for row in conn.execute(query)]
+        for row in rows:
+            yield row
+        if len(rows) < batchSize:
+            return
+        lastId = rows[-1]['id']
+
+
+def storeRecomputed(trackId, user, analytics=None, levels=None, fingerprint=None, conn=None):
+    # Replaces whichever derived data was recomputed for a stored track. A
+    # fingerprint that now collides with another track's is dropped, as in
+    # buildMissingFingerprints(). Rollups are left to rebuildRollups().
+    with _connection(conn) as conn:
+        if analytics is not None:
+            conn.execute(tracksTable.update().where(tracksTable.c.id == trackId).values(
+                **analyticsColumns(analytics)))
+        if levels is not None:
+            conn.execute(delete(trackLevelsTable).where(trackLevelsTable.c.trackId == trackId))
+            insertLevels(trackId, levels, conn)
+        if fingerprint is not None:
+            conn.execute(delete(trackFingerprintsTable).where(trackFingerprintsTable.c.trackId == trackId))
+            conn.execute(trackFingerprintsTable.insert().prefix_with('OR IGNORE').values(
+                trackId=trackId, user=user, **fingerprint))
+
+
+def insertLevels(trackId, levels, conn=None):
+    rows = [dict(trackId=trackId, tolerance=tolerance, pointCount=trackCodec.count(points), points=points)
+            for tolerance, points in levels.items()]
+    with _connection(conn) as conn:
+        conn.execute(trackLevelsTable.insert(), rows)
+
+
+def insertSpatialIndex(trackId, points, conn=None):
+    import spatialIndex
+    points = trackCodec.decode(points)
+    if len(points) == 0:
+        return
+    minLat, maxLat, minLon, maxLon = spatialIndex.trackBounds(points)
+    cells = [dict(cell=int(cell), trackId=trackId) for cell in spatialIndex.trackCells(points)]
+    with _connection(conn) as conn:
+        conn.execute(trackBoundsTable.insert().values(id=trackId, minLat=minLat, maxLat=maxLat,
+                                                      minLon=minLon, maxLon=maxLon))
+        conn.execute(trackCellsTable.insert(), cells)
+
+
+def _binTrack(points):
+    import heatmap
+    return heatmap.binTrack(trackCodec.decode(points))
+
+
+def _mergeHeatTiles(conn, user, level, keys, rides):
+    # Adds `rides` (one number or one per key) to the sorted cell keys of a
+    # level and rewrites the tiles they fall in; emptied tiles are dropped.
+    import heatmap
+    tiles = heatmap.splitTiles(keys, rides)
+    if not tiles:
+        return
+    stored = dict(conn.execute(select(heatTilesTable.c.tile, heatTilesTable.c.cells).where(
+        heatTilesTable.c.user == user, heatTilesTable.c.level == level,
+        heatTilesTable.c.tile.in_(list(tiles)))).fetchall())
+    written, emptied = [], []
+    for tile, (positions, tileRides) in tiles.items():
+        cells, cellCount = heatmap.mergeCells(stored.get(tile), positions, tileRides)
+        if cellCount:
+            written.append(dict(user=user, level=level, tile=tile, cellCount=cellCount, cells=cells))
+        elif tile in stored:
+            emptied.append(dict(tileUser=user, tileLevel=level, tileKey=tile))
+    if written:
+        statement = sqliteInsert(heatTilesTable)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=['user', 'level', 'tile'],
+            set_=dict(cellCount=statement.excluded.cellCount, cells=statement.excluded.cells)), written)
+    if emptied:
+        conn.execute(delete(heatTilesTable).where(
+            heatTilesTable.c.user == bindparam('tileUser'), heatTilesTable.c.level == bindparam('tileLevel'),
+            heatTilesTable.c.tile == bindparam('tileKey')), emptied)
+
+
+def addHeatCells(user, cells, conn=None, rides=1):
+    # One more ride (rides=-1: one less) through each of the
+    # heatmap.binTrack() cells.
+    with _connection(conn) as conn:
+        for level, keys in cells.items():
+            _mergeHeatTiles(conn, user, level, keys, rides)
+
+
+def removeHeatCells(user, cells, conn=None):
+    addHeatCells(user, cells, conn, -1)
+
+
+def getHeatTiles(user, level, tiles):
+    # [(tile, cells)] of the given tiles of one level that have rides.
+    query = select(heatTilesTable.c.tile, heatTilesTable.c.cells).where(
+        heatTilesTable.c.user == user, heatTilesTable.c.level == level, heatTilesTable.c.tile.in_(tiles))
+    with _connection(None) as conn:
+        return conn.execute(query).fetchall()
+
+
+def rebuildHeatmap(user=None, conn=None, batchSize=200):
+    # Recomputes the heatmap from the stored points, for one user or
+    # everybody; the repair path if it ever drifts. batchSize tracks are
+    # binned at a time and merged as summed counts. Returns the track count.
+    import numpy as np
+    clear = delete(heatTilesTable)
+    if user is not None:
+        clear = clear.where(heatTilesTable.c.user == user)
+    lastId = 0
+    built = 0
+    with _connection(conn) as conn:
+        conn.execute(clear)
+        while True:
+            query = select(tracksTable.c.id, tracksTable.c.user, trackPayloadsTable.c.points).join_from(
+                tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+                tracksTable.c.id > lastId).order_by(tracksTable.c.id).limit(batchSize)
+            if user is not None:
+                query = query.where(tracksTable.c.user == user)
+            rows = conn.execute(query).fetchall()
+            binned = {}
+            for row in rows:
+                for level, keys in _binTrack(row.points).items():
+                    binned.setdefault((row.user, level), []).append(keys)
+            for (cellUser, level), keys in binned.items():
+                keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+                _mergeHeatTiles(conn, cellUser, level, keys, counts)
+            built += len(rows)
+            if len(rows) < batchSize:
+                return built
+            lastId = rows[-1].id
+
+
+def buildMissingHeatmap():
+    # Databases from before the heatmap get it built once.
+    with _connection(None) as conn:
+        if conn.execute(select(heatTilesTable.c.tile).limit(1)).first() is not None:
+            return 0
+    return rebuildHeatmap()
+
+
+def periodStart(date, period):
+    day = date.date() if isinstance(date, datetime) else date
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    if period == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def rollupValues(distance, movingTime, elevationGain, hrZones):
+    values = dict(rideCount=1, distance=distance or 0.0, movingTime=movingTime or 0.0,
+                  elevationGain=elevationGain or 0.0)
+    hrZones = hrZones or []
+    for zone, name in enumerate(HR_ZONE_COLUMNS):
+        values[name] = hrZones[zone] if zone < len(hrZones) else 0.0
+    return values
+
+
+def _storedRollupValues(track):
+    # rollupValues() for a tracks row; hrZones sit in the analytics JSON
+    extra = json.loads(track.analytics) if track.analytics else {}
+    return rollupValues(track.distance, track.movingTime, track.elevationGain, extra.get('hrZones'))
+
+
+def _applyRollups(conn, user, date, values, sign=1):
+    # Adds (sign=1) or removes (sign=-1) one ride in all of its periods.
+    for period in ROLLUP_PERIODS:
+        statement = sqliteInsert(rollupsTable).values(
+            user=user, period=period, start=periodStart(date, period),
+            **dict((name, sign * values[name]) for name in ROLLUP_VALUES))
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=['user', 'period', 'start'],
+            set_=dict((name, rollupsTable.c[name] + statement.excluded[name]) for name in ROLLUP_VALUES)))
+    if sign < 0:
+        conn.execute(delete(rollupsTable).where(rollupsTable.c.user == user, rollupsTable.c.rideCount <= 0))
+
+
+def rebuildRollups(user=None, conn=None, batchSize=500):
+    # Recomputes the rollups from the tracks summary columns, for one user
+    # or everybody; the repair path if they ever drift. Returns the row count.
+    query = select(tracksTable.c.user, tracksTable.c.date, tracksTable.c.distance, tracksTable.c.movingTime,
+                   tracksTable.c.elevationGain, tracksTable.c.analytics).where(tracksTable.c.date.isnot(None))
+    clear = delete(rollupsTable)
+    if user is not None:
+        query = query.where(tracksTable.c.user == user)
+        clear = clear.where(rollupsTable.c.user == user)
+    totals = {}
+    with _connection(conn) as conn:
+        for track in conn.execute(query):
+            values = _storedRollupValues(track)
+            for period in ROLLUP_PERIODS:
+                key = (track.user, period, periodStart(track.date, period))
+                row = totals.get(key)
+                if row is None:
+                    totals[key] = dict(values)
+                else:
+                    for name in ROLLUP_VALUES:
+                        row[name] += values[name]
+        conn.execute(clear)
+        rows = [dict(values, user=key[0], period=key[1], start=key[2]) for key, values in totals.items()]
+        for offset in range(0, len(rows), batchSize):
+            conn.execute(rollupsTable.insert(), rows[offset:offset + batchSize])
+    return len(rows)
+
+
+def getRollups(user, period, limit=None):
+    # Newest period first.
+    query = select(rollupsTable).where(rollupsTable.c.user == user, rollupsTable.c.period == period).order_by(
+        rollupsTable.c.start.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    with _connection(None) as conn:
+        return [row._asdict() for row in conn.execute(query)]
+
+
+def getRollupTotals(user):
+    # All time totals, summed over the (few) year rows.
+    query = select(*[func.coalesce(func.sum(rollupsTable.c[name]), 0).label(name) for name in ROLLUP_VALUES]).where(
+        rollupsTable.c.user == user, rollupsTable.c.period == 'year')
+    with _connection(None) as conn:
+        return conn.execute(query).first()._asdict()
+
+
+def insertUser(name, password, conn=None):
+    userIns = usersTable.insert().values(name = name, password=password)
+    with _connection(conn) as conn:
+        conn.execute(userIns)
+
+
+
+def insertGpxTrack(username,avgSpeed,distance,avgHr,date,rideTime,points,hr,elevation, conn=None, levels=None,
+                   time=None, speed=None, analytics=None, fingerprint=None):
+    # New track id, or None when the user already has this track.
+    return insertGpxTracks([dict(user=username, avgSpeed=avgSpeed, distance=distance, avgHr=avgHr,
+                                 date=date, rideTime=rideTime, points=points, hr=hr,
+                                 elevation=elevation, levels=levels, time=time, speed=speed,
+                                 analytics=analytics, fingerprint=fingerprint)], conn)[0]
+
+
+@instrument.timed('db.insert')
+def insertGpxTracks(tracks, conn=None, batchSize=500):
+    # Writes an iterable of dicts keyed like the old gpxTracks columns (user,
+    # avgSpeed, distance, avgHr, date, rideTime, points, hr, elevation and the
+    # optional time, speed, precomputed `levels`, `analytics`, `fingerprint`
+    # and `heatCells`) and returns the new track ids, in order. A track already
+    # stored for the user (same fingerprint) is not written; its id is None.
+    # Payloads are written with executemany in chunks of batchSize.
+    trackIds = []
+    with _connection(conn) as conn:
+        payloads = []
+        for track in tracks:
+            fingerprint = track.get('fingerprint')
+            if fingerprint is None:
+                fingerprint = fingerprintStoredTrack(track['points'], track.get('time'), track['date'])
+            if findTrackByFingerprint(track['user'], fingerprint, conn) is not None:
+                trackIds.append(None)
+                continue
+            analytics = track.get('analytics')
+            if analytics is None:
+                analytics = analyseStoredTrack(track['points'], track['elevation'], track['hr'], track.get('time'))
+            result = conn.execute(tracksTable.insert().values(
+                user=track['user'], date=track['date'], avgSpeed=track['avgSpeed'],
+                distance=track['distance'], avgHr=track['avgHr'], rideTime=track['rideTime'],
+                pointCount=trackCodec.count(track['points']),
+                contentHash=trackCodec.contentHash(track['points'], track['hr'], track['elevation']),
+                **analyticsColumns(analytics)))
+            trackId = result.inserted_primary_key[0]
+            conn.execute(trackFingerprintsTable.insert().values(trackId=trackId, user=track['user'], **fingerprint))
+            if track['date'] is not None:
+                _applyRollups(conn, track['user'], track['date'], rollupValues(
+                    track['distance'], analytics['movingTime'], analytics['elevationGain'], analytics['hrZones']))
+            payloads.append(dict(trackId=trackId, points=track['points'], hr=track['hr'],
+                                 elevation=track['elevation'], time=track.get('time'),
+                                 speed=track.get('speed')))
+            trackIds.append(trackId)
+            _trackChanged(conn, 'insert', trackId)
+            levels = track.get('levels')
+            if levels is None:
+                levels = _buildLevels(track['points'])
+            insertLevels(trackId, levels, conn)
+            insertSpatialIndex(trackId, track['points'], conn)
+            heatCells = track.get('heatCells')
+            if heatCells is None:
+                heatCells = _binTrack(track['points'])
+            addHeatCells(track['user'], heatCells, conn)
+            matchNewTrack(trackId, track, conn)
+            if len(payloads) >= batchSize:
+                conn.execute(trackPayloadsTable.insert(), payloads)
+                payloads = []
+        if payloads:
+            conn.execute(trackPayloadsTable.insert(), payloads)
+    instrument.count('db.insertedTracks', len(trackIds) - trackIds.count(None))
+    return trackIds
 
 
 def checkUser(name,password):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    userstable = Table('users', metadata, autoload=True, autoload_with=engine)
-    query = select([userstable]).where(userstable.columns.name == name)
-    results = engine.execute(query)
-    user = results.fetchall()
+    query = select(usersTable).where(usersTable.columns.name == name)
+    with _connection(None) as conn:
+        user = conn.execute(query).fetchall()
     if user:
         try:
             if name == user[0][1] and password == user[0][2]:
                 return True
         except:
-            print("Sql exception")
+            log.exception("Sql exception")
     else:
         return False
 
 def checkCreatedUser(name):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    userstable = Table('users', metadata, autoload=True, autoload_with=engine)
-    query = select([userstable]).where(userstable.columns.name == name)
-    results = engine.execute(query)
-    user = results.fetchall()
+    query = select(usersTable).where(usersTable.columns.name == name)
+    with _connection(None) as conn:
+        user = conn.execute(query).fetchall()
     if user:
         try:
             if name == user[0][1]:
                 return True
         except:
-            print("Sql exception")
+            log.exception("Sql exception")
     else:
         return False
 
-def getTrackDates(user):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    gpxTracksTable = Table('gpxTracks', metadata, autoload=True, autoload_with=engine)
-    query = select(gpxTracksTable.c.date).where(gpxTracksTable.columns.user == user)
-    results = engine.execute(query)
-    dates = results.fetchall()
-    dates = [row._asdict() for row in dates]
-    return dates
-
-
-def getTracks(user):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    gpxTracksTable = Table('gpxTracks', metadata, autoload=True, autoload_with=engine)
-    query = select([gpxTracksTable]).where(gpxTracksTable.columns.user == user)
-    results = engine.execute(query)
-    tracks = results.fetchall()
-    tracks = [row._asdict() for row in tracks]
+def getTrackSummaries(user):
+    query = select(*SUMMARY_COLUMNS).where(tracksTable.columns.user == user).order_by(
+        tracksTable.c.date, tracksTable.c.id)
+    with _connection(None) as conn:
+        tracks = conn.execute(query).fetchall()
+    return [row._asdict() for row in tracks]
+
+
+@instrument.timed('db.getTrack')
+def getTrack(trackId):
+    query = select(*SUMMARY_COLUMNS).where(tracksTable.c.id == trackId)
+    with _connection(None) as conn:
+        track = conn.execute(query).first()
+    return track._asdict() if track is not None else None
+
+
+@instrument.timed('db.getTrackPayload')
+def getTrackPayload(trackId):
+    query = select(*PAYLOAD_COLUMNS).where(trackPayloadsTable.c.trackId == trackId)
+    with _connection(None) as conn:
+        payload = conn.execute(query).first()
+    return payload._asdict() if payload is not None else None
+
+
+def getTrackData(trackId):
+    # The stored points as a trackData.TrackData, or None.
+    import trackData
+    payload = getTrackPayload(trackId)
+    return trackData.TrackData.fromPayload(payload) if payload is not None else None
+
+
+def getTrackBounds(trackId):
+    # (minLat, maxLat, minLon, maxLon) of the track, or None
+    bounds = trackBoundsTable.c
+    query = select(bounds.minLat, bounds.maxLat, bounds.minLon, bounds.maxLon).where(bounds.id == trackId)
+    with _connection(None) as conn:
+        row = conn.execute(query).first()
+    return tuple(row) if row is not None else None
+
+
+@instrument.timed('db.getMapPoints')
+def getMapPoints(trackId, maxPoints):
+    # Full points when they fit the budget, otherwise the most detailed
+    # simplified level that does (or the coarsest one there is).
+    track = getTrack(trackId)
+    if track is None:
+        return None
+    if track['pointCount'] <= maxPoints:
+        return getTrackPayload(trackId)['points']
+    query = select(trackLevelsTable.c.pointCount, trackLevelsTable.c.points).where(
+        trackLevelsTable.c.trackId == trackId).order_by(trackLevelsTable.c.tolerance)
+    with _connection(None) as conn:
+        levels = conn.execute(query).fetchall()
+    if not levels:
+        return getTrackPayload(trackId)['points']
+    for level in levels:
+        if level.pointCount <= maxPoints:
+            return level.points
+    return levels[-1].points
+
+
+def countTracks(user):
+    query = select(func.count()).select_from(tracksTable).where(tracksTable.c.user == user)
+    with _connection(None) as conn:
+        return conn.execute(query).scalar()
+
+
+def streamTracks(user, batchSize=100):
+    # Summary and payload rows of all the user's tracks from one streamed
+    # query: they come off the cursor batchSize at a time and are never all
+    # held in memory.
+    query = select(*SUMMARY_COLUMNS, *PAYLOAD_COLUMNS).join_from(
+        tracksTable, trackPayloadsTable, trackPayloadsTable.c.trackId == tracksTable.c.id).where(
+        tracksTable.columns.user == user).order_by(tracksTable.c.date, tracksTable.c.id)
+    with _connection(None) as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batchSize).execute(query)
+        for rows in result.partitions(batchSize):
+            for row in rows:
+                yield row._asdict()
+
+
+def deleteSelectedTrack(trackId, conn=None):
+    with _connection(conn) as conn:
+        track = conn.execute(select(tracksTable.c.user, tracksTable.c.date, tracksTable.c.distance,
+                                    tracksTable.c.movingTime, tracksTable.c.elevationGain,
+                                    tracksTable.c.analytics).where(tracksTable.c.id == trackId)).first()
+        if track is not None and track.date is not None:
+            _applyRollups(conn, track.user, track.date, _storedRollupValues(track), -1)
+        points = conn.execute(select(trackPayloadsTable.c.points).where(
+            trackPayloadsTable.c.trackId == trackId)).scalar()
+        if track is not None and points is not None:
+            removeHeatCells(track.user, _binTrack(points), conn)
+        conn.execute(delete(trackLevelsTable).where(trackLevelsTable.c.trackId == trackId))
+        conn.execute(delete(trackCellsTable).where(trackCellsTable.c.trackId == trackId))
+        conn.execute(delete(trackFingerprintsTable).where(trackFingerprintsTable.c.trackId == trackId))
+        conn.execute(delete(segmentEffortsTable).where(segmentEffortsTable.c.trackId == trackId))
+        conn.execute(delete(trackBoundsTable).where(trackBoundsTable.c.id == trackId))
+        conn.execute(delete(trackPayloadsTable).where(trackPayloadsTable.c.trackId == trackId))
+        conn.execute(delete(tracksTable).where(tracksTable.c.id == trackId))
+        _trackChanged(conn, 'delete', trackId)
+
+
+def _spatialCandidates(user, minLat, maxLat, minLon, maxLon):
+    # Ids of the user's tracks whose bounding box overlaps the box and, for
+    # boxes small enough, that visit one of its grid cells.
+    import spatialIndex
+    bounds = trackBoundsTable.c
+    query = select(tracksTable.c.id).where(tracksTable.c.user == user, tracksTable.c.id.in_(
+        select(bounds.id).where(bounds.maxLat >= minLat, bounds.minLat <= maxLat,
+                                bounds.maxLon >= minLon, bounds.minLon <= maxLon)))
+    ranges = spatialIndex.queryCellRanges(minLat, maxLat, minLon, maxLon)
+    if ranges is not None:
+        cells = trackCellsTable.c
+        query = query.where(tracksTable.c.id.in_(
+            select(cells.trackId).where(or_(*[cells.cell.between(first, last) for first, last in ranges]))))
+    with _connection(None) as conn:
+        return [row.id for row in conn.execute(query)]
+
+
+def _refineTracks(trackIds, matches, batchSize=200):
+    # Keeps the ids whose stored points pass matches(points).
+    kept = []
+    for offset in range(0, len(trackIds), batchSize):
+        query = select(trackPayloadsTable.c.trackId, trackPayloadsTable.c.points).where(
+            trackPayloadsTable.c.trackId.in_(trackIds[offset:offset + batchSize]))
+        with _connection(None) as conn:
+            for row in conn.execute(query):
+                if matches(trackCodec.decode(row.points)):
+                    kept.append(row.trackId)
+    return kept
+
+
+def getTrackSummariesById(trackIds, batchSize=500):
+    # Summary rows for the given ids, ordered like getTrackSummaries().
+    tracks = []
+    for offset in range(0, len(trackIds), batchSize):
+        query = select(*SUMMARY_COLUMNS).where(tracksTable.c.id.in_(trackIds[offset:offset + batchSize]))
+        with _connection(None) as conn:
+            tracks.extend(row._asdict() for row in conn.execute(query))
+    tracks.sort(key=lambda track: (track['date'] is None, track['date'] or datetime.min, track['id']))
     return tracks
 
 
-def getSelectedTrack(user, trackDate):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    gpxTracksTable = Table('gpxTracks', metadata, autoload=True, autoload_with=engine)
-    query = select([gpxTracksTable]).where( and_ (gpxTracksTable.columns.user == user) ,
-                                            (gpxTracksTable.columns.date == trackDate ))
-    results = engine.execute(query)
-    selectedTrack = results.fetchall()
-    selectedTrack = [row._asdict() for row in selectedTrack]
-    print("sql" , trackDate)
-    return selectedTrack
-
-
-def deleteSelectedTrack(userId):
-    engine = create_engine("sqlite:///sqlDb.db", echo=False)
-    metadata = MetaData()
-    gpxTracksTable = Table('gpxTracks', metadata, autoload=True, autoload_with=engine)
-    query = delete(gpxTracksTable).where(gpxTracksTable.c.id==userId)
-    results = engine.execute(query)
+def _listConditions(user, dateFrom=None, dateTo=None, minDistance=None, maxDistance=None):
+    conditions = [tracksTable.c.user == user]
+    if dateFrom is not None:
+        conditions.append(tracksTable.c.date >= dateFrom)
+    if dateTo is not None:
+        conditions.append(tracksTable.c.date < dateTo)
+    if minDistance is not None:
+        conditions.append(tracksTable.c.distance >= minDistance)
+    if maxDistance is not None:
+        conditions.append(tracksTable.c.distance <= maxDistance)
+    return conditions
+
+
+def _listOrder(sortKey, descending):
+    # NULLs sort first ascending and last descending, so the descending
+    # order is exactly the ascending one reversed.
+    column = LIST_SORT_COLUMNS[sortKey]
+    if descending:
+        return column.desc(), tracksTable.c.id.desc()
+    return column, tracksTable.c.id
+
+
+@instrument.timed('db.getTrackListIds')
+def getTrackListIds(user, sortKey='date', descending=False, **filters):
+    # Ids of the user's tracks in list order, optionally filtered by
+    # dateFrom/dateTo and minDistance/maxDistance.
+    query = select(tracksTable.c.id).where(*_listConditions(user, **filters)).order_by(
+        *_listOrder(sortKey, descending))
+    with _connection(None) as conn:
+        return conn.execute(query).scalars().all()
+
+
+def getTrackListPosition(user, trackId, sortKey='date', descending=False, **filters):
+    # Where the track sits in getTrackListIds() order, or None when it is
+    # not in the list (another user's track or filtered out).
+    column = LIST_SORT_COLUMNS[sortKey]
+    conditions = _listConditions(user, **filters)
+    with _connection(None) as conn:
+        track = conn.execute(select(column).where(tracksTable.c.id == trackId, *conditions)).first()
+        if track is None:
+            return None
+        value = track[0]
+        if value is None:
+            before = and_(column.is_(None), tracksTable.c.id < trackId)
+        else:
+            before = or_(column.is_(None), column < value, and_(column == value, tracksTable.c.id < trackId))
+        position = conn.execute(select(func.count()).select_from(tracksTable).where(before, *conditions)).scalar()
+        if descending:
+            total = conn.execute(select(func.count()).select_from(tracksTable).where(*conditions)).scalar()
+            position = total - 1 - position
+    return position
+
+
+@instrument.timed('db.getTrackListRows')
+def getTrackListRows(trackIds):
+    # LIST_COLUMNS rows for the given ids, by id.
+    query = select(*LIST_COLUMNS).where(tracksTable.c.id.in_(trackIds))
+    with _connection(None) as conn:
+        return dict((row.id, row._asdict()) for row in conn.execute(query))
+
+
+@instrument.timed('db.findTracksInBox')
+def findTracksInBox(user, minLat, maxLat, minLon, maxLon, exact=True):
+    # Tracks of `user` crossing the box. Without `exact` the bounding box and
+    # grid cell candidates are returned as they are.
+    import spatialIndex
+    trackIds = _spatialCandidates(user, minLat, maxLat, minLon, maxLon)
+    if exact:
+        trackIds = _refineTracks(trackIds, lambda points: spatialIndex.intersectsBox(
+            points, minLat, maxLat, minLon, maxLon))
+    return getTrackSummariesById(trackIds)
+
+
+@instrument.timed('db.findTracksNear')
+def findTracksNear(user, lat, lon, radius, exact=True):
+    # Tracks of `user` passing within `radius` metres of (lat, lon).
+    import spatialIndex
+    trackIds = _spatialCandidates(user, *spatialIndex.radiusBox(lat, lon, radius))
+    if exact:
+        trackIds = _refineTracks(trackIds, lambda points: spatialIndex.distanceToTrack(points, lat, lon) <= radius)
+    return getTrackSummariesById(trackIds)
+
+
+def _insertEfforts(segmentId, trackId, efforts, conn):
+    if efforts:
+        conn.execute(segmentEffortsTable.insert(), [dict(effort, segmentId=segmentId, trackId=trackId)
+                                                    for effort in efforts])
+    return len(efforts)
+
+
+def _decodeOptional(blob):
+    return trackCodec.decode(blob) if blob is not None else None
+
+
+def matchNewTrack(trackId, track, conn=None):
+    # Efforts of a freshly inserted track on the user's segments. Only the
+    # segments with both ends in cells the track visits are aligned, so the
+    # cost does not grow with the history.
+    import segmentMatch
+    cells = segmentCellsTable.c
+    query = select(segmentsTable.c.id, segmentsTable.c.points).where(
+        segmentsTable.c.user == track['user'], segmentsTable.c.id.in_(
+            select(cells.segmentId).join_from(segmentCellsTable, trackCellsTable,
+                                              trackCellsTable.c.cell == cells.cell).where(
+                trackCellsTable.c.trackId == trackId).group_by(cells.segmentId).having(
+                func.count(cells.endpoint.distinct()) == 2)))
+    matched = 0
+    with _connection(conn) as conn:
+        segments = conn.execute(query).fetchall()
+        if not segments:
+            return 0
+        points = trackCodec.decode(track['points'])
+        times = _decodeOptional(track.get('time'))
+        hr = _decodeOptional(track['hr'])
+        for segment in segments:
+            efforts = segmentMatch.matchSegment(trackCodec.decode(segment.points), points, times, hr)
+            matched += _insertEfforts(segment.id, trackId, efforts, conn)
+    return matched
+
+
+def createSegment(user, name, trackId, startIndex, endIndex, conn=None, batchSize=100):
+    # Cuts points startIndex..endIndex of a stored track into a new segment
+    # and finds the efforts on it in all of the user's tracks; returns the
+    # segment id. Candidates come from the cell index, so only tracks that
+    # pass both ends are decoded.
+    import segmentMatch
+    payload = getTrackPayload(trackId)
+    points = trackCodec.decode(payload['points'])[startIndex:endIndex + 1]
+    if len(points) < 2:
+        raise ValueError('a segment needs at least two points')
+    blob = trackCodec.encodePoints(points)
+    cells = segmentCellsTable.c
+    with _connection(conn) as conn:
+        distance = segmentMatch.pathLength(segmentMatch.localMeters(points, points[0])) / 1000
+        segmentId = conn.execute(segmentsTable.insert().values(
+            user=user, name=name, trackId=trackId, distance=distance, pointCount=len(points),
+            points=blob)).inserted_primary_key[0]
+        conn.execute(segmentCellsTable.insert(), [dict(cell=cell, segmentId=segmentId, endpoint=endpoint)
+                                                  for cell, endpoint in set(segmentMatch.endpointCells(points))])
+        candidates = select(trackCellsTable.c.trackId).join_from(
+            segmentCellsTable, trackCellsTable, trackCellsTable.c.cell == cells.cell).where(
+            cells.segmentId == segmentId).group_by(trackCellsTable.c.trackId).having(
+            func.count(cells.endpoint.distinct()) == 2)
+        trackIds = [row.id for row in conn.execute(
+            select(tracksTable.c.id).where(tracksTable.c.user == user, tracksTable.c.id.in_(candidates)))]
+        for offset in range(0, len(trackIds), batchSize):
+            query = select(trackPayloadsTable.c.trackId, trackPayloadsTable.c.points, trackPayloadsTable.c.time,
+                           trackPayloadsTable.c.hr).where(
+                trackPayloadsTable.c.trackId.in_(trackIds[offset:offset + batchSize]))
+            for row in conn.execute(query).fetchall():
+                efforts = segmentMatch.matchSegment(points, trackCodec.decode(row.points),
+                                                    _decodeOptional(row.time), _decodeOptional(row.hr))
+                _insertEfforts(segmentId, row.trackId, efforts, conn)
+    return segmentId
+
+
+def getSegments(user):
+    # Segments with their effort count and best time.
+    efforts = segmentEffortsTable.c
+    query = select(segmentsTable.c.id, segmentsTable.c.name, segmentsTable.c.trackId, segmentsTable.c.distance,
+                   func.count(efforts.id).label('effortCount'),
+                   func.min(efforts.elapsedTime).label('bestTime')).select_from(
+        segmentsTable.outerjoin(segmentEffortsTable, efforts.segmentId == segmentsTable.c.id)).where(
+        segmentsTable.c.user == user).group_by(segmentsTable.c.id).order_by(segmentsTable.c.name, segmentsTable.c.id)
+    with _connection(None) as conn:
+        return [row._asdict() for row in conn.execute(query)]
+
+
+def getSegmentEfforts(segmentId):
+    # Fastest first; efforts without timestamps go last.
+    efforts = segmentEffortsTable.c
+    query = select(efforts.id, efforts.trackId, tracksTable.c.date, efforts.startIndex, efforts.endIndex,
+                   efforts.distance, efforts.elapsedTime, efforts.avgSpeed, efforts.avgHr).join_from(
+        segmentEffortsTable, tracksTable, tracksTable.c.id == efforts.trackId).where(
+        efforts.segmentId == segmentId).order_by(efforts.elapsedTime.is_(None), efforts.elapsedTime, tracksTable.c.date)
+    with _connection(None) as conn:
+        return [row._asdict() for row in conn.execute(query)]
+
+
+def deleteSegment(segmentId, conn=None):
+    with _connection(conn) as conn:
+        conn.execute(delete(segmentEffortsTable).where(segmentEffortsTable.c.segmentId == segmentId))
+        conn.execute(delete(segmentCellsTable).where(segmentCellsTable.c.segmentId == segmentId))
+        conn.execute(delete(segmentsTable).where(segmentsTable.c.id == segmentId))
@@ -0,0 +1,161 @@
+import datetime
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the app's modules are flat at the top level
+sys.path.insert(0, ROOT)
+
+RIDE_START = datetime.datetime(2020, 8, 1, 6, 41, 59, tzinfo=datetime.timezone.utc)
+RIDE_ORIGIN = (54.388577, 18.383194)
+METERS_PER_DEGREE = 6378137.0 * math.pi / 180
+
+GPX_STYLES = ('amazfit', 'garmin')
+GPX_HEADERS = {
+    'amazfit': ('<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\' ?>\n'
+                '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+                'xmlns:ns3="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
+                'creator="Amazfit App" version="4.7.1-play" >\n<trk >\n'),
+    'garmin': ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<gpx creator="Garmin Connect" version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+               'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n<trk>\n'),
+}
+# the heart rate is only in the TrackPointExtension, <ele> in centimetres
+GPX_POINTS = {
+    'amazfit': ('<trkpt lat="%.6f" lon="%.6f" ><ele >%.1f</ele><time >%s</time><extensions >'
+                '<ns3:TrackPointExtension ><ns3:speed >%.1f</ns3:speed><ns3:hr >%d</ns3:hr>'
+                '</ns3:TrackPointExtension></extensions></trkpt>\n'),
+    'garmin': ('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time><extensions>'
+               '<gpxtpx:TrackPointExtension><gpxtpx:speed>%.2f</gpxtpx:speed><gpxtpx:hr>%d</gpxtpx:hr>'
+               '</gpxtpx:TrackPointExtension></extensions></trkpt>\n'),
+}
+
+
+def generateRide(count, seed=0, origin=RIDE_ORIGIN):
+    # (lat, lon, ele [m], seconds, hr, speed [m/s]) of a seeded random walk
+    # sampled every second
+    rng = np.random.default_rng(seed)
+    speed = np.clip(6.0 + np.cumsum(rng.normal(0.0, 0.3, count)), 2.0, 14.0)
+    heading = rng.uniform(0, 2 * math.pi) + np.cumsum(rng.normal(0.0, 0.05, count))
+    lat = origin[0] + np.cumsum(speed * np.cos(heading)) / METERS_PER_DEGREE
+    lon = origin[1] + np.cumsum(speed * np.sin(heading)) / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    index = np.arange(count, dtype=float)
+    ele = 120 + 80 * np.sin(index / 900.0) + 15 * np.sin(index / 97.0)
+    hr = np.round(np.clip(110 + 5 * speed + rng.normal(0.0, 2.0, count), 60.0, 195.0))
+    return np.column_stack([lat, lon, ele, index, hr, speed])
+
+
+def writeGpx(path, rides, style='amazfit', start=RIDE_START, seed=0):
+    # one <trkseg> per ride; amazfit batches samples, so runs of points
+    # share one timestamp
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', encoding='utf-8') as output:
+        output.write(GPX_HEADERS[style])
+        for rows in rides:
+            output.write('<trkseg>\n')
+            stamp = None
+            for lat, lon, ele, seconds, hr, speed in rows:
+                if style == 'garmin' or stamp is None or rng.random() < 0.7:
+                    stamp = (start + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                output.write(GPX_POINTS[style] % (lat, lon, ele * 100, stamp, speed, hr))
+            output.write('</trkseg>\n')
+        output.write('</trk>\n</gpx>\n')
+    return str(path)
+
+
+def trackRow(rows, user='anna', date=None):
+    # what insertGpxTracks takes for a ride of generateRide rows
+    import trackCodec
+    return dict(user=user, avgSpeed=0.0, distance=0.0, avgHr=float(rows[:, 4].mean()), rideTime='00:00:00',
+                date=date, points=trackCodec.encodePoints(rows[:, :2]), hr=trackCodec.encodeSeries(rows[:, 4]),
+                elevation=trackCodec.encodeSeries(rows[:, 2]), time=trackCodec.encodeSeries(rows[:, 3]))
+
+
+class StandInTileServer:
+    # Tiles are the path repeated to tileBytes, so any mix-up shows.
+
+    def __init__(self, tileBytes):
+        self.latency = 0.0
+        self.tileBytes = tileBytes
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.requests[self.path] += 1
+                time.sleep(server.latency)
+                body = server.body(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def body(self, path):
+        return (path.encode() * (self.tileBytes // len(path) + 1))[:self.tileBytes]
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.httpd.server_address[1], path)
+
+    def count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def ride():
+    return generateRide
+
+
+@pytest.fixture
+def track():
+    return trackRow
+
+
+@pytest.fixture
+def gpxFile():
+    return writeGpx
+
+
+@pytest.fixture
+def tileServer():
+    servers = []
+
+    def start(tileBytes):
+        servers.append(StandInTileServer(tileBytes))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def database(tmp_path):
+    # sqlAlch pointed at a fresh database with the user anna
+    import sqlAlch
+    sqlAlch.configure(str(tmp_path / 'tracks.db'))
+    sqlAlch.createDb()
+    sqlAlch.insertUser('anna', 'secret')
+    yield
+    sqlAlch.getEngine().dispose()
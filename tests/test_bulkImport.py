@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import bulkImport
+import sqlAlch
+import trackFingerprint
+
+
+def importPaths(paths):
+    report = bulkImport.importFiles('anna', [str(path) for path in paths], workers=1)
+    assert report.failed == []
+    return sorted(str(result.path) for result in report.imported), sorted(str(result.path) for result in report.skipped)
+
+
+@pytest.fixture
+def stored(database, tmp_path, ride, gpxFile):
+    rows = ride(300, 1)
+    path = gpxFile(tmp_path / 'stored.gpx', [rows], 'garmin')
+    assert importPaths([path]) == ([path], [])
+    return rows
+
+
+def test_theSameFileIsSkippedBeforeTheFullParse(stored, tmp_path, gpxFile, monkeypatch):
+    again = gpxFile(tmp_path / 'again.gpx', [stored], 'garmin')
+
+    def parseFile(self, *args, **kwargs):
+        raise AssertionError('a known file was parsed')
+
+    monkeypatch.setattr(bulkImport.gpxParse.GpxRecord, 'parseFile', parseFile)
+    assert importPaths([again]) == ([], [again])
+    assert sqlAlch.countTracks('anna') == 1
+
+
+def test_filesThatOnlyStartLikeAStoredTrackAreImported(stored, tmp_path, ride, gpxFile):
+    longer = np.vstack((stored, ride(100, 2, stored[-1, :2]) + [0, 0, 0, len(stored), 0, 0]))
+    paths = [gpxFile(tmp_path / 'longer.gpx', [longer], 'garmin'),
+             gpxFile(tmp_path / 'export.gpx', [stored, ride(200, 3)], 'garmin')]
+    # both share the head hash of the stored ride
+    heads = set(sqlAlch.getHeadFingerprints('anna'))
+    assert set(trackFingerprint.readHeadHash(path) for path in paths) <= heads
+    assert importPaths(paths) == (sorted(paths), [])
+    assert sqlAlch.countTracks('anna') == 3
+
+
+def test_aHeadHashCollisionWithOtherPointsIsImported(stored, tmp_path, gpxFile):
+    moved = stored.copy()
+    moved[-1, 0] = stored[:, 0].max() + 0.01
+    path = gpxFile(tmp_path / 'moved.gpx', [moved], 'garmin')
+    assert importPaths([path]) == ([path], [])
+
+
+def test_readFingerprintMatchesTheFullParse(stored, tmp_path, gpxFile):
+    path = gpxFile(tmp_path / 'ride.gpx', [stored], 'amazfit')
+    record = bulkImport.gpxParse.GpxRecord('anna')
+    record.parseFile(path)
+    assert trackFingerprint.readFingerprint(path) == record.fingerprint
+    assert trackFingerprint.readFingerprint(str(tmp_path / 'missing.gpx')) is None
+
+
+
+def test_anInProcessImportDoesNotSetTheWorkerGlobal(stored, tmp_path, gpxFile):
+    # the known tracks are passed to each file, so imports running at once
+    # in one process cannot replace each other's
+    again = gpxFile(tmp_path / 'again.gpx', [stored], 'garmin')
+    bulkImport._knownHeads = None
+    try:
+        assert importPaths([again]) == ([], [again])
+        assert bulkImport._knownHeads is None
+    finally:
+        bulkImport._knownHeads = {}
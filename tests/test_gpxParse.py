@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+import gpxParse
+import trackData
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(gpxParse.gpxpy is None, reason='gpxpy is not installed')
+
+
+def parse(path, streaming):
+    record = gpxParse.GpxRecord('anna')
+    record.parseFile(path, streaming=streaming)
+    assert record.error is None
+    return record
+
+
+def assertSameRecords(path):
+    streamed, fallback = parse(path, True), parse(path, False)
+    for column in trackData.COLUMNS:
+        np.testing.assert_allclose(fallback.track.column(column), streamed.track.column(column),
+                                   rtol=1e-12, equal_nan=True, err_msg=column)
+    assert fallback.rideDate == streamed.rideDate
+    assert fallback.rideTime == streamed.rideTime
+    assert fallback.distance == pytest.approx(streamed.distance, rel=1e-9)
+    assert fallback.avgHr == pytest.approx(streamed.avgHr)
+    return streamed
+
+
+def test_amazfitExportParsesTheSameWithGpxpy():
+    streamed = assertSameRecords(os.path.join(ROOT, 'gpx', 'amazfit1.gpx'))
+    # the device speed, not the one computed from the positions
+    assert streamed.track.column('speed').max() == pytest.approx(12.82)
+
+
+@pytest.mark.parametrize('style', ['amazfit', 'garmin'])
+def test_heartRateOnlyInExtensionsParsesTheSameWithGpxpy(tmp_path, ride, gpxFile, style):
+    path = gpxFile(tmp_path / 'ride.gpx', [ride(300, 3)], style)
+    streamed = assertSameRecords(path)
+    assert streamed.track.column('hr').min() > 0
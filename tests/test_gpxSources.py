@@ -0,0 +1,25 @@
+import gzip
+import zipfile
+
+import gpxSources
+
+GPX = b'<gpx><trk><trkseg></trkseg></trk></gpx>'
+
+
+def test_closingAGzipSourceClosesTheFileUnderIt(tmp_path):
+    path = str(tmp_path / 'ride.gpx.gz')
+    with gzip.open(path, 'wb') as output:
+        output.write(GPX)
+    with gpxSources.openSource(path) as source:
+        assert source.read() == GPX
+    assert source.stream.closed
+
+
+def test_closingAGzipZipMemberClosesTheMember(tmp_path):
+    path = str(tmp_path / 'rides.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('ride.gpx.gz', gzip.compress(GPX))
+    with gpxSources.openSource(gpxSources.memberSource(path, 'ride.gpx.gz')) as source:
+        assert source.read() == GPX
+    assert source.stream.closed
+    gpxSources.closeArchives()
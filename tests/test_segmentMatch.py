@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from sqlalchemy import select
+
+import segmentMatch
+import sqlAlch
+import trackCodec
+
+# the segment is points FIRST..LAST of the ride
+FIRST, LAST = 100, 300
+
+
+@pytest.fixture
+def rows(ride):
+    return ride(600, 7)
+
+
+def shifted(rows, metres):
+    # the same ride a few metres further north, as another recording of it
+    moved = rows.copy()
+    moved[:, 0] += metres / (segmentMatch.EARTH_RADIUS * np.pi / 180)
+    return moved
+
+
+def test_rideAlongTheSegmentIsAnEffort(rows):
+    points, times, hr = rows[:, :2], rows[:, 3], rows[:, 4]
+    efforts = segmentMatch.matchSegment(points[FIRST:LAST + 1], shifted(rows, 5)[:, :2], times, hr)
+    assert len(efforts) == 1
+    effort = efforts[0]
+    assert abs(effort['startIndex'] - FIRST) <= 2 and abs(effort['endIndex'] - LAST) <= 2
+    assert effort['elapsedTime'] == pytest.approx(LAST - FIRST, abs=4)
+    assert effort['avgHr'] == pytest.approx(hr[FIRST:LAST + 1].mean(), abs=1)
+
+
+def test_lapsGiveAnEffortEach(rows):
+    points = rows[:, :2]
+    laps = np.vstack((points[:LAST + 50], points[FIRST - 50:]))
+    assert len(segmentMatch.matchSegment(points[FIRST:LAST + 1], laps)) == 2
+
+
+def test_rideInTheOtherDirectionIsNoEffort(rows):
+    points = rows[:, :2]
+    assert segmentMatch.matchSegment(points[FIRST:LAST + 1], points[::-1]) == []
+
+
+def test_partialPassesAreNoEffort(rows):
+    points = rows[:, :2]
+    segment = points[FIRST:LAST + 1]
+    # stops halfway
+    assert segmentMatch.matchSegment(segment, points[:200]) == []
+    # leaves the segment halfway and joins it again near the end, 300 m off
+    # route in between
+    middle = (FIRST + LAST) // 2
+    detour = np.vstack((points[:middle], shifted(rows, 300)[middle:LAST - 20, :2], points[LAST - 20:]))
+    assert segmentMatch.matchSegment(segment, detour) == []
+
+
+def test_effortsFollowTheTracksInTheDatabase(database, rows, track):
+    source, before = sqlAlch.insertGpxTracks([track(rows), track(shifted(rows, 5))])
+    segmentId = sqlAlch.createSegment('anna', 'climb', source, FIRST, LAST)
+    after, backwards = sqlAlch.insertGpxTracks([track(shifted(rows, -5)), track(shifted(rows, 10)[::-1])])
+    efforts = sqlAlch.getSegmentEfforts(segmentId)
+    assert sorted(effort['trackId'] for effort in efforts) == sorted([source, before, after])
+
+    sqlAlch.deleteSelectedTrack(source)
+    segment, = sqlAlch.getSegments('anna')
+    assert (segment['id'], segment['trackId'], segment['effortCount']) == (segmentId, None, 2)
+    assert sorted(effort['trackId'] for effort in sqlAlch.getSegmentEfforts(segmentId)) == sorted([before, after])
+    # the segment's own points are kept
+    with sqlAlch.transaction() as conn:
+        blob = conn.execute(select(sqlAlch.segmentsTable.c.points)).scalar()
+    np.testing.assert_allclose(trackCodec.decode(blob), rows[FIRST:LAST + 1, :2], atol=1e-6)
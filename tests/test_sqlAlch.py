@@ -0,0 +1,126 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+
+import heatmap
+import spatialIndex
+import sqlAlch
+import trackCodec
+
+
+def test_trackListenersHearOfChangesAfterTheCommit(database, ride, track):
+    heard = []
+
+    def listener(event, trackId):
+        # a fresh connection already sees the change
+        heard.append((event, trackId, sqlAlch.getTrack(trackId) is not None))
+
+    sqlAlch.addTrackListener(listener)
+    try:
+        with sqlAlch.transaction() as conn:
+            first, second = sqlAlch.insertGpxTracks([track(ride(200, 1)), track(ride(200, 2))], conn)
+            sqlAlch.deleteSelectedTrack(first, conn)
+            assert heard == []
+        assert heard == [('insert', first, False), ('insert', second, True), ('delete', first, False)]
+    finally:
+        sqlAlch.removeTrackListener(listener)
+
+
+def test_trackListenersHearNothingOfARollback(database, ride, track):
+    heard = []
+
+    def listener(event, trackId):
+        heard.append(event)
+
+    sqlAlch.addTrackListener(listener)
+    try:
+        with pytest.raises(RuntimeError):
+            with sqlAlch.transaction() as conn:
+                sqlAlch.insertGpxTracks([track(ride(200, 1))], conn)
+                raise RuntimeError('import cancelled')
+        assert heard == [] and sqlAlch.countTracks('anna') == 0
+    finally:
+        sqlAlch.removeTrackListener(listener)
+
+
+@pytest.fixture
+def spread(database, ride, track):
+    # rides around Gdansk and Krakow, and a two point track across the
+    # meridian 18.5 whose only points lie outside every box below
+    rides = [ride(600, seed, origin) for seed, origin in enumerate([
+        (54.39, 18.38), (54.40, 18.45), (54.52, 18.53), (50.06, 19.94)])]
+    rides.append(np.array([[50.0, 18.49, 0, 0, 120, 0], [50.0, 18.51, 0, 60, 120, 0]]))
+    ids = sqlAlch.insertGpxTracks([track(rows) for rows in rides])
+    return dict((trackId, trackCodec.decode(sqlAlch.getTrackPayload(trackId)['points'])) for trackId in ids)
+
+
+def foundIds(tracks):
+    return sorted(track['id'] for track in tracks)
+
+
+@pytest.mark.parametrize('box', [
+    (54.395, 54.405, 18.39, 18.41),
+    (54.0, 55.0, 18.0, 19.0),
+    (45.0, 58.0, 18.5, 18.5005),
+    (54.40, 54.401, 0.0, 40.0),
+    (10.0, 20.0, 10.0, 20.0),
+], ids=['small', 'city', 'tall', 'wide', 'empty'])
+def test_findTracksInBoxMatchesEveryTrackChecked(spread, box):
+    expected = sorted(trackId for trackId, points in spread.items() if spatialIndex.intersectsBox(points, *box))
+    assert foundIds(sqlAlch.findTracksInBox('anna', *box)) == expected
+    assert set(expected) <= set(foundIds(sqlAlch.findTracksInBox('anna', *box, exact=False)))
+
+
+def test_tallBoxesSkipTheCellFilter():
+    assert 50 < len(spatialIndex.queryCellRanges(54.0, 54.5, 18.0, 18.1)) <= spatialIndex.MAX_QUERY_ROWS
+    assert spatialIndex.queryCellRanges(45.0, 58.0, 18.5, 18.5005) is None
+
+
+@pytest.mark.parametrize('lat, lon, radius', [(54.40, 18.45, 50), (54.45, 18.45, 5000), (50.0, 18.5, 1000),
+                                              (52.0, 19.0, 300000), (0.0, 0.0, 1000)])
+def test_findTracksNearMatchesEveryTrackChecked(spread, lat, lon, radius):
+    expected = sorted(trackId for trackId, points in spread.items()
+                      if spatialIndex.distanceToTrack(points, lat, lon) <= radius)
+    assert foundIds(sqlAlch.findTracksNear('anna', lat, lon, radius)) == expected
+
+
+def rollupRows():
+    with sqlAlch.transaction() as conn:
+        return sorted((row.user, row.period, row.start, tuple(getattr(row, name) for name in sqlAlch.ROLLUP_VALUES))
+                      for row in conn.execute(select(sqlAlch.rollupsTable)))
+
+
+def heatRows():
+    with sqlAlch.transaction() as conn:
+        return sorted((row.user, row.level, row.tile, row.cellCount, heatmap.unpackCells(row.cells))
+                      for row in conn.execute(select(sqlAlch.heatTilesTable)))
+
+
+def test_incrementalRollupsAndHeatmapMatchARebuild(database, ride, track):
+    sqlAlch.insertUser('ben', 'secret')
+    days = [datetime(2020, 8, 1, 7), datetime(2020, 8, 2, 18), datetime(2020, 8, 31, 9), datetime(2021, 1, 4, 6),
+            None]
+    rows = []
+    for index, day in enumerate(days):
+        row = track(ride(400, index, (54.39 + 0.003 * index, 18.38)), 'ben' if index == 3 else 'anna', day)
+        rows.append(dict(row, distance=10.0 + index))
+    trackIds = sqlAlch.insertGpxTracks(rows)
+    sqlAlch.deleteSelectedTrack(trackIds[1])
+    sqlAlch.insertGpxTracks([dict(track(ride(300, 9), 'anna', days[0]), distance=3.5)])
+    incrementalRollups, incrementalHeat = rollupRows(), heatRows()
+    assert incrementalRollups and incrementalHeat
+
+    with sqlAlch.transaction() as conn:
+        sqlAlch.rebuildRollups(conn=conn)
+        sqlAlch.rebuildHeatmap(conn=conn)
+    rebuiltRollups, rebuiltHeat = rollupRows(), heatRows()
+    assert [row[:3] for row in incrementalRollups] == [row[:3] for row in rebuiltRollups]
+    for incremental, rebuilt in zip(incrementalRollups, rebuiltRollups):
+        assert incremental[3] == pytest.approx(rebuilt[3])
+    assert len(incrementalHeat) == len(rebuiltHeat)
+    for incremental, rebuilt in zip(incrementalHeat, rebuiltHeat):
+        assert incremental[:4] == rebuilt[:4]
+        for incrementalArray, rebuiltArray in zip(incremental[4], rebuilt[4]):
+            np.testing.assert_array_equal(incrementalArray, rebuiltArray)
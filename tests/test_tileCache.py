@@ -0,0 +1,115 @@
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import tileCache
+
+TILE_BYTES = 1000
+RIDE_BOUNDS = (54.38, 54.48, 18.25, 18.38)
+
+
+@pytest.fixture
+def upstream(tileServer):
+    return tileServer(TILE_BYTES)
+
+
+@pytest.fixture
+def cache(upstream, tmp_path):
+    cache = tileCache.TileCache(str(tmp_path / 'tiles'), url=upstream.url('{z}/{x}/{y}.png'))
+    yield cache
+    cache.close()
+
+
+def tileBody(upstream, zoom, x, y):
+    return upstream.body('/%d/%d/%d.png' % (zoom, x, y))
+
+
+def waitForDownloads(cache):
+    while cache.stats()['pending']:
+        time.sleep(0.01)
+
+
+def test_missIsDownloadedOnceThenServedFromDisk(upstream, cache):
+    assert cache.get(12, 2260, 1304) == tileBody(upstream, 12, 2260, 1304)
+    assert cache.get(12, 2260, 1304) == tileBody(upstream, 12, 2260, 1304)
+    assert upstream.count() == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits'], stats['files'], stats['bytes']) == (1, 1, 1, TILE_BYTES)
+    assert os.path.exists(cache._path(12, 2260, 1304))
+
+
+def test_concurrentRequestsShareOneDownload(upstream, cache):
+    upstream.latency = 0.05
+    with ThreadPoolExecutor(8) as clients:
+        bodies = list(clients.map(lambda index: cache.get(5, 17, 10), range(8)))
+    assert upstream.count() == 1
+    assert set(bodies) == {tileBody(upstream, 5, 17, 10)}
+
+
+def test_leastRecentlyUsedTilesAreEvictedFirst(upstream, tmp_path):
+    directory = str(tmp_path / 'tiles')
+    cache = tileCache.TileCache(directory, 10 * TILE_BYTES, upstream.url('{z}/{x}/{y}.png'))
+    cache.get(14, 0, 0)
+    for x in range(1, 30):
+        cache.get(14, x, 0)
+        cache.get(14, 0, 0)
+    cache.close()
+    onDisk = [name for root, dirs, names in os.walk(directory) for name in names]
+    assert len(onDisk) == 10 and cache.stats()['bytes'] == 10 * TILE_BYTES
+    assert os.path.exists(cache._path(14, 0, 0))
+    assert os.path.exists(cache._path(14, 29, 0)) and not os.path.exists(cache._path(14, 1, 0))
+    reopened = tileCache.TileCache(directory, 5 * TILE_BYTES, upstream.url('{z}/{x}/{y}.png'))
+    assert reopened.stats()['bytes'] == 5 * TILE_BYTES
+    reopened.close()
+
+
+def test_prefetchCoversTheRideWithoutMoreDownloads(upstream, cache):
+    queued = cache.prefetch(RIDE_BOUNDS, 1280, 720)
+    waitForDownloads(cache)
+    tiles = tileCache.prefetchTiles(RIDE_BOUNDS, 1280, 720)
+    assert 0 < queued == len(tiles) <= tileCache.MAX_PREFETCH_TILES
+    assert tileCache.fitZoom(RIDE_BOUNDS, 1280, 720) in set(zoom for zoom, x, y in tiles)
+    downloads = upstream.count()
+    for zoom, x, y in tiles:
+        assert cache.get(zoom, x, y) == tileBody(upstream, zoom, x, y)
+    assert upstream.count() == downloads
+    assert cache.prefetch(RIDE_BOUNDS, 1280, 720) == 0
+
+
+def test_staleTilesAreRefreshedOnlineAndServedOffline(upstream, cache):
+    cache.get(3, 4, 2)
+    cache.maxAge = 0
+    cache.get(3, 4, 2)
+    assert upstream.count() == 2
+    upstream.stop()
+    assert cache.get(3, 4, 2) == tileBody(upstream, 3, 4, 2)
+    assert cache.get(3, 4, 3) is None
+    assert cache.stats()['staleHits'] == 1
+
+
+def test_mapServerServesPageTilesAndRoutes(upstream, cache):
+    server = tileCache.MapServer(cache)
+    server.addRoute('heat', lambda rest: b'heat ' + rest.encode() if rest.endswith('.png') else None)
+    try:
+        def get(path):
+            try:
+                with urllib.request.urlopen(server.url(path)) as response:
+                    return response.status, response.read()
+            except urllib.error.HTTPError as error:
+                return error.code, None
+
+        status, page = get('maparea.html')
+        assert status == 200 and b'tiles/{z}/{x}/{y}.png' in page
+        # the CDN the page falls back to without a local copy of Leaflet
+        for name in ('leaflet.js', 'leaflet.css'):
+            assert (tileCache.LEAFLET_URL + name).encode() in page
+        assert get('tiles/12/2260/1304.png') == (200, tileBody(upstream, 12, 2260, 1304))
+        assert get('heat/0/1/2/3.png') == (200, b'heat 0/1/2/3.png')
+        for path in ('heat/nonsense', 'tiles/1/2/three.png', 'assets/unknown.js', 'elsewhere'):
+            assert get(path)[0] == 404
+    finally:
+        server.close()
@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+import pytest
+
+import trackAnalytics
+
+# latitude step of 10 m along a meridian
+STEP = math.degrees(10.0 / trackAnalytics.EARTH_RADIUS)
+
+
+@pytest.fixture
+def pausedRide():
+    # 60 s at 10 m/s, 20 s standing, an auto-pause gap of 120 s covering
+    # 200 m, then 10 s at 10 m/s; climbs 50 m, then descends 20 m
+    times = np.concatenate((np.arange(0, 81), np.arange(200, 211))).astype(float)
+    position = np.concatenate((np.arange(0, 61), np.full(20, 60), 80 + np.arange(0, 11)))
+    ele = np.concatenate((np.zeros(10), np.linspace(0, 50, 21), np.full(30, 50.0), np.linspace(50, 30, 11),
+                          np.full(19, 30.0)))
+    return dict(lat=54.0 + position * STEP, lon=np.full(len(times), 18.5), ele=ele, times=times,
+                hr=np.full(len(times), 150.0))
+
+
+def test_segmentDistancesAlongAMeridian():
+    lat = np.array([54.0, 54.0 + STEP, 55.0 + STEP])
+    distances = trackAnalytics.segmentDistances(lat, np.full(3, 18.5))
+    np.testing.assert_allclose(distances, [10.0, trackAnalytics.EARTH_RADIUS * math.pi / 180])
+
+
+def test_movingTimeLeavesOutStopsAndPauses(pausedRide):
+    result = trackAnalytics.analyse(**pausedRide)
+    assert result['distance'] == pytest.approx(900.0)
+    assert result['elapsedTime'] == 210.0
+    assert result['movingTime'] == 70.0
+    assert result['movingSpeed'] == pytest.approx(36.0)
+    assert result['maxSpeed'] == pytest.approx(36.0)
+    assert len(result['speed']) == len(pausedRide['times'])
+
+
+def test_climbIsMeasuredOnTheSmoothedElevation(pausedRide):
+    result = trackAnalytics.analyse(**pausedRide)
+    assert result['elevationGain'] == pytest.approx(50.0)
+    assert result['elevationLoss'] == pytest.approx(20.0)
+    # 1 m of noise on every point climbs 50 m unsmoothed
+    noise = np.tile([0.0, 1.0], 50)
+    assert trackAnalytics.analyse(np.zeros(100), np.zeros(100), noise)['elevationGain'] < 5.0
+
+
+def test_effortsAndHeartRateZones(pausedRide):
+    result = trackAnalytics.analyse(**pausedRide)
+    assert result['bestEfforts'][60]['speed'] == pytest.approx(36.0)
+    assert result['bestEfforts'][60]['hr'] == pytest.approx(150.0)
+    assert 300 not in result['bestEfforts']
+    # 150 bpm is zone 3 of 190
+    assert result['hrZones'] == [0.0, 0.0, 0.0, 210.0, 0.0, 0.0]
+
+
+def test_pointsSharingATimestampAreOneStep(pausedRide):
+    assert list(trackAnalytics.timeSteps(np.array([0.0, 0.0, 1.0, 1.0, 1.0, 2.0]))) == [0, 2, 5]
+    # every point stamped twice, as Amazfit batches do, keeps the result
+    batched = dict((name, np.repeat(values, 2)) for name, values in pausedRide.items())
+    result = trackAnalytics.analyse(**batched)
+    assert result['movingTime'] == 70.0
+    assert result['distance'] == pytest.approx(900.0)
+
+
+def test_withoutTimestampsOnlyDistanceAndClimb(pausedRide):
+    result = trackAnalytics.analyse(pausedRide['lat'], pausedRide['lon'], pausedRide['ele'])
+    assert result['distance'] == pytest.approx(900.0)
+    assert result['elevationGain'] == pytest.approx(50.0)
+    assert result['movingTime'] is result['elapsedTime'] is result['speed'] is result['hrZones'] is None
+    assert result['bestEfforts'] == {}
+
+
+def test_singlePoint():
+    result = trackAnalytics.analyse([54.0], [18.5], [12.0], [0.0], [150.0])
+    assert (result['distance'], result['elevationGain'], result['elevationLoss']) == (0.0, 0.0, 0.0)
+    assert result['movingTime'] is None and result['bestEfforts'] == {}
@@ -0,0 +1,94 @@
+import datetime
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+import bulkImport
+import gpxParse
+import gpxSources
+import sqlAlch
+import trackData
+import trackExport
+
+
+@pytest.fixture
+def stored(database, tmp_path, ride, gpxFile):
+    # two imported rides, as trackColumns() of the stored tracks in export
+    # order
+    start = datetime.datetime(2021, 5, 2, 8, 30, tzinfo=datetime.timezone.utc)
+    paths = [gpxFile(tmp_path / 'first.gpx', [ride(400, 1)], 'garmin'),
+             gpxFile(tmp_path / 'second.gpx', [ride(250, 2, (50.06, 19.94))], 'amazfit', start)]
+    report = bulkImport.importFiles('anna', paths, workers=1)
+    assert len(report.imported) == 2
+    return [trackExport.trackColumns(track) for track in sqlAlch.streamTracks('anna')]
+
+
+def parsedColumns(source):
+    record = gpxParse.GpxRecord('anna')
+    record.parseFile(source)
+    assert record.error is None
+    return dict((name, record.track.column(name)) for name in trackData.COLUMNS)
+
+
+def assertSameColumns(actual, expected):
+    for name in trackData.COLUMNS:
+        np.testing.assert_allclose(actual[name], expected[name], rtol=0, atol=1e-9, equal_nan=True, err_msg=name)
+
+
+def concatenated(tracks):
+    return dict((name, np.concatenate([track[name] for track in tracks])) for name in trackData.COLUMNS)
+
+
+def test_zipExportReimportsTrackByTrack(stored, tmp_path):
+    path = str(tmp_path / 'export.zip')
+    assert trackExport.exportTracks('anna', path, workers=1) == 2
+    members = sorted(source for source, data in gpxSources.expandSources([path]))
+    assert len(members) == 2
+    # member names start with the ride date, so they sort like the export
+    for source, expected in zip(members, stored):
+        assertSameColumns(parsedColumns(source), expected)
+
+
+@pytest.mark.parametrize('name', ['export.gpx', 'export.gpx.gz'])
+def test_gpxExportReimportsAsOneTrack(stored, tmp_path, name):
+    path = str(tmp_path / name)
+    trackExport.exportTracks('anna', path, workers=1)
+    assertSameColumns(parsedColumns(path), concatenated(stored))
+
+
+def test_reimportingAnExportFindsEveryTrackKnown(stored, tmp_path):
+    path = str(tmp_path / 'export.zip')
+    trackExport.exportTracks('anna', path, workers=1)
+    report = bulkImport.importFiles('anna', [path], workers=1)
+    assert (len(report.imported), len(report.skipped)) == (0, 2)
+
+
+@pytest.mark.parametrize('name', ['export.geojson', 'export.ndjson.gz'])
+def test_geojsonExportKeepsPointsAndTimes(stored, tmp_path, name):
+    path = str(tmp_path / name)
+    trackExport.exportTracks('anna', path, workers=1)
+    with (gzip.open if name.endswith('.gz') else open)(path, 'rt', encoding='utf-8') as output:
+        if 'ndjson' in name:
+            features = [json.loads(line) for line in output]
+        else:
+            features = json.load(output)['features']
+    assert len(features) == len(stored)
+    for feature, expected in zip(features, stored):
+        lon, lat, ele = np.array(feature['geometry']['coordinates']).T
+        properties = feature['properties']['coordinateProperties']
+        times = [gpxParse.parseGpxTime(text).timestamp() for text in properties['times']]
+        assertSameColumns(dict(lat=lat, lon=lon, ele=ele, time=np.array(times), hr=np.array(properties['hr']),
+                               speed=np.array(properties['speed'])), expected)
+
+
+def test_parquetExportKeepsEveryPoint(stored, tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'export.parquet')
+    trackExport.exportTracks('anna', path, workers=1)
+    table = parquet.read_table(path)
+    columns = dict((name, table.column(name).to_numpy()) for name in trackData.COLUMNS)
+    # times are stored as timestamps in milliseconds
+    columns['time'] = columns['time'].astype('datetime64[ms]').astype(np.int64) / 1000.0
+    assertSameColumns(columns, concatenated(stored))
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+
+import sqlAlch
+import trackList
+
+
+@pytest.mark.parametrize('text, filters', [
+    ('', {}),
+    ('2024', dict(dateFrom=datetime(2024, 1, 1), dateTo=datetime(2025, 1, 1))),
+    ('2024-12', dict(dateFrom=datetime(2024, 12, 1), dateTo=datetime(2025, 1, 1))),
+    ('2024-02-29', dict(dateFrom=datetime(2024, 2, 29), dateTo=datetime(2024, 3, 1))),
+    ('>50', dict(minDistance=50.0)),
+    ('<100km >=20.5KM', dict(maxDistance=100.0, minDistance=20.5)),
+    ('  2023-05   >10 ', dict(dateFrom=datetime(2023, 5, 1), dateTo=datetime(2023, 6, 1), minDistance=10.0)),
+])
+def test_parseFilter(text, filters):
+    assert trackList.parseFilter(text) == filters
+
+
+@pytest.mark.parametrize('text', ['ride', '>', '<fifty', '2024-13', '2024/05', '50'])
+def test_parseFilterRejectsUnknownWords(text):
+    with pytest.raises(ValueError, match='Unknown filter'):
+        trackList.parseFilter(text)
+
+
+def addTracks(ride, track, specs, user='anna'):
+    # (date, distance) per track
+    rows = [dict(track(ride(50, seed, (54.0 + seed * 0.01, 18.0)), user, date), distance=distance)
+            for seed, (date, distance) in enumerate(specs, len(sqlAlch.getTrackListIds(user)) + 100 * len(user))]
+    return sqlAlch.insertGpxTracks(rows)
+
+
+def changesOf(action):
+    changes = []
+
+    def listener(event, trackId):
+        changes.append((event, trackId))
+
+    sqlAlch.addTrackListener(listener)
+    try:
+        action()
+    finally:
+        sqlAlch.removeTrackListener(listener)
+    return changes
+
+
+@pytest.fixture
+def listed(database, ride, track):
+    sqlAlch.insertUser('ben', 'secret')
+    trackIds = addTracks(ride, track, [(datetime(2024, month, 1 + month), 10.0 * month) for month in range(1, 10)]
+                         + [(None, 35.0), (datetime(2024, 3, 2), 30.0)])
+    return trackIds
+
+
+@pytest.mark.parametrize('sortKey, descending, text', [
+    ('date', False, ''), ('date', True, ''), ('distance', False, '>25'), ('distance', True, '2024-03'),
+    ('avgHr', False, '<60'),
+])
+@pytest.mark.parametrize('maxPlaced', [trackList.MAX_PLACED_TRACKS, 1])
+def test_applyChangesKeepsTheListInOrder(listed, ride, track, monkeypatch, sortKey, descending, text, maxPlaced):
+    monkeypatch.setattr(trackList, 'MAX_PLACED_TRACKS', maxPlaced)
+    model = trackList.TrackListModel('anna', sortKey, descending)
+    model.setFilter(text)
+    for index in range(len(model)):
+        model.row(index)
+
+    def change():
+        # listed[-1] has the highest id, which SQLite gives to the next insert
+        with sqlAlch.transaction() as conn:
+            for trackId in (listed[0], listed[4], listed[-1]):
+                sqlAlch.deleteSelectedTrack(trackId, conn)
+        addTracks(ride, track, [(datetime(2024, 3, 2), 30.0), (None, 5.0), (datetime(2023, 12, 31), 55.0)])
+        addTracks(ride, track, [(datetime(2024, 3, 5), 31.0)], 'ben')
+        with sqlAlch.transaction() as conn:
+            # inserted and deleted again before the list hears of it
+            sqlAlch.deleteSelectedTrack(addTracks(ride, track, [(datetime(2024, 3, 3), 32.0)])[0], conn)
+
+    model.applyChanges(changesOf(change))
+    assert list(model.ids) == sqlAlch.getTrackListIds('anna', sortKey, descending, **trackList.parseFilter(text))
+    assert not set(model.rows) & {listed[0], listed[4], listed[-1]}
+    assert [model.cell(index, 0) for index in range(len(model))] == [
+        trackList.formatCell(sqlAlch.getTrackListRows([trackId])[trackId], 'date') for trackId in model.ids]
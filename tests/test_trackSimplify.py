@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+import MapMaker
+import gpxParse
+import sqlAlch
+import trackCodec
+import trackSimplify
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def amazfitPoints():
+    record = gpxParse.GpxRecord('anna')
+    record.parseFile(os.path.join(ROOT, 'gpx', 'amazfit1.gpx'))
+    return record.track.points()
+
+
+@pytest.fixture
+def generatedPoints(ride):
+    return lambda count=20000: ride(count, 4)[:, :2]
+
+
+def levelIndexes(points):
+    # {tolerance: indexes of the points kept}
+    weight = trackSimplify.significance(points)
+    return dict((tolerance, np.flatnonzero(weight >= tolerance)) for tolerance in trackSimplify.LOD_TOLERANCES)
+
+
+def recursiveDouglasPeucker(xy, first, last, tolerance, kept):
+    if last - first < 2:
+        return
+    inside = xy[first + 1:last]
+    distance = trackSimplify.segmentDistances(inside, np.broadcast_to(xy[first], inside.shape),
+                                              np.broadcast_to(xy[last], inside.shape))
+    index = int(np.argmax(distance))
+    if distance[index] > tolerance:
+        split = first + 1 + index
+        kept.add(split)
+        recursiveDouglasPeucker(xy, first, split, tolerance, kept)
+        recursiveDouglasPeucker(xy, split, last, tolerance, kept)
+
+
+@pytest.mark.parametrize('source', ['amazfit', 'generated'])
+def test_levelsNestAndStayWithinTheirTolerance(generatedPoints, source):
+    points = amazfitPoints() if source == 'amazfit' else generatedPoints()
+    xy = trackSimplify.projectMeters(points)
+    levels = levelIndexes(points)
+    tolerances = sorted(levels)
+    for finer, coarser in zip(tolerances, tolerances[1:]):
+        assert set(levels[coarser]) <= set(levels[finer])
+        assert len(levels[coarser]) < len(levels[finer])
+    for tolerance, kept in levels.items():
+        assert kept[0] == 0 and kept[-1] == len(points) - 1
+        # every dropped point lies within the tolerance of the segment
+        # between the kept points around it
+        segment = np.searchsorted(kept, np.arange(len(points)), side='right') - 1
+        segment = np.minimum(segment, len(kept) - 2)
+        distance = trackSimplify.segmentDistances(xy, xy[kept[segment]], xy[kept[segment + 1]])
+        assert distance.max() <= tolerance + 1e-6
+        assert len(kept) < len(points) / 4
+
+
+def test_levelsMatchARecursiveDouglasPeucker(generatedPoints):
+    points = generatedPoints(3000)
+    xy = trackSimplify.projectMeters(points)
+    for tolerance, kept in levelIndexes(points).items():
+        reference = {0, len(points) - 1}
+        recursiveDouglasPeucker(xy, 0, len(points) - 1, tolerance, reference)
+        # the nested levels may keep a few more points than an independent
+        # run, never fewer
+        assert reference <= set(kept)
+
+
+def test_buildLevelsPacksEveryLevel(generatedPoints):
+    points = generatedPoints(5000)
+    levels = trackSimplify.buildLevels(points)
+    assert sorted(levels) == sorted(trackSimplify.LOD_TOLERANCES)
+    for tolerance, kept in levelIndexes(points).items():
+        np.testing.assert_array_equal(np.array(trackCodec.decode(levels[tolerance])), points[kept])
+
+
+def test_mapDrawsTheFinestLevelWithinItsBudget(database, ride, track):
+    rows = ride(MapMaker.MAX_MAP_POINTS + 3000, 5)
+    trackId, = sqlAlch.insertGpxTracks([track(rows)])
+    full = trackCodec.decode(sqlAlch.getTrackPayload(trackId)['points'])
+    drawn = trackCodec.decode(sqlAlch.getMapPoints(trackId, MapMaker.MAX_MAP_POINTS))
+    finest = levelIndexes(rows[:, :2])[min(trackSimplify.LOD_TOLERANCES)]
+    assert len(drawn) == len(finest) <= MapMaker.MAX_MAP_POINTS
+    assert len(trackCodec.decode(sqlAlch.getMapPoints(trackId, len(full)))) == len(full)
+    assert len(MapMaker.trackScript(drawn)) < len(MapMaker.trackScript(full)) / 2
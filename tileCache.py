@@ -0,0 +1,364 @@
+import logging
+import math
+import mimetypes
+import os
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+MAP_PAGE = os.path.join(APP_DIR, 'maparea.html')
+
+TILE_URL = os.environ.get('GPX_TILE_URL', 'https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png')
+TILE_SUBDOMAINS = 'abc'
+CACHE_DIR = os.environ.get('GPX_TILE_CACHE_DIR', 'tileCache')
+DEFAULT_DISK_BYTES = 256 * 1024 * 1024
+# Cached tiles older than this are downloaded again when the tile server can
+# be reached; offline they are still served.
+MAX_AGE_SECONDS = 7 * 24 * 3600
+# The OpenStreetMap tile usage policy asks for at most two connections and
+# an identifying User-Agent; prefetching stays well clear of bulk downloads.
+FETCH_WORKERS = 2
+FETCH_TIMEOUT = 10
+USER_AGENT = 'wxpython-gpx tile cache'
+MAX_LATITUDE = 85.0511287798
+MAX_PREFETCH_TILES = 200
+PREFETCH_DEPTH = 3
+PREFETCH_MAX_ZOOM = 16
+
+TILE_PATH = re.compile(r'^(\d+)/(\d+)/(\d+)\.png$')
+
+# Files maparea.html needs, kept under ASSET_DIR. One that is missing is
+# downloaded once from here and kept; `gpxCli.py assets` fetches them all
+# ahead, for machines that are installed offline.
+ASSET_DIR = os.path.join(APP_DIR, 'assets')
+LEAFLET_URL = 'https://cdn.jsdelivr.net/npm/leaflet@1.6.0/dist/'
+ASSETS = dict(('leaflet/' + name, LEAFLET_URL + name) for name in (
+    'leaflet.js', 'leaflet.css', 'images/layers.png', 'images/layers-2x.png', 'images/marker-icon.png',
+    'images/marker-icon-2x.png', 'images/marker-shadow.png'))
+
+
+def download(url, path, timeout=FETCH_TIMEOUT):
+    # Body of `url`, also written to `path`; the file is replaced whole so a
+    # concurrent reader never sees half of it.
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = response.read()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '%s.%d.tmp' % (path, threading.get_ident())
+    with open(temporary, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+    return data
+
+
+def assetPath(name):
+    return os.path.join(ASSET_DIR, *name.split('/'))
+
+
+def readAsset(name):
+    # Bytes of one of ASSETS, or None when it is not one or cannot be had.
+    if name not in ASSETS:
+        return None
+    try:
+        with open(assetPath(name), 'rb') as assetFile:
+            return assetFile.read()
+    except FileNotFoundError:
+        pass
+    try:
+        return download(ASSETS[name], assetPath(name))
+    except OSError as error:
+        log.warning('cannot download %s: %s', ASSETS[name], error)
+        return None
+
+
+def fetchAssets(force=False):
+    # Downloads the missing ASSETS (every one with `force`); names fetched.
+    fetched = []
+    for name, url in sorted(ASSETS.items()):
+        if force or not os.path.exists(assetPath(name)):
+            download(url, assetPath(name))
+            fetched.append(name)
+    return fetched
+
+
+def mercatorPixel(lat, lon, zoom):
+    size = 256 << zoom
+    sinLat = math.sin(math.radians(max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)))
+    x = (lon + 180.0) / 360.0 * size
+    y = (0.5 - math.log((1 + sinLat) / (1 - sinLat)) / (4 * math.pi)) * size
+    return x, y
+
+
+def boundsTiles(bounds, zoom):
+    # (zoom, x, y) of the map tiles covering (minLat, maxLat, minLon, maxLon)
+    minLat, maxLat, minLon, maxLon = bounds
+    last = (1 << zoom) - 1
+    left, top = mercatorPixel(maxLat, minLon, zoom)
+    right, bottom = mercatorPixel(minLat, maxLon, zoom)
+    columns = range(max(int(left) >> 8, 0), min(int(right) >> 8, last) + 1)
+    rows = range(max(int(top) >> 8, 0), min(int(bottom) >> 8, last) + 1)
+    return [(zoom, x, y) for x in columns for y in rows]
+
+
+def fitZoom(bounds, width, height):
+    # About the zoom Leaflet's fitBounds() picks for a width x height map.
+    minLat, maxLat, minLon, maxLon = bounds
+    for zoom in range(PREFETCH_MAX_ZOOM, 0, -1):
+        left, top = mercatorPixel(maxLat, minLon, zoom)
+        right, bottom = mercatorPixel(minLat, maxLon, zoom)
+        if right - left <= width and bottom - top <= height:
+            return zoom
+    return 0
+
+
+def prefetchTiles(bounds, width=1280, height=720):
+    # Tiles of the track's bounding box at the zoom it is shown at and a few
+    # deeper ones, as many whole zooms as fit in MAX_PREFETCH_TILES.
+    first = fitZoom(bounds, width, height)
+    tiles = []
+    for zoom in range(first, min(first + PREFETCH_DEPTH, PREFETCH_MAX_ZOOM) + 1):
+        zoomTiles = boundsTiles(bounds, zoom)
+        if tiles and len(tiles) + len(zoomTiles) > MAX_PREFETCH_TILES:
+            break
+        tiles.extend(zoomTiles[:MAX_PREFETCH_TILES])
+    return tiles
+
+
+class TileCache:
+    # Disk cache in front of the TILE_URL tile server. Tiles are stored as
+    # directory/z/x/y.png; once they take more than maxBytes the least
+    # recently used are deleted. Misses are downloaded on a small thread
+    # pool and concurrent requests for one tile share the same download.
+
+    def __init__(self, directory=CACHE_DIR, maxBytes=DEFAULT_DISK_BYTES, url=TILE_URL, workers=FETCH_WORKERS,
+                 maxAge=MAX_AGE_SECONDS):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.url = url
+        self.maxAge = maxAge
+        self.files = OrderedDict()
+        self.used = 0
+        self.pending = {}
+        self.hits = 0
+        self.staleHits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.errors = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tileFetch')
+        os.makedirs(directory, exist_ok=True)
+        self._loadIndex()
+
+    def _loadIndex(self):
+        # Files are ordered by when they were downloaded, the best guess of
+        # use order a previous run leaves behind.
+        entries = []
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                elif name.endswith('.png'):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(entries):
+            self.files[path] = size
+            self.used += size
+        self._evict()
+
+    def _path(self, zoom, x, y):
+        return os.path.join(self.directory, str(zoom), str(x), '%d.png' % y)
+
+    def _tileUrl(self, zoom, x, y):
+        return self.url.format(s=TILE_SUBDOMAINS[(x + y) % len(TILE_SUBDOMAINS)], z=zoom, x=x, y=y)
+
+    def _cached(self, path):
+        # (data, fresh) of a cached tile, or (None, False)
+        with self.lock:
+            if path not in self.files:
+                return None, False
+            self.files.move_to_end(path)
+        try:
+            with open(path, 'rb') as tileFile:
+                data = tileFile.read()
+            fresh = time.time() - os.path.getmtime(path) < self.maxAge
+        except OSError:
+            # evicted meanwhile
+            return None, False
+        return data, fresh
+
+    def _isFresh(self, path):
+        with self.lock:
+            if path not in self.files:
+                return False
+        try:
+            return time.time() - os.path.getmtime(path) < self.maxAge
+        except OSError:
+            return False
+
+    def _fetch(self, zoom, x, y):
+        path = self._path(zoom, x, y)
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                future = self.executor.submit(self._download, zoom, x, y, path)
+                self.pending[path] = future
+                future.add_done_callback(lambda done: self._fetched(path))
+        return future
+
+    def _fetched(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+
+    def _download(self, zoom, x, y, path):
+        url = self._tileUrl(zoom, x, y)
+        try:
+            data = download(url, path)
+        except OSError as error:
+            log.debug('cannot download %s: %s', url, error)
+            with self.lock:
+                self.errors += 1
+            return None
+        with self.lock:
+            self.downloads += 1
+            self.used -= self.files.pop(path, 0)
+            self.files[path] = len(data)
+            self.used += len(data)
+            self._evict()
+        return data
+
+    def _evict(self):
+        with self.lock:
+            while self.used > self.maxBytes and len(self.files) > 1:
+                path, size = self.files.popitem(last=False)
+                self.used -= size
+                self.evictions += 1
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, zoom, x, y, timeout=FETCH_TIMEOUT):
+        # PNG bytes of tile zoom/x/y, or None when it is neither cached nor
+        # downloadable. A stale tile is kept when downloading it fails.
+        data, fresh = self._cached(self._path(zoom, x, y))
+        if fresh:
+            with self.lock:
+                self.hits += 1
+            return data
+        try:
+            fetched = self._fetch(zoom, x, y).result(timeout)
+        except TimeoutError:
+            fetched = None
+        with self.lock:
+            if fetched is not None:
+                self.misses += 1
+            elif data is not None:
+                self.staleHits += 1
+        return fetched if fetched is not None else data
+
+    def prefetch(self, bounds, width=1280, height=720):
+        # Queues the missing tiles of a track's bounding box (see
+        # prefetchTiles()) without waiting for them; how many were queued.
+        queued = 0
+        for zoom, x, y in prefetchTiles(bounds, width, height):
+            if not self._isFresh(self._path(zoom, x, y)):
+                self._fetch(zoom, x, y)
+                queued += 1
+        return queued
+
+    def stats(self):
+        with self.lock:
+            return dict(files=len(self.files), bytes=self.used, hits=self.hits, staleHits=self.staleHits,
+                        misses=self.misses, downloads=self.downloads, errors=self.errors,
+                        evictions=self.evictions, pending=len(self.pending))
+
+    def close(self):
+        try:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # Python < 3.9 cannot drop queued work
+            self.executor.shutdown(wait=False)
+
+
+class MapRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, contentType, body, maxAge = self.server.mapServer.respond(urllib.parse.urlsplit(self.path).path)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=%d' % maxAge if maxAge else 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s ' + format, self.address_string(), *args)
+
+
+class MapServer:
+    # HTTP server on 127.0.0.1 the map WebView loads maparea.html from. It
+    # serves /assets/ (see ASSETS), /tiles/z/x/y.png through a TileCache, and
+    # whatever addRoute() adds, e.g. the heatmap layer. Relative URLs in the
+    # page work the same whichever free port it got.
+
+    def __init__(self, cache, page=MAP_PAGE, port=0):
+        self.cache = cache
+        self.page = page
+        self.routes = {}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), MapRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mapServer = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='mapServer', daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:%d/%s' % (self.port, path)
+
+    def addRoute(self, prefix, handler):
+        # handler(rest of the path) returns PNG bytes, or None for 404
+        self.routes[prefix] = handler
+
+    def respond(self, path):
+        # (status, content type, body, max-age seconds) for a request path
+        prefix, _, rest = path.lstrip('/').partition('/')
+        try:
+            if prefix in ('', os.path.basename(self.page)) and not rest:
+                with open(self.page, 'rb') as page:
+                    return 200, 'text/html; charset=utf-8', page.read(), 0
+            if prefix == 'assets':
+                data = readAsset(rest)
+                contentType = mimetypes.guess_type(rest)[0] or 'application/octet-stream'
+                maxAge = 24 * 3600
+            elif prefix == 'tiles' and TILE_PATH.match(rest):
+                zoom, x, y = (int(value) for value in TILE_PATH.match(rest).groups())
+                data, contentType, maxAge = self.cache.get(zoom, x, y), 'image/png', 24 * 3600
+            elif prefix in self.routes:
+                data, contentType, maxAge = self.routes[prefix](rest), 'image/png', 0
+            else:
+                data = None
+        except Exception:
+            log.exception('cannot serve %s', path)
+            return 500, 'text/plain', b'internal error', 0
+        if data is None:
+            return 404, 'text/plain', b'not found', 0
+        return 200, contentType, data, maxAge
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.cache.close()
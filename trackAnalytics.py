@@ -0,0 +1,112 @@
+import numpy as np
+
+import instrument
+
+EARTH_RADIUS = 6378.137 * 1000
+
+# Below this speed (m/s) a segment counts as standing still, and gaps longer
+# than PAUSE_GAP seconds (recording auto-paused) never count as moving.
+MOVING_SPEED = 1.0
+PAUSE_GAP = 30.0
+# Points averaged on each side when smoothing elevation before gain/loss.
+ELEVATION_SMOOTHING = 5
+BEST_EFFORT_WINDOWS = (60, 300, 1200)
+DEFAULT_MAX_HR = 190.0
+# Lower bounds of HR zones 1-5 as fractions of the maximum heart rate.
+HR_ZONES = (0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def segmentDistances(lat, lon):
+    # Haversine distance in metres between consecutive points.
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def smooth(values, radius=ELEVATION_SMOOTHING):
+    if len(values) < 2 * radius + 1:
+        return values
+    kernel = np.ones(2 * radius + 1) / (2 * radius + 1)
+    padded = np.pad(values, radius, mode='edge')
+    return np.convolve(padded, kernel, mode='valid')
+
+
+def timeSteps(times):
+    # Indices of the first point of every distinct timestamp. Some watches
+    # (Amazfit) stamp batches of points with the same second, so speeds are
+    # computed between distinct timestamps rather than between points.
+    return np.flatnonzero(np.concatenate(([True], np.diff(times) > 0)))
+
+
+def bestEfforts(times, cumulative, hr, windows=BEST_EFFORT_WINDOWS):
+    # For every window length: the fastest average speed (km/h) and highest
+    # average HR over any stretch of at least that many seconds.
+    efforts = {}
+    if len(times) < 2:
+        return efforts
+    hrArea = np.concatenate(([0.0], np.cumsum((hr[1:] + hr[:-1]) / 2 * np.diff(times))))
+    for window in windows:
+        end = np.searchsorted(times, times + window, side='left')
+        valid = end < len(times)
+        if not valid.any():
+            continue
+        start = np.flatnonzero(valid)
+        end = end[valid]
+        duration = times[end] - times[start]
+        speed = (cumulative[end] - cumulative[start]) / duration * 3.6
+        heart = (hrArea[end] - hrArea[start]) / duration
+        efforts[window] = dict(speed=float(speed.max()), hr=float(heart.max()))
+    return efforts
+
+
+def hrZones(hr, dt, maxHr=DEFAULT_MAX_HR, zones=HR_ZONES):
+    # Seconds spent in each zone (zone 0 = below zone 1); points without a
+    # reading (0) are ignored.
+    bounds = np.concatenate(([0.0], np.asarray(zones) * maxHr, [np.inf]))
+    segmentHr = (hr[1:] + hr[:-1]) / 2
+    measured = (hr[1:] > 0) & (hr[:-1] > 0)
+    seconds, _ = np.histogram(segmentHr[measured], bins=bounds, weights=dt[measured])
+    return [float(value) for value in seconds]
+
+
+@instrument.timed('analytics')
+def analyse(lat, lon, ele, times=None, hr=None, maxHr=DEFAULT_MAX_HR):
+    # Columnar inputs (NumPy arrays or anything array-like, times in epoch
+    # seconds); returns plain floats/lists so the result can be stored.
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    ele = np.asarray(ele, dtype=float)
+    distances = segmentDistances(lat, lon)
+    cumulative = np.concatenate(([0.0], np.cumsum(distances)))
+    climb = np.diff(smooth(ele)) if len(ele) > 1 else np.zeros(0)
+    result = dict(distance=float(cumulative[-1]) if len(cumulative) else 0.0,
+                  elevationGain=float(climb[climb > 0].sum()),
+                  elevationLoss=float(-climb[climb < 0].sum()),
+                  movingTime=None, elapsedTime=None, maxSpeed=None, movingSpeed=None,
+                  bestEfforts={}, hrZones=None, speed=None)
+    if times is None or len(lat) < 2:
+        return result
+    times = np.asarray(times, dtype=float)
+    steps = timeSteps(times)
+    stepTimes = times[steps]
+    stepDistance = cumulative[steps]
+    dt = np.diff(stepTimes)
+    covered = np.diff(stepDistance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stepSpeed = np.where(dt > 0, covered / dt, 0.0)
+    moving = (stepSpeed >= MOVING_SPEED) & (dt <= PAUSE_GAP)
+    movingTime = float(dt[moving].sum())
+    if len(stepSpeed):
+        speed = np.interp(times, stepTimes[:-1] + dt / 2, stepSpeed)
+    else:
+        speed = np.zeros(len(times))
+    result.update(elapsedTime=float(times[-1] - times[0]), movingTime=movingTime,
+                  maxSpeed=float(smooth(stepSpeed, 1).max() * 3.6) if len(stepSpeed) else 0.0,
+                  movingSpeed=float(covered[moving].sum() / movingTime * 3.6) if movingTime else 0.0,
+                  speed=speed)
+    stepHr = np.asarray(hr, dtype=float)[steps] if hr is not None else np.zeros(len(steps))
+    result['bestEfforts'] = bestEfforts(stepTimes, stepDistance, stepHr)
+    if hr is not None:
+        result['hrZones'] = hrZones(stepHr, dt, maxHr)
+    return result
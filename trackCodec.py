@@ -0,0 +1,132 @@
+import hashlib
+import json
+import struct
+import zlib
+from array import array
+
+import instrument
+
+# NumPy is imported on first use so that importing this module (and sqlAlch)
+# stays cheap at startup; without NumPy the array module is used.
+np = None
+_numpyChecked = False
+
+
+def _numpy():
+    global np, _numpyChecked
+    if not _numpyChecked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+        _numpyChecked = True
+    return np
+
+# Binary layout of a packed column blob:
+#   magic(4s) version(B) dtype(c) flags(B) columns(B) count(I)  + payload
+# payload is `count * columns` little-endian values, zlib compressed when
+# FLAG_ZLIB is set.
+MAGIC = b'GPXA'
+VERSION = 1
+HEADER = struct.Struct('<4sBcBBI')
+FLAG_ZLIB = 0x01
+DTYPES = {b'd': '<f8', b'f': '<f4'}
+
+
+def encode(values, columns=1, dtype='d', compress=True):
+    np = _numpy()
+    if np is not None:
+        data = np.ascontiguousarray(values, dtype=DTYPES[dtype.encode()])
+        payload = data.tobytes()
+        count = data.size // columns
+    else:
+        flat = array(dtype)
+        for value in values:
+            if columns > 1:
+                flat.extend(value)
+            else:
+                flat.append(value)
+        if struct.pack('=H', 1) != struct.pack('<H', 1):
+            flat.byteswap()
+        payload = flat.tobytes()
+        count = len(flat) // columns
+    flags = 0
+    if compress:
+        packed = zlib.compress(payload, 6)
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, VERSION, dtype.encode(), flags, columns, count) + payload
+
+
+def encodePoints(points, compress=True):
+    return encode(points, columns=2, dtype='d', compress=compress)
+
+
+def encodeSeries(values, compress=True):
+    return encode(values, columns=1, dtype='f', compress=compress)
+
+
+def encodeTimes(values, compress=True):
+    # epoch seconds need float64
+    return encode(values, columns=1, dtype='d', compress=compress)
+
+
+def contentHash(*blobs):
+    # Hex digest identifying the stored content of a track, used to key caches.
+    digest = hashlib.sha1()
+    for blob in blobs:
+        digest.update(struct.pack('<Q', len(blob)))
+        digest.update(blob)
+    return digest.hexdigest()
+
+
+def isPacked(blob):
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:4]) == MAGIC
+
+
+def count(blob):
+    # Number of rows in a packed blob, read from the header only.
+    if not isPacked(blob):
+        return len(decodeJson(blob))
+    return HEADER.unpack_from(blob)[5]
+
+
+@instrument.timed('decode')
+def decode(blob):
+    # Returns a NumPy view on the blob (no copy for uncompressed data) or an
+    # array.array when NumPy is not installed. Rows that were never migrated
+    # still hold JSON text and are decoded the slow way.
+    instrument.count('bytes.decoded', len(blob))
+    if not isPacked(blob):
+        return decodeJson(blob)
+    magic, version, dtype, flags, columns, count = HEADER.unpack_from(blob)
+    if version != VERSION:
+        raise ValueError('unsupported track blob version %d' % version)
+    payload = memoryview(blob)[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    np = _numpy()
+    if np is not None:
+        values = np.frombuffer(payload, dtype=DTYPES[dtype], count=count * columns)
+        if columns > 1:
+            values = values.reshape(count, columns)
+        return values
+    values = array(dtype.decode())
+    values.frombytes(payload)
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        values.byteswap()
+    return values
+
+
+def decodeJson(text):
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        text = bytes(text).decode()
+    values = json.loads(text)
+    np = _numpy()
+    if np is not None:
+        return np.array(values, dtype=float)
+    if values and isinstance(values[0], list):
+        return array('d', [v for pair in values for v in pair])
+    return array('d', values)
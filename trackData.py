@@ -0,0 +1,92 @@
+from array import array
+
+import numpy as np
+
+import trackCodec
+
+# Per point columns, in the order TrackData.append() takes them.
+COLUMNS = ('lat', 'lon', 'ele', 'time', 'hr', 'speed')
+
+
+def decodeSeries(blob, count):
+    # A stored series as floats, NaN where it is missing (older tracks).
+    values = trackCodec.decode(blob) if blob is not None else None
+    if values is None or len(values) != count:
+        return np.full(count, np.nan)
+    return np.asarray(values, dtype=float)
+
+
+class TrackData:
+    # The points of one track as columns of doubles: array('d') while a
+    # parser appends to them, NumPy arrays once the track is frozen or read
+    # back from storage. column() hands out NumPy views on the same buffers,
+    # so the parser, storage, plots and map share one copy of the data,
+    # 48 bytes per point against ~200 for lists of [lat, lon] lists.
+    __slots__ = COLUMNS + ('_points',)
+
+    def __init__(self, lat=None, lon=None, ele=None, time=None, hr=None, speed=None, points=None):
+        for name, values in zip(COLUMNS, (lat, lon, ele, time, hr, speed)):
+            setattr(self, name, array('d') if values is None else values)
+        # (n, 2) lat/lon array the lat and lon columns are views of, if any
+        self._points = points
+
+    @classmethod
+    def fromPayload(cls, payload):
+        # From a trackPayloads row (or any dict with its blobs). lat and lon
+        # are strided views on the decoded points, nothing is copied.
+        points = np.asarray(trackCodec.decode(payload['points']), dtype=float).reshape(-1, 2)
+        count = len(points)
+        return cls(points[:, 0], points[:, 1], decodeSeries(payload.get('elevation'), count),
+                   decodeSeries(payload.get('time'), count), decodeSeries(payload.get('hr'), count),
+                   decodeSeries(payload.get('speed'), count), points)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def append(self, lat, lon, ele, time, hr, speed):
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.ele.append(ele)
+        self.time.append(time)
+        self.hr.append(hr)
+        self.speed.append(speed)
+
+    def freeze(self):
+        # Swaps the growable arrays for NumPy views on their buffers; the
+        # arrays cannot be resized any more while the views exist.
+        for name in COLUMNS:
+            values = getattr(self, name)
+            if isinstance(values, array):
+                setattr(self, name, np.frombuffer(values, dtype=float))
+        return self
+
+    def column(self, name):
+        values = getattr(self, name)
+        if isinstance(values, array):
+            return np.frombuffer(values, dtype=float)
+        return values
+
+    def points(self):
+        # (n, 2) lat/lon array as trackCodec.encodePoints() and the map take it;
+        # built (one copy) unless the track came from a points blob.
+        if self._points is not None:
+            return self._points
+        return np.column_stack((self.column('lat'), self.column('lon')))
+
+    @property
+    def nbytes(self):
+        return sum(memoryview(getattr(self, name)).nbytes for name in COLUMNS)
+
+    def encode(self):
+        # Blobs for the trackPayloads columns.
+        return dict(points=trackCodec.encodePoints(self.points()), hr=trackCodec.encodeSeries(self.column('hr')),
+                    elevation=trackCodec.encodeSeries(self.column('ele')),
+                    time=trackCodec.encodeTimes(self.column('time')),
+                    speed=trackCodec.encodeSeries(self.column('speed')))
+
+
+def asPoints(track):
+    # (n, 2) lat/lon array for a TrackData or anything array-like.
+    if isinstance(track, TrackData):
+        return track.points()
+    return np.asarray(track, dtype=float).reshape(-1, 2)
@@ -0,0 +1,280 @@
+import gzip
+import json
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import gpxParse
+import sqlAlch
+import trackData
+import workerPool
+
+FORMATS = ('gpx', 'geojson', 'ndjson', 'parquet', 'arrow')
+SUFFIXES = {'.gpx': 'gpx', '.zip': 'gpx', '.geojson': 'geojson', '.json': 'geojson', '.ndjson': 'ndjson',
+            '.parquet': 'parquet', '.arrow': 'arrow'}
+# tracks fetched per cursor batch, and per Parquet row group / Arrow batch
+BATCH_TRACKS = 100
+BUFFER_BYTES = 1024 * 1024
+COMPRESS_LEVEL = 6
+
+# Standard GPX 1.1: <ele> in metres, heart rate and speed in a Garmin
+# TrackPointExtension. gpxParse recognises the creator and reads the files
+# back unchanged (see gpxParse.EXPORT_CREATOR).
+GPX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx version="1.1" creator="%s" xmlns="http://www.topografix.com/GPX/1/1" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v2" '
+              'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">\n'
+              % gpxParse.EXPORT_CREATOR).encode('utf-8')
+GPX_FOOTER = b'</gpx>\n'
+GPX_POINT = '      <trkpt lat="%r" lon="%r">%s%s%s</trkpt>\n'
+GPX_EXTENSIONS = '<extensions><gpxtpx:TrackPointExtension>%s%s</gpxtpx:TrackPointExtension></extensions>'
+# %.10g: TrackPointExtension wants whole beats, which 120.0 would not be
+GPX_HR = '<gpxtpx:hr>%.10g</gpxtpx:hr>'
+GPX_SPEED = '<gpxtpx:speed>%r</gpxtpx:speed>'
+# every value known, the usual case: one format operation per point
+GPX_FULL_POINT = ('      <trkpt lat="%r" lon="%r"><ele>%r</ele><time>%s</time>' + GPX_EXTENSIONS % (GPX_HR, GPX_SPEED)
+                  + '</trkpt>\n')
+
+GEOJSON_HEADER = b'{"type":"FeatureCollection","features":[\n'
+GEOJSON_FOOTER = b'\n]}\n'
+
+PROPERTY_COLUMNS = ('date', 'distance', 'rideTime', 'avgSpeed', 'avgHr', 'movingTime', 'elevationGain',
+                    'elevationLoss', 'maxSpeed', 'pointCount')
+
+
+def formatForPath(path):
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    format = SUFFIXES.get(os.path.splitext(name)[1])
+    if format is None:
+        raise ValueError('%s: cannot tell the export format from the name, pick one of %s'
+                         % (path, ', '.join(FORMATS)))
+    return format
+
+
+def trackColumns(track):
+    # NumPy columns of a sqlAlch.streamTracks() row, one value per point.
+    columns = trackData.TrackData.fromPayload(track)
+    return {name: columns.column(name) for name in trackData.COLUMNS}
+
+
+def isoTimes(times):
+    # ISO 8601 UTC strings for epoch seconds, None where unknown.
+    text = [None] * len(times)
+    known = np.flatnonzero(~np.isnan(times))
+    if len(known):
+        milliseconds = np.round(times[known] * 1000).astype(np.int64)
+        unit = 's' if not (milliseconds % 1000).any() else 'ms'
+        for index, value in zip(known.tolist(), np.datetime_as_string(milliseconds.astype('datetime64[ms]'),
+                                                                      unit=unit).tolist()):
+            text[index] = value + 'Z'
+    return text
+
+
+def _elements(template, values):
+    return [template % value if value == value else '' for value in values.tolist()]
+
+
+def gpxPoints(columns):
+    times = isoTimes(columns['time'])
+    if not any(np.isnan(columns[name]).any() for name in ('ele', 'hr', 'speed')) and None not in times:
+        return [GPX_FULL_POINT % point for point in zip(
+            columns['lat'].tolist(), columns['lon'].tolist(), columns['ele'].tolist(), times,
+            columns['hr'].tolist(), columns['speed'].tolist())]
+    times = ['<time>%s</time>' % text if text is not None else '' for text in times]
+    extensions = [GPX_EXTENSIONS % (hr, speed) if hr or speed else '' for hr, speed in zip(
+        _elements(GPX_HR, columns['hr']), _elements(GPX_SPEED, columns['speed']))]
+    return [GPX_POINT % point for point in zip(columns['lat'].tolist(), columns['lon'].tolist(),
+                                               _elements('<ele>%r</ele>', columns['ele']), times, extensions)]
+
+
+def gpxTrack(track):
+    name = track['date'].isoformat() if track['date'] is not None else 'Track %d' % track['id']
+    parts = ['  <trk>\n    <name>%s</name>\n    <trkseg>\n' % escape(name)]
+    parts.extend(gpxPoints(trackColumns(track)))
+    parts.append('    </trkseg>\n  </trk>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def gpxMemberName(track):
+    if track['date'] is None:
+        return 'track-%d.gpx' % track['id']
+    return '%s-%d.gpx' % (track['date'].strftime('%Y%m%d-%H%M%S'), track['id'])
+
+
+def _jsonValues(values):
+    values = values.tolist()
+    if any(value != value for value in values):
+        return [value if value == value else None for value in values]
+    return values
+
+
+def geojsonFeature(track):
+    # LineString of [lon, lat, ele]; the per point times, heart rate and
+    # speed go into coordinateProperties, as read by togeojson and others.
+    columns = trackColumns(track)
+    properties = dict((name, track[name]) for name in PROPERTY_COLUMNS)
+    if properties['date'] is not None:
+        properties['date'] = properties['date'].isoformat()
+    properties['coordinateProperties'] = dict(times=isoTimes(columns['time']), hr=_jsonValues(columns['hr']),
+                                              speed=_jsonValues(columns['speed']))
+    coordinates = list(zip(columns['lon'].tolist(), columns['lat'].tolist(), _jsonValues(columns['ele'])))
+    feature = dict(type='Feature', id=track['id'], geometry=dict(type='LineString', coordinates=coordinates),
+                   properties=properties)
+    return json.dumps(feature, separators=(',', ':')).encode('utf-8')
+
+
+def encodeTrack(kind, track, compress=False):
+    # Runs in a worker process. Text is gzipped here, one gzip member per
+    # track: concatenated members are a valid .gz file, so compression is
+    # spread over the workers too.
+    if kind == 'columns':
+        columns = trackColumns(track)
+        columns['trackId'] = np.full(len(columns['lat']), track['id'], dtype=np.int64)
+        return columns
+    if kind == 'gpxDocument':
+        return gpxMemberName(track), GPX_HEADER + gpxTrack(track) + GPX_FOOTER
+    data = gpxTrack(track) if kind == 'gpx' else geojsonFeature(track)
+    if kind == 'ndjson':
+        data += b'\n'
+    return gzip.compress(data, COMPRESS_LEVEL) if compress else data
+
+
+def _encodeChunk(jobs):
+    return [encodeTrack(*job) for job in jobs]
+
+
+def _encoded(kind, tracks, compress, workers):
+    jobs = ((kind, track, compress) for track in tracks)
+    # a pool of one process would only add the pickling
+    if workerPool.poolSize(workers) == 1:
+        for job in jobs:
+            yield encodeTrack(*job)
+        return
+    poolSize = workerPool.poolSize(workers)
+    executor = ProcessPoolExecutor(max_workers=poolSize)
+    try:
+        for result in workerPool.boundedMap(executor, _encodeChunk, jobs, poolSize * workerPool.CHUNKS_PER_WORKER):
+            yield result
+    finally:
+        workerPool.shutdown(executor)
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet and Arrow export need the pyarrow package')
+    return pyarrow
+
+
+def arrowSchema(pa):
+    return pa.schema([('trackId', pa.int64()), ('point', pa.int32()), ('lat', pa.float64()),
+                      ('lon', pa.float64()), ('ele', pa.float64()), ('time', pa.timestamp('ms', tz='UTC')),
+                      ('hr', pa.float64()), ('speed', pa.float64())])
+
+
+def arrowBatch(pa, schema, tracks):
+    # One RecordBatch, one row per point, from trackColumns() dicts.
+    def column(name):
+        return np.concatenate([track[name] for track in tracks])
+    times = column('time')
+    unknown = np.isnan(times)
+    milliseconds = np.round(np.where(unknown, 0, times) * 1000).astype(np.int64)
+    arrays = [pa.array(column('trackId').astype(np.int64)),
+              pa.array(np.concatenate([np.arange(len(track['lat']), dtype=np.int32) for track in tracks])),
+              pa.array(column('lat')), pa.array(column('lon')), pa.array(column('ele'), from_pandas=True),
+              pa.array(milliseconds, type=schema.field('time').type, mask=unknown),
+              pa.array(column('hr'), from_pandas=True), pa.array(column('speed'), from_pandas=True)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _writeColumnar(format, path, columns, compress, batchSize, counted):
+    pa = _pyarrow()
+    schema = arrowSchema(pa)
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(path, schema, compression='gzip' if compress else 'snappy')
+        write = writer.write_batch
+    else:
+        # Arrow IPC has no gzip; its buffers are compressed with zstd instead
+        options = pa.ipc.IpcWriteOptions(compression='zstd' if compress else None)
+        sink = pa.OSFile(path, 'wb')
+        writer = pa.ipc.new_file(sink, schema, options=options)
+        write = writer.write_batch
+    try:
+        for batch in workerPool.chunks(counted(columns), batchSize):
+            write(arrowBatch(pa, schema, batch))
+    finally:
+        writer.close()
+        if format == 'arrow':
+            sink.close()
+
+
+def _openOutput(path):
+    if path == '-':
+        return sys.stdout.buffer
+    return open(path, 'wb', buffering=BUFFER_BYTES)
+
+
+def exportTracks(user, path, format=None, compress=None, workers=None, batchSize=BATCH_TRACKS, progress=None):
+    # Writes every track of `user` to `path` ('-' for stdout) and returns
+    # the number written. The format defaults to the one of the file name;
+    # a .zip name gives one GPX file per track, importable again as is.
+    # compress defaults to a .gz name and selects gzip for the text formats
+    # and the Parquet codec (.zip names default to deflated members). Tracks are streamed from the database and
+    # encoded in a worker pool with a bounded window, so memory does not
+    # grow with the number of tracks. `progress(done, total)` is called
+    # after each track.
+    format = format or formatForPath(path)
+    if format not in FORMATS:
+        raise ValueError('unknown export format %r' % format)
+    zipped = format == 'gpx' and path.lower().endswith('.zip')
+    if compress is None:
+        compress = zipped or path.lower().endswith('.gz')
+    total = sqlAlch.countTracks(user)
+    done = [0]
+
+    def counted(results):
+        for result in results:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0], total)
+            yield result
+
+    tracks = sqlAlch.streamTracks(user, batchSize)
+    if format in ('parquet', 'arrow'):
+        _writeColumnar(format, path, _encoded('columns', tracks, False, workers), compress, batchSize, counted)
+        return done[0]
+    if zipped:
+        method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(path, 'w', method) as archive:
+            for name, data in counted(_encoded('gpxDocument', tracks, False, workers)):
+                archive.writestr(name, data)
+        return done[0]
+    header, separator, footer = dict(gpx=(GPX_HEADER, b'', GPX_FOOTER), ndjson=(b'', b'', b''),
+                                     geojson=(GEOJSON_HEADER, b',\n', GEOJSON_FOOTER))[format]
+    if compress:
+        header, separator, footer = [gzip.compress(part, COMPRESS_LEVEL) if part else part
+                                     for part in (header, separator, footer)]
+    output = _openOutput(path)
+    try:
+        output.write(header)
+        for index, data in enumerate(counted(_encoded(format, tracks, compress, workers))):
+            if index and separator:
+                output.write(separator)
+            output.write(data)
+        output.write(footer)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        else:
+            output.flush()
+    return done[0]
@@ -0,0 +1,141 @@
+import hashlib
+import zipfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import gpxSources
+
+# Points (with their timestamps) hashed into headHash; a bulk import reads
+# only as much of a file as it takes to see them, at most HEAD_BYTES, to
+# tell which files may be stored already.
+HEAD_POINTS = 64
+HEAD_BYTES = 256 * 1024
+CHUNK_BYTES = 16 * 1024
+
+# Coordinates are compared at 1e-6 degrees (about 0.1 m), the precision of
+# the Amazfit export; the bounding box in the signature at 1e-4 degrees.
+COORDINATE_SCALE = 1e6
+SIGNATURE_FORMAT = '%s|%d|%.4f|%.4f|%.4f|%.4f'
+
+
+def normalisedPoints(points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return np.round(points * COORDINATE_SCALE).astype('<i8')
+
+
+def pointsHash(points):
+    # Hash of the coordinates alone: the same track exported again with
+    # other elevation units, HR or formatting still hashes the same.
+    return hashlib.sha1(normalisedPoints(points).tobytes()).hexdigest()
+
+
+def headHash(points, times, headPoints=HEAD_POINTS):
+    # Hash of the first headPoints points and timestamps, or None when the
+    # timestamps are unknown (tracks stored before they were kept).
+    if times is None:
+        return None
+    times = np.asarray(times, dtype=float)[:headPoints]
+    if len(times) == 0 or np.isnan(times).any():
+        return None
+    rows = np.column_stack((normalisedPoints(points)[:headPoints], np.round(times).astype('<i8')))
+    return hashlib.sha1(rows.tobytes()).hexdigest()
+
+
+def signature(points, start):
+    # start time, point count and bounding box: catches a re-export of the
+    # same activity whose coordinates were rounded differently.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if start is None or len(points) == 0:
+        return None
+    lowest = points.min(axis=0)
+    highest = points.max(axis=0)
+    return SIGNATURE_FORMAT % (start.strftime('%Y-%m-%dT%H:%M:%S'), len(points),
+                               lowest[0], highest[0], lowest[1], highest[1])
+
+
+def fingerprint(points, times, start):
+    return dict(pointsHash=pointsHash(points), headHash=headHash(points, times), signature=signature(points, start))
+
+
+def readHead(source, headPoints=HEAD_POINTS, maxBytes=HEAD_BYTES):
+    # (points, times) of the first headPoints track points of a GPX file
+    # object, parsed incrementally from at most maxBytes bytes. Follows
+    # GpxRecord.streamPoints, so the head hashes of both agree.
+    import gpxParse
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    points = []
+    times = []
+    depth = 0
+    read = 0
+    while len(points) < headPoints and read < maxBytes:
+        chunk = source.read(CHUNK_BYTES)
+        if not chunk:
+            break
+        read += len(chunk)
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            name = gpxParse.localName(elem.tag)
+            if name == 'trkseg':
+                depth += 1 if event == 'start' else -1
+            elif name == 'trkpt' and event == 'end' and depth > 0:
+                pointTime = next((child.text for child in elem if gpxParse.localName(child.tag) == 'time'), None)
+                points.append((float(elem.get('lat')), float(elem.get('lon'))))
+                times.append(gpxParse.parseGpxTime(pointTime).timestamp() if pointTime is not None else np.nan)
+                elem.clear()
+                if len(points) == headPoints:
+                    break
+    return points, times
+
+
+def sameTrack(fingerprint, known):
+    # The rule of sqlAlch.findTrackByFingerprint against [(pointsHash,
+    # signature)] of stored tracks.
+    return fingerprint is not None and any(
+        fingerprint['pointsHash'] == pointsHash or
+        (fingerprint['signature'] is not None and fingerprint['signature'] == signature)
+        for pointsHash, signature in known)
+
+
+def readHeadHash(path, headPoints=HEAD_POINTS, maxBytes=HEAD_BYTES, data=None):
+    # None when the head cannot be read; the full parse reports the error.
+    # `path` and `data` as for gpxSources.openSource().
+    try:
+        with gpxSources.openSource(path, data) as source:
+            points, times = readHead(source, headPoints, maxBytes)
+    except (OSError, EOFError, KeyError, zipfile.BadZipFile, ET.ParseError, ValueError, TypeError):
+        return None
+    if not points:
+        return None
+    return headHash(points, times, headPoints)
+
+
+def readFingerprint(path, data=None):
+    # fingerprint() of a whole GPX file from its coordinates and timestamps
+    # alone, without the rest of GpxRecord.parseFile; None when it cannot be
+    # read. Confirms a head hash match: a longer ride or a multi-track
+    # export may start with the points of a stored track.
+    import gpxParse
+    points = []
+    times = []
+    start = None
+    segment = None
+    try:
+        with gpxSources.openSource(path, data) as source:
+            for event, elem in ET.iterparse(source, events=('start', 'end')):
+                name = gpxParse.localName(elem.tag)
+                if name == 'trkseg':
+                    segment = elem if event == 'start' else None
+                elif name == 'trkpt' and event == 'end' and segment is not None:
+                    pointTime = next((child.text for child in elem if gpxParse.localName(child.tag) == 'time'), None)
+                    parsed = gpxParse.parseGpxTime(pointTime) if pointTime is not None else None
+                    if not points:
+                        start = parsed
+                    points.append((float(elem.get('lat')), float(elem.get('lon'))))
+                    times.append(parsed.timestamp() if parsed is not None else np.nan)
+                    segment.remove(elem)
+    except (OSError, EOFError, KeyError, zipfile.BadZipFile, ET.ParseError, ValueError, TypeError):
+        return None
+    if not points:
+        return None
+    return fingerprint(points, times, start)
@@ -0,0 +1,152 @@
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+import sqlAlch
+
+# Columns of the track list: title, sqlAlch.LIST_SORT_COLUMNS key and width.
+COLUMNS = (("Date", 'date', 130), ("Distance [km]", 'distance', 90), ("Time", 'rideTime', 70),
+           ("Speed [km/h]", 'avgSpeed', 85), ("HR", 'avgHr', 50))
+PAGE_ROWS = 100
+CACHED_ROWS = 2000
+# More changes than this at once re-read the ids instead of placing each
+# track with its own position query.
+MAX_PLACED_TRACKS = 200
+
+DATE_FORMATS = (('%Y-%m-%d', 'day'), ('%Y-%m', 'month'), ('%Y', 'year'))
+
+
+def _nextPeriod(start, period):
+    if period == 'day':
+        return datetime.fromordinal(start.toordinal() + 1)
+    if period == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start.replace(year=start.year + 1)
+
+
+def parseFilter(text):
+    # Filter words to getTrackListIds() keywords: a date prefix (2024,
+    # 2024-05 or 2024-05-03) and/or >km and <km for the distance.
+    filters = {}
+    for word in text.split():
+        try:
+            if word[0] in '<>':
+                value = float(word.lstrip('<>=').lower().replace('km', ''))
+                filters['minDistance' if word[0] == '>' else 'maxDistance'] = value
+                continue
+            for dateFormat, period in DATE_FORMATS:
+                try:
+                    start = datetime.strptime(word, dateFormat)
+                except ValueError:
+                    continue
+                filters['dateFrom'] = start
+                filters['dateTo'] = _nextPeriod(start, period)
+                break
+            else:
+                raise ValueError(word)
+        except (ValueError, IndexError):
+            raise ValueError("Unknown filter %r, expected a date like 2024-05 or >50 / <100 km" % word)
+    return filters
+
+
+def formatCell(row, key):
+    value = row[key]
+    if value is None:
+        return "-"
+    if key == 'date':
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if key == 'rideTime':
+        return value
+    if key == 'avgHr':
+        return "%.0f" % value
+    return "%.1f" % value
+
+
+class TrackListModel:
+    # Row order of the track list for a virtual wx.ListCtrl. Only the ids of
+    # the listed tracks are held (8 bytes each, read from the sort index);
+    # rows are fetched a page at a time when they are shown and kept by id,
+    # so inserts and deletes only move ids and never re-read the list.
+
+    def __init__(self, user, sortKey='date', descending=False):
+        self.user = user
+        self.sortKey = sortKey
+        self.descending = descending
+        self.filters = {}
+        self.rows = OrderedDict()
+        self.reload()
+
+    def reload(self):
+        self.ids = array('q', sqlAlch.getTrackListIds(self.user, self.sortKey, self.descending, **self.filters))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def setSort(self, sortKey, descending=False):
+        self.sortKey = sortKey
+        self.descending = descending
+        self.reload()
+
+    def setFilter(self, text):
+        # Raises ValueError for words parseFilter() does not understand.
+        self.filters = parseFilter(text)
+        self.reload()
+
+    def trackId(self, index):
+        return self.ids[index] if 0 <= index < len(self.ids) else None
+
+    def indexOf(self, trackId):
+        try:
+            return self.ids.index(trackId)
+        except ValueError:
+            return None
+
+    def row(self, index):
+        trackId = self.ids[index]
+        row = self.rows.get(trackId)
+        if row is None:
+            self._fetchPage(index)
+            return self.rows.get(trackId)
+        self.rows.move_to_end(trackId)
+        return row
+
+    def _fetchPage(self, index):
+        start = index - index % PAGE_ROWS
+        missing = [trackId for trackId in self.ids[start:start + PAGE_ROWS] if trackId not in self.rows]
+        self.rows.update(sqlAlch.getTrackListRows(missing))
+        while len(self.rows) > CACHED_ROWS:
+            self.rows.popitem(last=False)
+
+    def cell(self, index, column):
+        row = self.row(index)
+        return formatCell(row, COLUMNS[column][1]) if row is not None else ""
+
+    def applyChanges(self, changes):
+        # (event, trackId) pairs from sqlAlch track listeners, in order.
+        # SQLite hands the id of a deleted last track to the next insert, so
+        # an id may be deleted and inserted again: its last event decides.
+        last = dict((trackId, event) for event, trackId in changes)
+        deleted = set(trackId for event, trackId in changes if event == 'delete')
+        inserted = [trackId for trackId, event in last.items() if event == 'insert']
+        for trackId in deleted:
+            self.rows.pop(trackId, None)
+        if len(deleted) + len(inserted) > MAX_PLACED_TRACKS:
+            self.reload()
+            return
+        for trackId in deleted:
+            index = self.indexOf(trackId)
+            if index is not None:
+                del self.ids[index]
+        listed = set(self.ids)
+        positions = []
+        for trackId in inserted:
+            if trackId in listed:
+                continue
+            position = sqlAlch.getTrackListPosition(self.user, trackId, self.sortKey, self.descending,
+                                                    **self.filters)
+            if position is not None:
+                positions.append((position, trackId))
+        # positions are in the final order, so placing them front to back
+        # leaves every earlier one where it belongs
+        for position, trackId in sorted(positions):
+            self.ids.insert(position, trackId)
@@ -0,0 +1,87 @@
+import numpy as np
+
+import instrument
+import trackCodec
+
+# Levels of detail stored for every track, as Douglas-Peucker tolerances in
+# metres. The map picks the finest level that fits its point budget.
+LOD_TOLERANCES = (1.0, 5.0, 25.0)
+
+EARTH_RADIUS = 6378.137 * 1000
+
+
+def projectMeters(points):
+    # Equirectangular projection around the track's mean latitude; plenty
+    # accurate for ride-sized extents and cheap to vectorize.
+    points = np.asarray(points, dtype=float)
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    x = (lon - lon.mean()) * np.cos(lat.mean()) * EARTH_RADIUS
+    y = (lat - lat.mean()) * EARTH_RADIUS
+    return np.column_stack((x, y))
+
+
+def segmentDistances(points, a, b):
+    # Distance of every point to its segment a-b (all arrays row-aligned).
+    ab = b - a
+    ap = points - a
+    lengthSq = np.einsum('ij,ij->i', ab, ab)
+    t = np.divide(np.einsum('ij,ij->i', ap, ab), lengthSq, out=np.zeros_like(lengthSq), where=lengthSq > 0)
+    t = np.clip(t, 0.0, 1.0)
+    offset = ap - ab * t[:, None]
+    return np.sqrt(np.einsum('ij,ij->i', offset, offset))
+
+
+def significance(points, minTolerance=min(LOD_TOLERANCES)):
+    # Douglas-Peucker run breadth first: each pass splits every open segment
+    # at once with array operations instead of recursing per segment, and
+    # only revisits points of segments split in the previous pass. The
+    # returned weight of a point is the tolerance below which it is kept;
+    # weights are capped by the enclosing split so levels nest.
+    xy = projectMeters(points)
+    n = len(xy)
+    weight = np.zeros(n)
+    if n == 0:
+        return weight
+    weight[0] = weight[-1] = np.inf
+    # every pending point carries the ends of the segment it currently lies in
+    pending = np.arange(1, n - 1)
+    start = np.zeros(len(pending), dtype=np.intp)
+    end = np.full(len(pending), n - 1, dtype=np.intp)
+    while pending.size:
+        distance = segmentDistances(xy[pending], xy[start], xy[end])
+        newGroup = np.r_[True, start[1:] != start[:-1]]
+        groupStarts = np.flatnonzero(newGroup)
+        group = np.cumsum(newGroup) - 1
+        groupMax = np.maximum.reduceat(distance, groupStarts)
+        split = groupMax > minTolerance
+        candidates = np.flatnonzero((distance == groupMax[group]) & split[group])
+        splitGroups, first = np.unique(group[candidates], return_index=True)
+        chosenAt = candidates[first]
+        chosen = pending[chosenAt]
+        parent = np.minimum(weight[start[chosenAt]], weight[end[chosenAt]])
+        weight[chosen] = np.minimum(groupMax[splitGroups], parent)
+
+        splitPoint = np.full(len(groupMax), -1, dtype=np.intp)
+        splitPoint[splitGroups] = chosen
+        pivot = splitPoint[group]
+        remaining = (pivot >= 0) & (pending != pivot)
+        pending = pending[remaining]
+        pivot = pivot[remaining]
+        after = pending > pivot
+        start = np.where(after, pivot, start[remaining])
+        end = np.where(after, end[remaining], pivot)
+    return weight
+
+
+def simplify(points, tolerance):
+    points = np.asarray(points, dtype=float)
+    return points[significance(points, tolerance) >= tolerance]
+
+
+@instrument.timed('simplify')
+def buildLevels(points, tolerances=LOD_TOLERANCES):
+    # {tolerance: packed points} for every level, from a single DP run.
+    points = np.asarray(points, dtype=float)
+    weight = significance(points, min(tolerances))
+    return {tolerance: trackCodec.encodePoints(points[weight >= tolerance]) for tolerance in tolerances}
@@ -0,0 +1,33 @@
+import MapMaker
+import plotData
+import renderCache
+import sqlAlch
+import trackCodec
+
+
+def loadSeries(trackId):
+    track = sqlAlch.getTrackData(trackId)
+    return plotData.cumulativeDistance(track), track.column('ele'), track.column('hr')
+
+
+def loadMapScript(trackId):
+    return MapMaker.trackScript(trackCodec.decode(sqlAlch.getMapPoints(trackId, MapMaker.MAX_MAP_POINTS)))
+
+
+def loadTrackView(trackId, checkCancelled=None, cache=None):
+    # Everything the main window shows for one track: the summary row, the
+    # map script and the plotted series. No wx here so it can run headless
+    # (benchmarks/runBenchmarks.py times this exact path).
+    cache = renderCache.trackCache if cache is None else cache
+    summary = sqlAlch.getTrack(trackId)
+    if summary is None:
+        return None
+    cacheKey = (trackId, summary['contentHash'])
+    if checkCancelled is not None:
+        checkCancelled()
+    script = cache.getOrCreate(('mapScript',) + cacheKey + (MapMaker.MAX_MAP_POINTS, MapMaker.POLYLINE_PRECISION),
+                               lambda: loadMapScript(trackId))
+    if checkCancelled is not None:
+        checkCancelled()
+    series = cache.getOrCreate(('series',) + cacheKey, lambda: loadSeries(trackId))
+    return summary, script, series
@@ -0,0 +1,45 @@
+import os
+from collections import deque
+
+# Jobs handed to a worker at once, and chunks queued per worker: bounds the
+# work (and its results) held in memory, however many jobs there are.
+MAX_CHUNK = 8
+CHUNKS_PER_WORKER = 2
+
+
+def poolSize(workers=None):
+    return workers or os.cpu_count() or 1
+
+
+def chunks(jobs, size):
+    chunk = []
+    for job in jobs:
+        chunk.append(job)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def boundedMap(executor, chunkFunction, jobs, window, chunksize=MAX_CHUNK):
+    # executor.map() submits every job up front; this keeps at most `window`
+    # chunks in flight and yields chunkFunction's results in order.
+    # chunkFunction takes a list of jobs and returns a list of results.
+    pending = deque()
+    for chunk in chunks(jobs, chunksize):
+        if len(pending) >= window:
+            for result in pending.popleft().result():
+                yield result
+        pending.append(executor.submit(chunkFunction, chunk))
+    while pending:
+        for result in pending.popleft().result():
+            yield result
+
+
+def shutdown(executor):
+    try:
+        executor.shutdown(wait=True, cancel_futures=True)
+    except TypeError:
+        # Python < 3.9 cannot drop queued work
+        executor.shutdown(wait=True)